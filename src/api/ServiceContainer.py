@@ -1,98 +1,173 @@
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-
-from TextProcessor import FileLoader, TextChunker
-import config
-from LLMService import LLMService
-from EmbeddingService import EmbeddingService
-from VectorStore import VectorStore
-from RAGService import RAGAgent
-import logging
-import os
-import warnings
-
-warnings.filterwarnings("ignore", category=UserWarning)
-warnings.filterwarnings("ignore", category=FutureWarning)
-
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",")
-ENV = os.getenv("ENV", "development")
-
-if not GOOGLE_API_KEY:
-    logger.warning("GOOGLE_API_KEY not set; LLM service may fail at runtime")
-
-
-class ServiceContainer:
-    # Manages service lifecycle and dependencies
-    def __init__(self):
-        self.llm = None
-        self.embed_engine = None
-        self.vector_store = None
-        self.rag = None
-        self.initialized = False
-
-    def initialize(self):
-        # Initialize all services with error handling
-        try:
-            logger.info("Starting service initialization...")
-
-            # Initialize LLM service
-            self.llm = LLMService(api_key=GOOGLE_API_KEY or "")
-            logger.info("LLM Service initialized")
-
-            # Initialize embedding engine
-            self.embed_engine = EmbeddingService()
-            logger.info("Embedding Service initialized")
-
-            # Initialize vector store
-            self.vector_store = VectorStore()
-            logger.info("Vector Store initialized")
-
-            # Load and process documents
-            loader = FileLoader(config.FileLoaderConfig.path)
-            docs = loader.load_files()
-            if not docs:
-                raise RuntimeError("No documents found in data directory")
-            logger.info(f"Loaded {len(docs)} documents")
-
-            # Chunk documents
-            chunker = TextChunker(docs,
-                                 chunk_size=config.ChunkerConfig.chunk_size,
-                                 chunk_overlap=config.ChunkerConfig.chunk_overlap)
-            chunks = chunker.split_docs()
-            if not chunks:
-                raise RuntimeError("Failed to chunk documents")
-            logger.info(f"Created {len(chunks)} chunks")
-
-            # Embed and populate vector store
-            embeds, metas = self.embed_engine.embed_documents(chunks)
-            self.vector_store.add(embeds, metas)
-            logger.info(f"Populated vector store with {self.vector_store.index.ntotal} vectors")
-
-            # Initialize RAG agent
-            self.rag = RAGAgent(self.llm, self.vector_store, self.embed_engine, config.TicketResponse)
-            logger.info("RAG Agent initialized")
-
-            self.initialized = True
-            logger.info("All services initialized successfully")
-
-        except Exception as e:
-            logger.exception(f"Service initialization failed: {str(e)}")
-            self.initialized = False
-            raise
-
-    def get_status(self) -> dict:
-        # Get health status of all services
-        return {
-            "llm_initialized": self.llm is not None,
-            "embedding_initialized": self.embed_engine is not None,
-            "vector_store_initialized": self.vector_store is not None,
-            "vector_store_size": self.vector_store.index.ntotal if self.vector_store else 0,
-            "rag_initialized": self.rag is not None,
-            "overall_initialized": self.initialized,
-        }
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+import config
+from LLMService import LLMService
+from EmbeddingService import EmbeddingService
+from VectorStore import VectorStore
+from RAGService import RAGAgent
+from IndexManager import IndexManager
+from SemanticCache import SemanticCache
+from EmbeddingBatcher import EmbeddingBatcher
+from Reranker import Reranker
+from PromptBuilder import PromptBuilder, load_token_counter
+import logging
+import os
+import warnings
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",")
+ENV = os.getenv("ENV", "development")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", config.LLMServiceConfig.base_url)
+
+if not GOOGLE_API_KEY:
+    logger.warning("GOOGLE_API_KEY not set; LLM service may fail at runtime")
+
+
+class ServiceContainer:
+    # Manages service lifecycle and dependencies
+    def __init__(self):
+        self.llm = None
+        self.embed_engine = None
+        self.vector_store = None
+        self.rag = None
+        self.index_manager = None
+        self.cache = None
+        self.batcher = None
+        self.reranker = None
+        self.initialized = False
+
+    def initialize(self, start_background: bool = True):
+        # Initialize all services with error handling. Without start_background no threads are
+        # started, so the process can be forked; each worker then calls start_background itself.
+        try:
+            logger.info("Starting service initialization...")
+
+            # Initialize LLM service
+            self.llm = LLMService(api_key=GOOGLE_API_KEY or "",
+                                  model=config.LLMServiceConfig.model,
+                                  max_concurrency=config.LLMServiceConfig.max_concurrency,
+                                  timeout=config.LLMServiceConfig.timeout,
+                                  base_url=LLM_BASE_URL,
+                                  prompt_cache=config.LLMServiceConfig.prompt_cache,
+                                  prompt_cache_ttl=config.LLMServiceConfig.prompt_cache_ttl,
+                                  prompt_cache_refresh_margin=config.LLMServiceConfig.prompt_cache_refresh_margin)
+            logger.info("LLM Service initialized")
+
+            # Initialize embedding engine
+            cache_path = config.EmbeddingServiceConfig.query_cache_path
+            self.embed_engine = EmbeddingService(model_name=config.EmbeddingServiceConfig.model_name,
+                                                 embedding_dim=config.VectorStoreConfig.embedding_dim,
+                                                 query_cache_size=config.EmbeddingServiceConfig.query_cache_size,
+                                                 query_cache_path=str(cache_path) if cache_path else None,
+                                                 backend=config.EmbeddingServiceConfig.backend,
+                                                 quantize=config.EmbeddingServiceConfig.quantize,
+                                                 quantization_target=config.EmbeddingServiceConfig.quantization_target,
+                                                 model_cache_dir=str(config.EmbeddingServiceConfig.model_cache_dir))
+            logger.info("Embedding Service initialized")
+
+            if config.EmbeddingBatcherConfig.enabled:
+                self.batcher = EmbeddingBatcher(
+                    self.embed_engine,
+                    max_batch_size=config.EmbeddingBatcherConfig.max_batch_size,
+                    max_wait_ms=config.EmbeddingBatcherConfig.max_wait_ms,
+                    max_queue_size=config.EmbeddingBatcherConfig.max_queue_size,
+                )
+
+            # Initialize vector store
+            self.vector_store = VectorStore(embedding_dim=config.VectorStoreConfig.embedding_dim,
+                                            index_config=config.VectorStoreConfig(),
+                                            hybrid_config=config.HybridSearchConfig())
+            logger.info("Vector Store initialized")
+
+            # Context blocks are measured with this tokenizer when chunks are indexed
+            PromptBuilder.use_tokenizer(*load_token_counter(config.PromptConfig.tokenizer_model))
+
+            # Load the index snapshot, or chunk, embed and snapshot the documents
+            self.index_manager = IndexManager(self.embed_engine, self.vector_store,
+                                              dedup_config=config.DedupConfig(),
+                                              ingest_config=config.IngestConfig())
+            loaded = self.index_manager.load_or_build()
+            logger.info(f"Vector store {'loaded' if loaded else 'built'} with "
+                        f"{self.vector_store.index.ntotal} vectors "
+                        f"(index version {self.index_manager.index_version})")
+
+            # Initialize RAG agent
+            if config.SemanticCacheConfig.enabled:
+                self.cache = SemanticCache(
+                    similarity_threshold=config.SemanticCacheConfig.similarity_threshold,
+                    max_entries=config.SemanticCacheConfig.max_entries,
+                    ttl_seconds=config.SemanticCacheConfig.ttl_seconds,
+                    max_bytes=config.SemanticCacheConfig.max_bytes,
+                )
+            if config.RerankerConfig.enabled:
+                self.reranker = Reranker(
+                    model_name=config.RerankerConfig.model_name,
+                    top_n=config.RerankerConfig.top_n,
+                    candidates=config.RerankerConfig.candidates,
+                    batch_size=config.RerankerConfig.batch_size,
+                    budget_ms=config.RerankerConfig.budget_ms,
+                    max_length=config.RerankerConfig.max_length,
+                )
+                logger.info(f"Reranker {config.RerankerConfig.model_name} initialized")
+            self.rag = RAGAgent(self.llm, self.vector_store, self.embed_engine, config.TicketResponse,
+                                cache=self.cache, batcher=self.batcher,
+                                relevance_config=config.RelevanceGateConfig(),
+                                reranker=self.reranker)
+            logger.info("RAG Agent initialized")
+
+            self.initialized = True
+            logger.info("All services initialized successfully")
+            if start_background:
+                self.start_background()
+
+        except Exception as e:
+            logger.exception(f"Service initialization failed: {str(e)}")
+            self.initialized = False
+            raise
+
+    def start_background(self, watch_data: bool = True, follow_snapshots: bool = False):
+        # Background index maintenance. With several workers one watches the data directory
+        # and the others load the snapshots it publishes.
+        if watch_data and config.VectorStoreConfig.sync_interval > 0:
+            self.index_manager.start_watcher(config.VectorStoreConfig.sync_interval)
+        if follow_snapshots and config.VectorStoreConfig.follow_interval > 0:
+            self.index_manager.follow_snapshots(config.VectorStoreConfig.follow_interval)
+
+    def shutdown(self):
+        # Stop background work started by initialize
+        if self.index_manager is not None:
+            self.index_manager.stop_watcher()
+        if self.embed_engine is not None:
+            self.embed_engine.save_query_cache()
+
+    def get_status(self) -> dict:
+        # Get health status of all services
+        return {
+            "llm_initialized": self.llm is not None,
+            "embedding_initialized": self.embed_engine is not None,
+            "query_embedding_cache": self.embed_engine.query_cache.stats() if self.embed_engine else None,
+            "embedding_batcher": self.batcher.stats() if self.batcher else None,
+            "vector_store_initialized": self.vector_store is not None,
+            "vector_store_size": self.vector_store.index.ntotal if self.vector_store else 0,
+            "vector_index_type": self.vector_store.index_type if self.vector_store else None,
+            "lexical_index": self.vector_store.lexical_stats() if self.vector_store else None,
+            "index_version": self.index_manager.index_version if self.index_manager else None,
+            "dedup": self.index_manager.dedup_stats() if self.index_manager else None,
+            "index_build": self.index_manager.last_ingest if self.index_manager else None,
+            "llm_in_flight": self.llm.in_flight if self.llm else 0,
+            "llm": self.llm.stats() if self.llm else None,
+            "rag_initialized": self.rag is not None,
+            "rag": self.rag.stats() if self.rag else None,
+            "reranker": self.reranker.stats() if self.reranker else None,
+            "answer_cache": self.cache.stats() if self.cache else None,
+            "overall_initialized": self.initialized,
+        }
@@ -1,121 +1,334 @@
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-
-from TextProcessor import FileLoader, TextChunker
-import config
-from LLMService import LLMService
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.middleware.cors import CORSMiddleware
-import logging
-from EmbeddingService import EmbeddingService
-from VectorStore import VectorStore
-from RAGService import RAGAgent
-import os
-import warnings
-
-warnings.filterwarnings("ignore", category=UserWarning)
-warnings.filterwarnings("ignore", category=FutureWarning)
-
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",")
-ENV = os.getenv("ENV", "development")
-
-if not GOOGLE_API_KEY:
-    logger.warning("GOOGLE_API_KEY not set; LLM service may fail at runtime")
-
-
-from ServiceContainer import ServiceContainer
-
-
-app = FastAPI(
-    title="RAG Support Ticket API",
-    description="RAG support ticket resolution",
-    version="1.0.0"
-)
-
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=ALLOWED_ORIGINS,
-    allow_credentials=True,
-    allow_methods=["GET", "POST"],
-    allow_headers=["Content-Type"],
-)
-
-
-services = ServiceContainer()
-
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize services on startup"""
-    try:
-        services.initialize()
-        if not services.initialized:
-            raise RuntimeError("Services failed to initialize")
-    except Exception as e:
-        logger.error(f"Startup failed: {str(e)}")
-        raise
-
-
-def get_services() -> ServiceContainer:
-    #Dependency injection for services
-    if not services.initialized:
-        raise HTTPException(
-            status_code=503,
-            detail="Services not initialized. Check startup logs."
-        )
-    return services
-
-
-@app.post("/resolve-ticket", response_model=config.TicketResponse)
-async def resolve_ticket(request: config.TicketRequest, svc: ServiceContainer = Depends(get_services)):
-    try:
-        # Validate input
-        if not request.query or not request.query.strip():
-            logger.warning("Resolve ticket called with empty query")
-            return config.TicketResponse(
-                answer="Unable to process empty query. Please provide a valid support question.",
-                references=[],
-                action_required="follow_up_required"
-            )
-        
-        # Log the incoming request
-        logger.info(f"Processing support ticket: {request.query[:100]}...")
-        
-        # Call RAG pipeline with the user's query
-        response = await svc.rag.answer_query(request.query)
-        
-        # Log successful resolution
-        logger.info(f"Ticket resolved successfully")
-        
-        return response
-        
-    except ValueError as e:
-        logger.error(f"Validation error in resolve_ticket: {str(e)}")
-        raise HTTPException(status_code=400, detail="Invalid request data.")
-        
-    except Exception as e:
-        logger.exception(f"Unexpected error in resolve_ticket: {str(e)}")
-        raise HTTPException(status_code=500, detail="An unexpected error occurred while processing your request.")
-
-
-@app.get("/health")
-async def health_check(svc: ServiceContainer = Depends(get_services)):
-    """Enhanced health check with service status"""
-    status = svc.get_status()
-    return {
-        "status": "healthy" if svc.initialized else "degraded",
-        "services": status,
-        "environment": ENV,
-    }
-
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from TextProcessor import FileLoader, TextChunker
+import config
+from LLMService import LLMService, LLMServiceError, LLMTimeoutError
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+import logging
+from EmbeddingService import EmbeddingService
+from VectorStore import VectorStore
+from RAGService import RAGAgent
+from EmbeddingBatcher import EmbeddingQueueFull
+from StageTimings import StageTimings
+import Metrics
+import asyncio
+import json
+from typing import List
+import os
+import warnings
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",")
+ENV = os.getenv("ENV", "development")
+
+if not GOOGLE_API_KEY:
+    logger.warning("GOOGLE_API_KEY not set; LLM service may fail at runtime")
+
+
+from ServiceContainer import ServiceContainer
+
+
+app = FastAPI(
+    title="RAG Support Ticket API",
+    description="RAG support ticket resolution",
+    version="1.0.0"
+)
+
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    # Lets browser dev tools show the stage timings of cross-origin responses
+    expose_headers=["Server-Timing"],
+)
+
+
+class RequestTimingMiddleware:
+    """Times every request's pipeline stages and reports them in a Server-Timing header.
+    Ticket endpoints are also counted in flight and observed in the request time histogram."""
+
+    def __init__(self, app, server_timing: bool = True):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = StageTimings.begin()
+        status = 500
+        started = False
+
+        async def send_with_timings(message):
+            nonlocal started, status
+            # Streamed responses start after retrieval, so their header covers the stages until then
+            if message["type"] == "http.response.start":
+                started = True
+                status = message["status"]
+                if self.server_timing:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", timings.header().encode("latin-1"))]
+            await send(message)
+
+        in_flight = Metrics.in_flight(scope["path"])
+        if in_flight is not None:
+            in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_timings)
+        except Exception:
+            # Unhandled errors would get their 500 from the outermost middleware, without the timings
+            if not started:
+                await send_with_timings({"type": "http.response.start", "status": 500,
+                                         "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+                await send_with_timings({"type": "http.response.body", "body": b"Internal Server Error"})
+            raise
+        finally:
+            if in_flight is not None:
+                in_flight.dec()
+                Metrics.observe_request(scope["path"], status, timings.total())
+
+
+app.add_middleware(RequestTimingMiddleware, server_timing=config.ServerTimingConfig.enabled)
+
+
+services = ServiceContainer()
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Initialize services on startup"""
+    try:
+        # The pre-fork launcher (serve.py) initializes once in the parent before forking workers
+        if not services.initialized:
+            services.initialize()
+        if not services.initialized:
+            raise RuntimeError("Services failed to initialize")
+    except Exception as e:
+        logger.error(f"Startup failed: {str(e)}")
+        raise
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background services on shutdown"""
+    if services.batcher is not None:
+        await services.batcher.close()
+    services.shutdown()
+
+
+def get_services() -> ServiceContainer:
+    #Dependency injection for services
+    if not services.initialized:
+        raise HTTPException(
+            status_code=503,
+            detail="Services not initialized. Check startup logs."
+        )
+    return services
+
+
+class ClientDisconnected(Exception):
+    """Raised when the HTTP client goes away before its ticket is resolved."""
+
+
+async def cancel_on_disconnect(http_request: Request, coro, poll_interval: float = 0.25):
+    #Await coro, cancelling it (and any in-flight LLM call) if the client disconnects
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+@app.post("/resolve-ticket", response_model=config.TicketResponse)
+async def resolve_ticket(request: config.TicketRequest, http_request: Request, svc: ServiceContainer = Depends(get_services)):
+    try:
+        # Validate input
+        if not request.query or not request.query.strip():
+            logger.warning("Resolve ticket called with empty query")
+            return config.TicketResponse(
+                answer="Unable to process empty query. Please provide a valid support question.",
+                references=[],
+                action_required="follow_up_required"
+            )
+        
+        # Log the incoming request
+        logger.info(f"Processing support ticket: {request.query[:100]}...")
+        
+        # Call RAG pipeline with the user's query
+        response = await cancel_on_disconnect(http_request, svc.rag.answer_query(request.query))
+        
+        # Log successful resolution
+        logger.info(f"Ticket resolved successfully")
+        
+        return response
+        
+    except ClientDisconnected:
+        logger.info("Client disconnected, ticket processing cancelled")
+        # 499: client closed request (nginx convention); nobody is left to read it
+        return Response(status_code=499)
+
+    except EmbeddingQueueFull:
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly.")
+
+    except ValueError as e:
+        logger.error(f"Validation error in resolve_ticket: {str(e)}")
+        raise HTTPException(status_code=400, detail="Invalid request data.")
+        
+    except Exception as e:
+        logger.exception(f"Unexpected error in resolve_ticket: {str(e)}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while processing your request.")
+
+
+def sse_event(event: str, data) -> str:
+    #Format one server-sent event with a JSON payload
+    if isinstance(data, BaseModel):
+        data = data.model_dump()
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/resolve-ticket/stream")
+async def resolve_ticket_stream(request: config.TicketRequest, svc: ServiceContainer = Depends(get_services)):
+    """Resolve a ticket as server-sent events: references, answer pieces, then the final result"""
+    if not request.query or not request.query.strip():
+        logger.warning("Streaming resolve ticket called with empty query")
+        empty = config.TicketResponse(
+            answer="Unable to process empty query. Please provide a valid support question.",
+            references=[],
+            action_required="follow_up_required"
+        )
+        return StreamingResponse(iter([sse_event("result", empty)]), media_type="text/event-stream")
+
+    logger.info(f"Streaming support ticket: {request.query[:100]}...")
+    events = svc.rag.answer_query_stream(request.query)
+
+    # Embedding and retrieval happen before the first event, so their failures still get a status code
+    try:
+        first = await events.__anext__()
+    except EmbeddingQueueFull:
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly.")
+    except Exception as e:
+        logger.exception(f"Unexpected error in resolve_ticket_stream: {str(e)}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while processing your request.")
+
+    async def stream():
+        # A client disconnect cancels this generator, and with it the LLM stream
+        try:
+            yield sse_event(*first)
+            async for event, data in events:
+                yield sse_event(event, data)
+            logger.info("Streamed ticket resolved successfully")
+        except Exception as e:
+            logger.exception(f"Ticket stream failed: {str(e)}")
+            yield sse_event("error", {"detail": describe_ticket_error(e)})
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def describe_ticket_error(error: BaseException) -> str:
+    #Client-facing message for a failed ticket in a batch; details stay in the logs
+    if isinstance(error, ValueError):
+        return "Unable to process empty query. Please provide a valid support question."
+    if isinstance(error, LLMTimeoutError):
+        return "The language model timed out while processing this ticket."
+    if isinstance(error, LLMServiceError):
+        return "The language model failed to process this ticket."
+    return "An unexpected error occurred while processing this ticket."
+
+
+@app.post("/resolve-tickets", response_model=List[config.TicketResult])
+async def resolve_tickets(requests: List[config.TicketRequest], http_request: Request, svc: ServiceContainer = Depends(get_services)):
+    if not requests:
+        return []
+    if len(requests) > config.TicketBatchConfig.max_batch_size:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.TicketBatchConfig.max_batch_size} tickets per batch."
+        )
+
+    try:
+        logger.info(f"Processing batch of {len(requests)} support tickets")
+
+        answers = await cancel_on_disconnect(
+            http_request,
+            svc.rag.answer_queries([r.query for r in requests],
+                                   max_concurrency=config.TicketBatchConfig.max_concurrency),
+        )
+
+        results = []
+        for i, answer in enumerate(answers):
+            if isinstance(answer, BaseException):
+                logger.error(f"Ticket {i} in batch failed: {answer!r}")
+                results.append(config.TicketResult(index=i, error=describe_ticket_error(answer)))
+            else:
+                results.append(config.TicketResult(index=i, response=answer))
+
+        logger.info(f"Batch resolved: {sum(r.error is None for r in results)}/{len(results)} succeeded")
+        return results
+
+    except ClientDisconnected:
+        logger.info("Client disconnected, ticket batch cancelled")
+        return Response(status_code=499)
+
+    except Exception as e:
+        logger.exception(f"Unexpected error in resolve_tickets: {str(e)}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while processing your request.")
+
+
+@app.post("/reindex")
+async def reindex(svc: ServiceContainer = Depends(get_services)):
+    """Sync the index with the data directory; queries keep being served meanwhile"""
+    try:
+        result = await asyncio.to_thread(svc.index_manager.sync)
+        logger.info(f"Reindex finished: {result}")
+        return result
+    except Exception as e:
+        logger.exception(f"Reindex failed: {str(e)}")
+        raise HTTPException(status_code=500, detail="Reindexing failed.")
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage and request time histograms, in-flight requests, index size, LLM errors"""
+    if services.vector_store is not None:
+        Metrics.INDEX_VECTORS.set(services.vector_store.index.ntotal)
+    body, content_type = Metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/health")
+async def health_check(svc: ServiceContainer = Depends(get_services)):
+    """Enhanced health check with service status"""
+    status = svc.get_status()
+    return {
+        "status": "healthy" if svc.initialized else "degraded",
+        "services": status,
+        "environment": ENV,
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
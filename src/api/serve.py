@@ -0,0 +1,297 @@
+"""
+Pre-fork launcher for production serving.
+
+Loads the services (embedding model, index, caches) once in a parent process,
+then forks worker processes that serve the API from one shared socket. The
+workers share the parent's model weights and index pages copy-on-write
+instead of each loading their own copy in the startup hook:
+
+    python src/api/serve.py --workers 4 --port 8000
+    python src/api/serve.py --workers 4 --threads 2 --prebuild
+
+Each worker gets its own slice of the CPU cores for torch and FAISS, and the
+aggregate memory of the workers is logged next to the estimate for N
+independently started uvicorn processes. The workers write their Prometheus
+metrics to PROMETHEUS_MULTIPROC_DIR (a temporary directory unless set), so
+/metrics on any worker reports all of them.
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+# Thread pools are sized from these when the libraries load, so they are set before any import
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+SMAPS_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared_clean",
+    "Shared_Dirty": "shared_dirty",
+    "Private_Clean": "private_clean",
+    "Private_Dirty": "private_dirty",
+}
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("serve")
+
+
+def threads_per_worker(workers: int, cpus: int = None) -> int:
+    #Split the cores evenly so N workers never run more compute threads than there are cores
+    cpus = cpus or len(os.sched_getaffinity(0))
+    return max(1, cpus // max(1, workers))
+
+
+def limit_threads(threads: int):
+    #Compute threads of this process for torch, FAISS and BLAS
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    import torch
+    import faiss
+    torch.set_num_threads(threads)
+    faiss.omp_set_num_threads(threads)
+
+
+def parse_smaps_rollup(text: str) -> dict:
+    #Memory totals in bytes from /proc/<pid>/smaps_rollup
+    memory = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(":")
+        if name in SMAPS_FIELDS:
+            memory[SMAPS_FIELDS[name]] = int(value.split()[0]) * 1024
+    return memory
+
+
+def read_memory(pid: int) -> dict:
+    with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as f:
+        return parse_smaps_rollup(f.read())
+
+
+def memory_report(parent_rss: int, parent: dict, workers: list[dict]) -> dict:
+    #Actual footprint of the pool (sum of PSS, shared pages counted once) against N processes
+    #that each load everything themselves, i.e. N times the parent's RSS after initialization
+    actual = parent["pss"] + sum(worker["pss"] for worker in workers)
+    naive = parent_rss * len(workers)
+    return {
+        "workers": len(workers),
+        "parent_rss": parent_rss,
+        "worker_rss": [worker["rss"] for worker in workers],
+        "worker_private": [worker["private_clean"] + worker["private_dirty"] for worker in workers],
+        "aggregate_rss": parent["rss"] + sum(worker["rss"] for worker in workers),
+        "aggregate_pss": actual,
+        "naive_rss": naive,
+        "saved_bytes": naive - actual,
+    }
+
+
+def format_memory_report(report: dict) -> str:
+    mb = 1024 * 1024
+    private = ", ".join(f"{value / mb:.0f}" for value in report["worker_private"])
+    return (f"{report['workers']} workers use {report['aggregate_pss'] / mb:.0f} MB in total (PSS) "
+            f"vs ~{report['naive_rss'] / mb:.0f} MB for {report['workers']} independent processes "
+            f"({report['saved_bytes'] / mb:.0f} MB saved); summed RSS {report['aggregate_rss'] / mb:.0f} MB, "
+            f"private MB per worker: {private}")
+
+
+def prepare_metrics_dir() -> str:
+    #Must run before prometheus_client is imported; files left by an earlier run are removed
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(prefix="rag-metrics-")
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+def mark_worker_dead(pid: int):
+    #Drops the in-flight gauge of a dead worker; its counters and histograms keep counting
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(pid)
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    #One listening socket shared by every worker; the kernel hands each connection to one of them
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerPool:
+    #Forks workers running target(index), restarts the ones that die and stops them on SIGTERM/SIGINT
+
+    def __init__(self, workers: int, target, graceful_timeout: float = 30.0, on_tick=None, on_exit=None):
+        self.workers = workers
+        self.target = target
+        self.graceful_timeout = graceful_timeout
+        self.on_tick = on_tick
+        # Called with the pid of every worker that exited
+        self.on_exit = on_exit
+        # pid -> worker index
+        self.children = {}
+        self.stopping = False
+        self._stop_deadline = None
+
+    @property
+    def pids(self) -> list[int]:
+        return sorted(self.children)
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.target(index)
+                code = 0
+            except BaseException:
+                logger.exception(f"Worker {index} failed")
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        logger.info(f"Started worker {index} (pid {pid})")
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def stop(self, *_):
+        if not self.stopping:
+            logger.info("Stopping workers")
+            self.stopping = True
+            self._stop_deadline = time.monotonic() + self.graceful_timeout
+            self._signal(signal.SIGTERM)
+
+    def _signal(self, sig):
+        for pid in self.pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def supervise(self, poll_interval: float = 0.2):
+        #Runs until every worker has exited after stop()
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                if self.stopping and time.monotonic() > self._stop_deadline:
+                    logger.warning("Workers did not stop in time, killing them")
+                    self._signal(signal.SIGKILL)
+                    self._stop_deadline = float("inf")
+                if self.on_tick is not None and not self.stopping:
+                    self.on_tick()
+                time.sleep(poll_interval)
+                continue
+
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if self.on_exit is not None:
+                self.on_exit(pid)
+            if not self.stopping:
+                logger.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting it")
+                self._spawn(index)
+
+
+def prebuild_index():
+    #Build (or validate) the index snapshot with every core in a fresh process; the parent then
+    #only maps the finished snapshot and never starts a multi-threaded OpenMP pool before forking
+    import multiprocessing
+    process = multiprocessing.get_context("spawn").Process(target=_build_index, name="index-build")
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Index build failed with exit code {process.exitcode}")
+
+
+def _build_index():
+    from ServiceContainer import ServiceContainer
+    ServiceContainer().initialize(start_background=False)
+
+
+def run_worker(index: int, sock: socket.socket, args, threads: int):
+    import uvicorn
+    from app import app, services
+
+    limit_threads(threads)
+    # Every worker follows the snapshots the others publish after a sync or /reindex;
+    # only worker 0 watches the data directory itself
+    services.start_background(watch_data=index == 0, follow_snapshots=args.workers > 1)
+    server = uvicorn.Server(uvicorn.Config(app, log_level=args.log_level,
+                                           timeout_graceful_shutdown=args.graceful_timeout))
+    server.run(sockets=[sock])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch/FAISS threads per worker (default: cores / workers)")
+    parser.add_argument("--prebuild", action="store_true",
+                        help="build a missing or stale index snapshot with all cores before loading it")
+    parser.add_argument("--report-after", type=float, default=15.0,
+                        help="log the memory report this many seconds after the workers start; 0 disables it")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    threads = args.threads or threads_per_worker(args.workers)
+    metrics_dir = prepare_metrics_dir()
+    # Forked children inherit a multi-threaded OpenMP pool in a broken state, so the parent stays
+    # single-threaded; tokenizers would otherwise warn and disable their parallelism in every worker
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    limit_threads(1)
+
+    if args.prebuild:
+        prebuild_index()
+
+    from app import services
+    services.initialize(start_background=False)
+    parent_rss = read_memory(os.getpid())["rss"]
+    # Move the loaded objects out of the collector's reach so its passes do not write to
+    # (and so un-share) the pages holding them in every worker
+    gc.collect()
+    gc.freeze()
+
+    sock = bind_socket(args.host, args.port)
+    report_at = time.monotonic() + args.report_after if args.report_after > 0 else None
+
+    def report_memory():
+        nonlocal report_at
+        if report_at is None or time.monotonic() < report_at:
+            return
+        report_at = None
+        try:
+            workers = [read_memory(pid) for pid in pool.pids]
+            logger.info(format_memory_report(memory_report(parent_rss, read_memory(os.getpid()), workers)))
+        except OSError as e:
+            logger.warning(f"Memory report unavailable: {e}")
+
+    pool = WorkerPool(args.workers, lambda index: run_worker(index, sock, args, threads),
+                      graceful_timeout=args.graceful_timeout, on_tick=report_memory, on_exit=mark_worker_dead)
+    signal.signal(signal.SIGTERM, pool.stop)
+    signal.signal(signal.SIGINT, pool.stop)
+    logger.info(f"Serving on {args.host}:{args.port} with {args.workers} workers, {threads} threads each; "
+                f"metrics in {metrics_dir}")
+    pool.start()
+    pool.supervise()
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import json
+import os
+import re
+from collections import Counter
+import numpy as np
+from ChunkStore import load_array, save_array, write_atomic
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# Bump when tokenization changes so persisted postings are rebuilt from the chunk text
+LEXICAL_FORMAT_VERSION = 2
+LEXICAL_ARRAYS = ("row_ids", "offsets", "postings", "frequencies")
+# Words, numbers and identifiers such as ERR_DNS_404, example.com or v2-beta
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+SPLIT_PATTERN = re.compile(r"[._\-]")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from has have how i if in is it its my "
+    "no not of on or our so that the their then there these this to was we what when "
+    "which will with you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    #Lowercased terms; identifiers are kept whole and also split so either form matches
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        if SPLIT_PATTERN.search(token):
+            terms.extend(part for part in SPLIT_PATTERN.split(token) if part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    #Inverted index over chunk text with BM25 scoring, addressed by the same chunk ids as the vector index.
+    #Postings are kept as flat numpy arrays (CSR by term) and rebuilt lazily after changes.
+    #A loaded index searches the (memory-mapped) saved arrays; the per-chunk forward index
+    #is only rebuilt from them when the index is changed.
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> term id
+        self._terms = {}
+        # chunk id -> (term ids, term frequencies); the source the postings are compiled from.
+        # None while the postings come straight from a saved index.
+        self._docs = {}
+        self._dirty = True
+
+        self.row_ids = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+        self.frequencies = np.empty(0, dtype=np.uint16)
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self._idf = np.empty(0, dtype=np.float32)
+        self._norm = np.empty(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.row_ids) if self._docs is None else len(self._docs)
+
+    @staticmethod
+    def document_text(meta: dict) -> str:
+        #Text indexed for a chunk: its document name and content
+        filename = (meta.get('metadata') or {}).get('filename', '')
+        return f"{filename}\n{meta.get('text', '')}"
+
+    def _term_id(self, term: str) -> int:
+        term_id = self._terms.get(term)
+        if term_id is None:
+            term_id = self._terms[term] = len(self._terms)
+        return term_id
+
+    def add(self, ids, texts):
+        self._ensure_forward_index()
+        for chunk_id, text in zip(ids, texts):
+            counts = Counter(self._term_id(term) for term in tokenize(text))
+            term_ids = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            tfs = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+            self._docs[int(chunk_id)] = (term_ids, np.minimum(tfs, np.iinfo(np.uint16).max).astype(np.uint16))
+        self._dirty = True
+
+    def remove(self, ids):
+        self._ensure_forward_index()
+        for chunk_id in ids:
+            self._docs.pop(int(chunk_id), None)
+        self._dirty = True
+
+    def clear(self):
+        self._terms = {}
+        self._docs = {}
+        self._dirty = True
+
+    def _ensure_forward_index(self):
+        #Invert the saved postings back into per-chunk term lists so they can be edited
+        if self._docs is not None:
+            return
+        term_of_posting = np.repeat(np.arange(len(self._terms), dtype=np.int32), np.diff(self.offsets))
+        order = np.argsort(self.postings, kind="stable")
+        splits = np.cumsum(np.bincount(self.postings, minlength=len(self.row_ids)))[:-1]
+        self._docs = {
+            int(chunk_id): (term_ids, freqs)
+            for chunk_id, term_ids, freqs in zip(self.row_ids.tolist(),
+                                                 np.split(term_of_posting[order], splits),
+                                                 np.split(np.asarray(self.frequencies)[order], splits))
+        }
+
+    def _compile(self):
+        #Rebuild the postings arrays and per-document BM25 normalization from the forward index
+        n = len(self._docs)
+        vocab = len(self._terms)
+        self.row_ids = np.fromiter(self._docs.keys(), dtype=np.int64, count=n)
+        docs = list(self._docs.values())
+
+        if docs:
+            terms = np.concatenate([term_ids for term_ids, _ in docs])
+            tfs = np.concatenate([freqs for _, freqs in docs])
+            rows = np.repeat(np.arange(n, dtype=np.int32), [len(term_ids) for term_ids, _ in docs])
+            self.doc_lengths = np.array([freqs.sum() for _, freqs in docs], dtype=np.float32)
+        else:
+            terms = np.empty(0, dtype=np.int32)
+            tfs = np.empty(0, dtype=np.uint16)
+            rows = np.empty(0, dtype=np.int32)
+            self.doc_lengths = np.empty(0, dtype=np.float32)
+
+        # Stable sort keeps each term's postings in row order
+        order = np.argsort(terms, kind="stable")
+        self.postings = rows[order]
+        self.frequencies = tfs[order]
+        df = np.bincount(terms, minlength=vocab)
+        self.offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        self._weights(df)
+        self._dirty = False
+
+    def _weights(self, df: np.ndarray):
+        #idf per term and the BM25 length normalization per chunk
+        n = len(self.row_ids)
+        self._idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_length = float(self.doc_lengths.mean()) if n else 1.0
+        self._norm = (self.k1 * (1.0 - self.b + self.b * self.doc_lengths / max(avg_length, 1.0))).astype(np.float32)
+
+    def search(self, query: str, top_k: int = 5) -> list[tuple[int, float]]:
+        #(chunk id, BM25 score) of the best matching chunks, best first
+        if self._dirty:
+            self._compile()
+        term_ids = sorted({self._terms[t] for t in tokenize(query) if t in self._terms})
+        if not term_ids or not len(self.row_ids) or top_k <= 0:
+            return []
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        starts, ends = self.offsets[term_ids], self.offsets[term_ids + 1]
+        positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        if not len(positions):
+            return []
+
+        rows = self.postings[positions]
+        tf = self.frequencies[positions].astype(np.float32)
+        idf = np.repeat(self._idf[term_ids], ends - starts)
+        contributions = idf * tf * (self.k1 + 1.0) / (tf + self._norm[rows])
+        scores = np.bincount(rows, weights=contributions, minlength=len(self.row_ids))
+
+        hits = np.flatnonzero(scores > 0)
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(self.row_ids[row]), float(scores[row])) for row in hits]
+
+    def arrays(self) -> dict:
+        #Persisted state; compiling replaces the arrays rather than mutating them, so this is a safe snapshot
+        if self._dirty:
+            self._compile()
+        arrays = {name: getattr(self, name) for name in LEXICAL_ARRAYS}
+        arrays["terms"] = sorted(self._terms, key=self._terms.get)
+        return arrays
+
+    @staticmethod
+    def write(path: str, arrays: dict):
+        #One .npy file per array so a loaded index can map them instead of reading them
+        os.makedirs(path, exist_ok=True)
+        for name in LEXICAL_ARRAYS:
+            save_array(os.path.join(path, f"{name}.npy"), arrays[name])
+        vocabulary = {"format_version": LEXICAL_FORMAT_VERSION, "terms": arrays["terms"]}
+        write_atomic(os.path.join(path, "terms.json"),
+                     lambda f: f.write(json.dumps(vocabulary, ensure_ascii=False).encode("utf-8")))
+
+    def save(self, path: str):
+        self.write(path, self.arrays())
+
+    def load(self, path: str, mmap: bool = True):
+        with open(os.path.join(path, "terms.json"), "r", encoding="utf-8") as f:
+            vocabulary = json.load(f)
+        if vocabulary.get("format_version") != LEXICAL_FORMAT_VERSION:
+            raise ValueError(f"Lexical index format {vocabulary.get('format_version')} is outdated")
+        arrays = {name: load_array(os.path.join(path, f"{name}.npy"), mmap) for name in LEXICAL_ARRAYS}
+        if len(arrays["offsets"]) != len(vocabulary["terms"]) + 1:
+            raise ValueError(f"Lexical index in {path} is inconsistent")
+
+        self._terms = {term: i for i, term in enumerate(vocabulary["terms"])}
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self._docs = None
+        self.doc_lengths = np.bincount(self.postings, weights=self.frequencies,
+                                       minlength=len(self.row_ids)).astype(np.float32)
+        self._weights(np.diff(self.offsets))
+        self._dirty = False
+        logger.info(f"Loaded BM25 index: {len(self.row_ids)} chunks, {len(self._terms)} terms")
+
+    def stats(self) -> dict:
+        if self._dirty:
+            self._compile()
+        return {
+            "chunks": len(self),
+            "terms": len(self._terms),
+            "postings": int(len(self.postings)),
+        }
@@ -0,0 +1,362 @@
+import json
+import os
+from collections.abc import Mapping
+import numpy as np
+
+# Bump when the column layout changes
+CHUNK_FORMAT_VERSION = 2
+CHUNK_ARRAYS = ("ids", "rows", "text_offsets", "layout_ids", "field_ids", "numbers")
+TEXT_FILE = "text.bin"
+SCHEMA_FILE = "schema.json"
+# Group of the fields of a chunk's nested metadata dict; other fields are top-level keys
+METADATA = "metadata"
+
+
+def write_atomic(path: str, write):
+    #Write through a temporary file and rename it into place, so processes that have the old
+    #file memory-mapped keep reading the old contents instead of a truncated file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def save_array(path: str, array: np.ndarray):
+    write_atomic(path, lambda f: np.save(f, np.ascontiguousarray(array)))
+
+
+def load_array(path: str, mmap: bool = True) -> np.ndarray:
+    return np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool) and -2**63 <= value < 2**63
+
+
+def _intern_key(value):
+    #Dict key for a JSON value: typed so 1 and True stay apart, serialized when not hashable
+    try:
+        hash(value)
+        return type(value), value
+    except TypeError:
+        return type(value), json.dumps(value, sort_keys=True)
+
+
+class ChunkStore(Mapping):
+    #Columnar chunk id -> chunk dict store. The text of all chunks is one UTF-8 buffer addressed by
+    #offsets; top-level integer fields (context_tokens, parent, start_byte, ...) are int64 columns, since
+    #they mostly differ per chunk; every other field (filename and the rest of the metadata, ...) is
+    #interned, so a chunk costs its id, an offset and one int per field instead of a dict per chunk.
+    #Interned values no row uses any more are dropped when rows are removed or replaced.
+    #Chunks are decoded into dicts only when looked up. Changes are buffered and compiled on the next read;
+    #compiling replaces the arrays instead of writing to them, so a memory-mapped store stays untouched.
+
+    def __init__(self):
+        # (group, key) per field column; group is METADATA or None
+        self.fields = []
+        # Interned values per field, and the tuples of top-level keys chunks have (their layouts)
+        self.field_values = []
+        self.layouts = []
+        # Top-level keys with an int64 column; the layout of a row tells whether it has the key
+        self.number_fields = []
+        self._value_ids = None
+        self._layout_ids = None
+
+        # Rows in insertion order: text offsets, layout id and one value id per field (-1 when absent)
+        self.text = np.empty(0, dtype=np.uint8)
+        self.text_offsets = np.zeros(1, dtype=np.int64)
+        self.layout_ids = np.empty(0, dtype=np.int32)
+        self.field_ids = np.empty((0, 0), dtype=np.int32)
+        self.numbers = np.empty((0, 0), dtype=np.int64)
+        # Sorted chunk ids and the row of each
+        self.ids = np.empty(0, dtype=np.int64)
+        self.rows = np.empty(0, dtype=np.int64)
+        self._row_ids = np.empty(0, dtype=np.int64)
+
+        self._pending = []
+
+    @property
+    def row_ids(self) -> np.ndarray:
+        #Chunk id of each row, derived from the sorted ids when loaded
+        if self._row_ids is None:
+            self._row_ids = np.empty(len(self.ids), dtype=np.int64)
+            self._row_ids[self.rows] = self.ids
+        return self._row_ids
+
+    def nbytes(self) -> int:
+        self._compile()
+        arrays = (self.text, self.text_offsets, self.layout_ids, self.field_ids, self.numbers, self.ids, self.rows)
+        return sum(int(array.nbytes) for array in arrays)
+
+    def _ensure_interning(self):
+        if self._value_ids is None:
+            self._value_ids = [{_intern_key(value): i for i, value in enumerate(values)}
+                               for values in self.field_values]
+            self._layout_ids = {layout: i for i, layout in enumerate(self.layouts)}
+
+    def _intern(self, field: tuple, value) -> int:
+        try:
+            column = self.fields.index(field)
+        except ValueError:
+            column = len(self.fields)
+            self.fields.append(field)
+            self.field_values.append([])
+            self._value_ids.append({})
+        key = _intern_key(value)
+        value_id = self._value_ids[column].get(key)
+        if value_id is None:
+            value_id = self._value_ids[column][key] = len(self.field_values[column])
+            self.field_values[column].append(value)
+        return value_id
+
+    def add(self, ids, chunks):
+        #Add or replace chunks by id
+        self._ensure_interning()
+        ids = np.asarray(list(ids), dtype=np.int64)
+        texts = []
+        layout_ids = np.empty(len(ids), dtype=np.int32)
+        columns = []
+        numbers = []
+        for i, chunk in enumerate(chunks):
+            layout = tuple(chunk)
+            layout_id = self._layout_ids.get(layout)
+            if layout_id is None:
+                layout_id = self._layout_ids[layout] = len(self.layouts)
+                self.layouts.append(layout)
+            layout_ids[i] = layout_id
+            texts.append(chunk.get("text", "").encode("utf-8"))
+
+            row = {}
+            row_numbers = {}
+            for key, value in chunk.items():
+                if key == "text":
+                    continue
+                if _is_number(value):
+                    if key not in self.number_fields:
+                        self.number_fields.append(key)
+                    row_numbers[key] = int(value)
+                elif key == METADATA and isinstance(value, dict):
+                    for meta_key, meta_value in value.items():
+                        field = (METADATA, meta_key)
+                        row[field] = self._intern(field, meta_value)
+                else:
+                    row[(None, key)] = self._intern((None, key), value)
+            columns.append(row)
+            numbers.append(row_numbers)
+        if len(texts) != len(ids):
+            raise ValueError("Ids and chunks length mismatch")
+        if len(ids):
+            self._pending.append((ids, texts, layout_ids, columns, numbers))
+
+    def remove(self, ids):
+        #Drop chunks by id; unknown ids are ignored
+        self._compile()
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if not len(ids) or not len(self.ids):
+            return
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = positions[self.ids[positions] == ids]
+        if len(found):
+            keep = np.ones(len(self.layout_ids), dtype=bool)
+            keep[self.rows[found]] = False
+            self._keep_rows(keep)
+
+    def clear(self):
+        self.__init__()
+
+    def ids_where(self, key: str, values) -> np.ndarray:
+        #Ids of the chunks whose top-level field `key` holds one of the values
+        self._compile()
+        values = list(values)
+        matches = np.zeros(len(self.layout_ids), dtype=bool)
+        interned = None
+        if (None, key) in self.fields:
+            column = self.fields.index((None, key))
+            interned = self.field_ids[:, column]
+            wanted = {_intern_key(value) for value in values}
+            value_ids = [i for i, value in enumerate(self.field_values[column]) if _intern_key(value) in wanted]
+            matches |= np.isin(interned, value_ids)
+        if key in self.number_fields:
+            has_key = np.isin(self.layout_ids, [i for i, layout in enumerate(self.layouts) if key in layout])
+            if interned is not None:
+                has_key &= interned < 0
+            wanted = [int(value) for value in values if _is_number(value)]
+            matches |= has_key & np.isin(self.numbers[:, self.number_fields.index(key)], wanted)
+        return self.row_ids[matches]
+
+    def _compile(self):
+        #Append the buffered chunks to the columns; later writes of an id replace earlier ones
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        n_fields = len(self.fields)
+        column = {field: i for i, field in enumerate(self.fields)}
+        n_numbers = len(self.number_fields)
+        number_column = {key: i for i, key in enumerate(self.number_fields)}
+
+        texts = [text for _, batch, _, _, _ in pending for text in batch]
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+        new_offsets = self.text_offsets[-1] + np.cumsum(lengths)
+        field_ids = np.full((len(texts), n_fields), -1, dtype=np.int32)
+        for i, row in enumerate(row for _, _, _, columns, _ in pending for row in columns):
+            for field, value_id in row.items():
+                field_ids[i, column[field]] = value_id
+        numbers = np.zeros((len(texts), n_numbers), dtype=np.int64)
+        for i, row in enumerate(row for _, _, _, _, rows in pending for row in rows):
+            for key, value in row.items():
+                numbers[i, number_column[key]] = value
+        old_fields = self.field_ids
+        if old_fields.shape[1] < n_fields:
+            old_fields = np.hstack([old_fields, np.full((len(old_fields), n_fields - old_fields.shape[1]), -1,
+                                                        dtype=np.int32)])
+        old_numbers = self.numbers
+        if old_numbers.shape[1] < n_numbers:
+            old_numbers = np.hstack([old_numbers, np.zeros((len(old_numbers), n_numbers - old_numbers.shape[1]),
+                                                           dtype=np.int64)])
+
+        self.text = np.concatenate([self.text, np.frombuffer(b"".join(texts), dtype=np.uint8)])
+        self.text_offsets = np.concatenate([self.text_offsets, new_offsets])
+        self.layout_ids = np.concatenate([self.layout_ids] + [layouts for _, _, layouts, _, _ in pending])
+        self.field_ids = np.concatenate([old_fields, field_ids])
+        self.numbers = np.concatenate([old_numbers, numbers])
+        row_ids = np.concatenate([self.row_ids] + [ids for ids, _, _, _, _ in pending])
+
+        # Keep the last row of every id
+        last = len(row_ids) - 1 - np.unique(row_ids[::-1], return_index=True)[1]
+        if len(last) < len(row_ids):
+            keep = np.zeros(len(row_ids), dtype=bool)
+            keep[last] = True
+            self._index(row_ids)
+            self._keep_rows(keep)
+        else:
+            self._index(row_ids)
+
+    def _index(self, row_ids: np.ndarray):
+        self._row_ids = row_ids
+        self.rows = np.argsort(row_ids, kind="stable")
+        self.ids = row_ids[self.rows]
+
+    def _keep_rows(self, keep: np.ndarray):
+        #Compact the columns to the kept rows; text is copied in runs of consecutive kept rows
+        starts, ends = self.text_offsets[:-1][keep], self.text_offsets[1:][keep]
+        boundaries = np.flatnonzero(np.diff(np.concatenate([[False], keep, [False]]).astype(np.int8)))
+        runs = boundaries.reshape(-1, 2)
+        self.text = np.concatenate([self.text[self.text_offsets[a]:self.text_offsets[b]] for a, b in runs]) \
+            if len(runs) else np.empty(0, dtype=np.uint8)
+        self.text_offsets = np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64)
+        self.layout_ids = self.layout_ids[keep]
+        self.field_ids = self.field_ids[keep]
+        self.numbers = self.numbers[keep]
+        self._index(self.row_ids[keep])
+        self._drop_unused_values()
+
+    def _drop_unused_values(self):
+        #Forget interned values no row refers to any more and renumber the rest; field_ids is a fresh
+        #copy after _keep_rows, so it can be rewritten in place
+        for column, values in enumerate(self.field_values):
+            value_ids = self.field_ids[:, column]
+            used = np.unique(value_ids[value_ids >= 0])
+            if len(used) == len(values):
+                continue
+            renumber = np.full(len(values), -1, dtype=np.int32)
+            renumber[used] = np.arange(len(used), dtype=np.int32)
+            self.field_ids[:, column] = np.where(value_ids >= 0, renumber[value_ids], -1)
+            self.field_values[column] = [values[i] for i in used.tolist()]
+            self._value_ids = None
+
+    def _row(self, chunk_id) -> int:
+        self._compile()
+        position = int(np.searchsorted(self.ids, chunk_id))
+        if position < len(self.ids) and self.ids[position] == chunk_id:
+            return int(self.rows[position])
+        return -1
+
+    def _decode(self, row: int) -> dict:
+        value_ids = self.field_ids[row]
+        fields = {field: self.field_values[i][value_ids[i]]
+                  for i, field in enumerate(self.fields) if value_ids[i] >= 0}
+        chunk = {}
+        for key in self.layouts[self.layout_ids[row]]:
+            if key == "text":
+                chunk[key] = self.text[self.text_offsets[row]:self.text_offsets[row + 1]].tobytes().decode("utf-8")
+            elif (None, key) in fields:
+                chunk[key] = fields[(None, key)]
+            elif key in self.number_fields:
+                chunk[key] = int(self.numbers[row, self.number_fields.index(key)])
+            elif key == METADATA:
+                chunk[key] = {meta_key: value for (group, meta_key), value in fields.items() if group == METADATA}
+        return chunk
+
+    def __getitem__(self, chunk_id) -> dict:
+        row = self._row(chunk_id)
+        if row < 0:
+            raise KeyError(chunk_id)
+        return self._decode(row)
+
+    def __contains__(self, chunk_id) -> bool:
+        return self._row(chunk_id) >= 0
+
+    def __len__(self) -> int:
+        self._compile()
+        return len(self.ids)
+
+    def __iter__(self):
+        self._compile()
+        return iter(self.ids.tolist())
+
+    def arrays(self) -> dict:
+        #Persisted state; the arrays are replaced rather than mutated later, so this is a safe snapshot
+        self._compile()
+        arrays = {name: getattr(self, name) for name in CHUNK_ARRAYS}
+        arrays["text"] = self.text
+        arrays["schema"] = {
+            "format_version": CHUNK_FORMAT_VERSION,
+            "fields": [list(field) for field in self.fields],
+            "values": [list(values) for values in self.field_values],
+            "layouts": [list(layout) for layout in self.layouts],
+            "number_fields": list(self.number_fields),
+        }
+        return arrays
+
+    @staticmethod
+    def write(path: str, arrays: dict):
+        #One file per column so a loaded store can map them instead of reading them
+        os.makedirs(path, exist_ok=True)
+        for name in CHUNK_ARRAYS:
+            save_array(os.path.join(path, f"{name}.npy"), arrays[name])
+        write_atomic(os.path.join(path, TEXT_FILE), lambda f: f.write(arrays["text"].tobytes()))
+        write_atomic(os.path.join(path, SCHEMA_FILE),
+                     lambda f: f.write(json.dumps(arrays["schema"], ensure_ascii=False).encode("utf-8")))
+
+    def save(self, path: str):
+        self.write(path, self.arrays())
+
+    @classmethod
+    def open(cls, path: str, mmap: bool = True) -> "ChunkStore":
+        with open(os.path.join(path, SCHEMA_FILE), "r", encoding="utf-8") as f:
+            schema = json.load(f)
+        if schema.get("format_version") != CHUNK_FORMAT_VERSION:
+            raise ValueError(f"Chunk store format {schema.get('format_version')} is outdated")
+        store = cls()
+        for name in CHUNK_ARRAYS:
+            setattr(store, name, load_array(os.path.join(path, f"{name}.npy"), mmap))
+        text_path = os.path.join(path, TEXT_FILE)
+        if os.path.getsize(text_path) == 0:
+            # Empty files cannot be mapped
+            store.text = np.empty(0, dtype=np.uint8)
+        elif mmap:
+            store.text = np.memmap(text_path, dtype=np.uint8, mode="r")
+        else:
+            store.text = np.fromfile(text_path, dtype=np.uint8)
+        store.fields = [(group, key) for group, key in schema["fields"]]
+        store.field_values = schema["values"]
+        store.layouts = [tuple(layout) for layout in schema["layouts"]]
+        store.number_fields = schema["number_fields"]
+        store._row_ids = None
+
+        n = len(store.ids)
+        if (len(store.rows) != n or len(store.layout_ids) != n or len(store.text_offsets) != n + 1
+                or store.field_ids.shape != (n, len(store.fields))
+                or store.numbers.shape != (n, len(store.number_fields)) or store.text_offsets[-1] != len(store.text)):
+            raise ValueError(f"Chunk store in {path} is inconsistent")
+        return store
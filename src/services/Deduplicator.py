@@ -0,0 +1,110 @@
+import os
+import re
+import zlib
+import numpy as np
+from ChunkStore import load_array, save_array
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+WORD_PATTERN = re.compile(r"\w+")
+# Prime just above 2**32: (a * x + b) mod p with 32-bit a, b and x never overflows uint64
+HASH_PRIME = np.uint64(4294967311)
+
+
+def shingles(text: str, size: int = 5) -> set[str]:
+    #Overlapping word n-grams of the lowercased text; short texts are one shingle
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class NearDuplicateIndex:
+    #MinHash signatures of indexed chunks with LSH banding, to find chunks whose word shingles
+    #overlap by at least `threshold` (estimated Jaccard similarity) without comparing every pair.
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, shingle_size: int = 5):
+        if num_perm % bands:
+            raise ValueError(f"bands={bands} must divide num_perm={num_perm}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(1)
+        self._a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        # chunk id -> signature, and per band: band bytes -> chunk ids
+        self._signatures = {}
+        self._buckets = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def __contains__(self, chunk_id) -> bool:
+        return chunk_id in self._signatures
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles(text, self.shingle_size)),
+                             dtype=np.uint64)
+        permuted = (hashes[:, np.newaxis] * self._a + self._b) % HASH_PRIME
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _bands(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def add(self, chunk_id: int, signature: np.ndarray):
+        self._signatures[chunk_id] = signature
+        for band, key in self._bands(signature):
+            self._buckets[band].setdefault(key, []).append(chunk_id)
+
+    def remove(self, chunk_id: int):
+        signature = self._signatures.pop(chunk_id, None)
+        if signature is None:
+            return
+        for band, key in self._bands(signature):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.remove(chunk_id)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def clear(self):
+        self._signatures = {}
+        self._buckets = [{} for _ in range(self.bands)]
+
+    def find(self, signature: np.ndarray):
+        #Indexed chunk most similar to the signature if it clears the threshold, else None
+        candidates = set()
+        for band, key in self._bands(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        best, best_similarity = None, 0.0
+        for chunk_id in sorted(candidates):
+            similarity = float(np.mean(self._signatures[chunk_id] == signature))
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = chunk_id, similarity
+        return best
+
+    def settings(self) -> dict:
+        #Parameters that decide which chunks count as duplicates; part of the index version
+        return {"threshold": self.threshold, "num_perm": self.num_perm,
+                "bands": self.bands, "shingle_size": self.shingle_size}
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        ids = np.fromiter(self._signatures.keys(), dtype=np.int64, count=len(self._signatures))
+        signatures = np.array(list(self._signatures.values()), dtype=np.uint32).reshape(len(ids), self.num_perm)
+        save_array(os.path.join(path, "ids.npy"), ids)
+        save_array(os.path.join(path, "signatures.npy"), signatures)
+
+    def load(self, path: str):
+        ids = load_array(os.path.join(path, "ids.npy"), mmap=False)
+        signatures = load_array(os.path.join(path, "signatures.npy"), mmap=False)
+        if signatures.shape != (len(ids), self.num_perm):
+            raise ValueError(f"Duplicate signatures in {path} do not match num_perm={self.num_perm}")
+        self.clear()
+        for chunk_id, signature in zip(ids.tolist(), signatures):
+            self.add(chunk_id, signature)
+        logger.info(f"Loaded {len(ids)} near-duplicate signatures")
@@ -0,0 +1,119 @@
+import asyncio
+from collections import Counter
+import numpy as np
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class EmbeddingQueueFull(Exception):
+    """Raised when too many queries are already waiting to be embedded."""
+
+
+class EmbeddingBatcher:
+    #Async front-end for EmbeddingService that coalesces concurrent embed_query calls.
+    #Requests arriving within max_wait_ms of each other (up to max_batch_size) share one encode call.
+
+    def __init__(
+        self,
+        embedding_service,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        max_queue_size: int = 1024,
+    ):
+        self.embedding_service = embedding_service
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self._queue = None
+        self._worker = None
+
+        self.batches = 0
+        self.batched_queries = 0
+        self.cache_hits = 0
+        self.batch_sizes = Counter()
+
+    def _ensure_worker(self):
+        # Created lazily so the queue and task belong to the loop actually serving requests
+        if self._worker is None or self._worker.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def embed_query(self, query: str) -> np.ndarray:
+        #Embed a single query as a (1, dim) matrix, batched with concurrent callers.
+        if not query or not query.strip():
+            raise ValueError("No texts provided for embedding")
+
+        # Repeated tickets are answered from the query cache without queueing
+        cached = self.embedding_service.cached_query(query)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((query, future))
+        except asyncio.QueueFull:
+            raise EmbeddingQueueFull(f"{self.max_queue_size} queries already waiting for embedding")
+        return await future
+
+    def _drain(self, batch: list):
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            self._drain(batch)
+            if len(batch) < self.max_batch_size and self.max_wait > 0:
+                # Give concurrent requests a short window to join this batch
+                await asyncio.sleep(self.max_wait)
+                self._drain(batch)
+
+            live = [(query, future) for query, future in batch if not future.done()]
+            if not live:
+                continue
+
+            try:
+                # Encoding runs off the event loop; requests arriving meanwhile form the next batch
+                vectors = await asyncio.to_thread(
+                    self.embedding_service.embed_queries, [query for query, _ in live]
+                )
+            except Exception as e:
+                logger.error(f"Batched embedding of {len(live)} queries failed: {e}")
+                for _, future in live:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), vector in zip(live, vectors):
+                if not future.done():
+                    future.set_result(vector[np.newaxis, :])
+            self._record(len(live))
+
+    def _record(self, size: int):
+        self.batches += 1
+        self.batched_queries += size
+        self.batch_sizes[size] += 1
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "batched_queries": self.batched_queries,
+            "cache_hits": self.cache_hits,
+            "mean_batch_size": self.batched_queries / self.batches if self.batches else 0.0,
+            "max_batch_size": max(self.batch_sizes) if self.batch_sizes else 0,
+            "batch_size_counts": dict(sorted(self.batch_sizes.items())),
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+        }
@@ -1,49 +1,232 @@
-
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
-from logger_config import get_logger
-
-logger = get_logger(__name__)
-
-class EmbeddingService:
-    def __init__(self, model_name: str="all-MiniLM-L6-v2", embedding_dim: int=384):
-        try:
-            self.model = SentenceTransformer(model_name)
-            self.embedding_dim = embedding_dim
-            self.index = faiss.IndexFlatL2(self.embedding_dim)
-            self.metadata = []
-            logger.info(f"Loaded SentenceTransformer model: {model_name}")
-        except Exception as e:
-            logger.error(f"Failed to initialize embedding model: {e}")
-            raise e
-
-    def embed_documents(self, chunks: list[dict]) -> tuple[np.ndarray, list[dict]]:
-        #Embed a list of text chunks and return their embeddings along with metadata.
-        texts = [chunk['text'] for chunk in chunks]
-        try:
-            embeddings = self.model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-            if embeddings.shape[1] != self.embedding_dim:
-                logging.warning(f"Embedding dimension mismatch: {embeddings.shape[1]} != {self.embedding_dim}")
-
-
-
-            # # Store metadata aligned with FAISS vectors
-            self.metadata.extend([chunk['metadata'] for chunk in chunks])
-
-            return embeddings, chunks
-        except Exception as e:
-            logging.error(f"Failed to embed documents: {e}")
-            raise e
-
-
-    def embed_query(self, query:str) -> np.ndarray:
-      #Embed a single query string and return its embedding.
-      if not query:
-            raise ValueError("No texts provided for embedding")
-
-      try:
-          return self.model.encode(query, convert_to_numpy=True, show_progress_bar=True)
-      except Exception as e:
-          logging.error(f"Embedding failed: {e}")
-          raise
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+BACKENDS = ("torch", "onnx")
+QUANTIZATION_TARGETS = ("arm64", "avx2", "avx512", "avx512_vnni")
+
+
+def backend_id(backend: str = "torch", quantize: bool = False, quantization_target: str = "avx2") -> str:
+    #Short name of an inference backend; vectors from different backends are not interchangeable
+    if backend == "torch":
+        return "torch"
+    return f"onnx-qint8-{quantization_target}" if quantize else "onnx"
+
+
+def load_model(model_name: str, backend: str = "torch", quantize: bool = False,
+               quantization_target: str = "avx2", cache_dir: Optional[str] = None):
+    #Load the SentenceTransformer for a backend; ONNX exports are created once and kept in cache_dir
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == "torch":
+        if quantize:
+            raise ValueError("int8 quantization needs the onnx backend")
+        return SentenceTransformer(model_name)
+    if quantize and quantization_target not in QUANTIZATION_TARGETS:
+        raise ValueError(f"Unknown quantization target {quantization_target!r}, "
+                         f"expected one of {', '.join(QUANTIZATION_TARGETS)}")
+
+    try:
+        import onnxruntime  # noqa: F401
+        import optimum.onnxruntime  # noqa: F401
+    except ImportError as e:
+        raise ImportError("The onnx embedding backend needs `pip install optimum[onnxruntime]`") from e
+
+    if cache_dir is None:
+        raise ValueError("The onnx embedding backend needs a cache_dir for the exported model")
+    export_dir = Path(cache_dir) / f"{model_name.replace('/', '__')}-onnx"
+    file_name = f"onnx/model_qint8_{quantization_target}.onnx" if quantize else "onnx/model.onnx"
+
+    if not (export_dir / "onnx" / "model.onnx").exists():
+        logger.info(f"Exporting {model_name} to ONNX in {export_dir}")
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(str(export_dir))
+    if not (export_dir / file_name).exists():
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        logger.info(f"Quantizing {model_name} to int8 for {quantization_target}")
+        fp32 = SentenceTransformer(str(export_dir), backend="onnx")
+        export_dynamic_quantized_onnx_model(fp32, quantization_target, str(export_dir))
+
+    return SentenceTransformer(str(export_dir), backend="onnx", model_kwargs={"file_name": file_name})
+
+
+class QueryEmbeddingCache:
+    #Bounded LRU of query text -> embedding, optionally persisted as a .npz file
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str, count_miss: bool = True) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: str, vector: np.ndarray) -> np.ndarray:
+        # Cached vectors are shared between callers, so make them immutable
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        if self.max_entries <= 0:
+            return vector
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def save(self, path: str, model_name: str):
+        #persist entries (oldest first, so LRU order survives a reload)
+        with self._lock:
+            keys = list(self._entries)
+            vectors = np.stack(list(self._entries.values())) if keys else np.empty((0, 0), np.float32)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Per-process temporary name: forked workers may save at the same time
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys, dtype=str), vectors=vectors,
+                 model_name=np.array(model_name))
+        os.replace(tmp_path, path)
+        logger.info(f"Saved {len(keys)} cached query embeddings to {path}")
+
+    def load(self, path: str, model_name: str):
+        #restore entries saved for the same model; anything else is ignored
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data["model_name"]) != model_name:
+                    logger.info(f"Ignoring query cache for model {data['model_name']}")
+                    return
+                for key, vector in zip(data["keys"].tolist(), data["vectors"]):
+                    self.put(key, vector)
+            logger.info(f"Loaded {len(self)} cached query embeddings from {path}")
+        except Exception as e:
+            logger.warning(f"Failed to load query cache {path}: {e}")
+
+
+class EmbeddingService:
+    def __init__(self, model_name: str="all-MiniLM-L6-v2", embedding_dim: int=384,
+                 query_cache_size: int=4096, query_cache_path: Optional[str]=None,
+                 backend: str="torch", quantize: bool=False, quantization_target: str="avx2",
+                 model_cache_dir: Optional[str]=None):
+        try:
+            self.model = load_model(model_name, backend=backend, quantize=quantize,
+                                    quantization_target=quantization_target, cache_dir=model_cache_dir)
+            self.model_name = model_name
+            self.backend = backend_id(backend, quantize, quantization_target)
+            self.embedding_dim = embedding_dim
+            self.query_cache = QueryEmbeddingCache(query_cache_size)
+            self.query_cache_path = query_cache_path
+            if query_cache_path:
+                self.query_cache.load(query_cache_path, self.cache_identity)
+            # Uncased models embed "Password" and "password" identically, so the cache may fold case
+            tokenizer = getattr(self.model, "tokenizer", None)
+            self._fold_case = bool(getattr(tokenizer, "do_lower_case", False))
+            logger.info(f"Loaded SentenceTransformer model: {model_name} ({self.backend})")
+        except Exception as e:
+            logger.error(f"Failed to initialize embedding model: {e}")
+            raise e
+
+    @property
+    def cache_identity(self) -> str:
+        #what cached query vectors were computed with; the plain model name for the default backend
+        return self.model_name if self.backend == "torch" else f"{self.model_name}:{self.backend}"
+
+    def embed_documents(self, chunks: list[dict], show_progress: bool = True) -> tuple[np.ndarray, list[dict]]:
+        #Embed a list of text chunks and return their embeddings along with metadata.
+        texts = [chunk['text'] for chunk in chunks]
+        try:
+            embeddings = self.model.encode(texts, show_progress_bar=show_progress, convert_to_numpy=True)
+            if embeddings.shape[1] != self.embedding_dim:
+                logger.warning(f"Embedding dimension mismatch: {embeddings.shape[1]} != {self.embedding_dim}")
+            # The chunks themselves are kept by the VectorStore they are added to
+            return embeddings, chunks
+        except Exception as e:
+            logger.error(f"Failed to embed documents: {e}")
+            raise e
+
+
+    def normalize_query(self, query: str) -> str:
+      #Cache key: whitespace collapsed, case folded when the model ignores case.
+      text = " ".join(query.split())
+      return text.lower() if self._fold_case else text
+
+
+    def embed_query(self, query:str) -> np.ndarray:
+      #Embed a single query string and return its embedding as a (1, dim) matrix.
+      if not query or not query.strip():
+            raise ValueError("No texts provided for embedding")
+
+      key = self.normalize_query(query)
+      vector = self.query_cache.get(key)
+      if vector is not None:
+          return vector[np.newaxis, :]
+
+      try:
+          vector = self.model.encode(key, convert_to_numpy=True, show_progress_bar=False)
+      except Exception as e:
+          logger.error(f"Embedding failed: {e}")
+          raise
+      return self.query_cache.put(key, vector)[np.newaxis, :]
+
+
+    def cached_query(self, query: str) -> Optional[np.ndarray]:
+      #Cached (1, dim) embedding of a query, or None; a miss is counted when it is embedded.
+      vector = self.query_cache.get(self.normalize_query(query), count_miss=False)
+      return None if vector is None else vector[np.newaxis, :]
+
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+      #Embed many queries with a single encode call for the cache misses; returns (n, dim).
+      if not queries or any(not q or not q.strip() for q in queries):
+            raise ValueError("No texts provided for embedding")
+
+      keys = [self.normalize_query(q) for q in queries]
+      vectors = [self.query_cache.get(key) for key in keys]
+      missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+
+      if missing:
+          try:
+              encoded = self.model.encode(missing, convert_to_numpy=True, show_progress_bar=False,
+                                          batch_size=len(missing))
+          except Exception as e:
+              logger.error(f"Embedding failed: {e}")
+              raise
+          fresh = {key: self.query_cache.put(key, vector) for key, vector in zip(missing, encoded)}
+          vectors = [fresh[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+      return np.stack(vectors)
+
+
+    def save_query_cache(self):
+      #Persist the query cache if a path was configured.
+      if self.query_cache_path:
+          self.query_cache.save(self.query_cache_path, self.cache_identity)
@@ -0,0 +1,597 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict
+from pathlib import Path
+import config
+from Deduplicator import NearDuplicateIndex
+from IngestPipeline import IngestPipeline, chunk_file
+from TextProcessor import ChildChunker, FileLoader
+from PromptBuilder import PromptBuilder
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# Bump whenever the on-disk snapshot layout changes so old snapshots are rebuilt
+SNAPSHOT_FORMAT_VERSION = 9
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "LOCK"
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    #Content hash of a file, read in blocks so large files are not loaded at once.
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_ids(source: str, chunks: list[dict], seen: dict = None) -> list[int]:
+    #Content-addressed chunk ids: an unchanged chunk keeps its id (and its vector) across edits.
+    #A file's chunks can be numbered batch by batch by passing the same `seen` for all of them.
+    ids = []
+    seen = {} if seen is None else seen
+    for chunk in chunks:
+        # Occurrences are counted by digest, so `seen` does not keep the texts of a whole file alive
+        text_key = hashlib.blake2b(chunk['text'].encode("utf-8"), digest_size=16).digest()
+        occurrence = seen.get(text_key, 0)
+        seen[text_key] = occurrence + 1
+        key = f"{source}\0{occurrence}\0{chunk['text']}".encode("utf-8")
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        # FAISS ids are signed 64-bit
+        ids.append(int.from_bytes(digest, "big") & ((1 << 63) - 1))
+    return ids
+
+
+class IndexManager:
+    #Loads the vector store from a versioned on-disk snapshot or rebuilds it from the data files
+
+    def __init__(
+        self,
+        embedding_service,
+        vector_store,
+        data_dir: str = config.FileLoaderConfig.path,
+        snapshot_dir: str = config.VectorStoreConfig.path,
+        chunker_config: config.ChunkerConfig = None,
+        keep_snapshots: int = config.VectorStoreConfig.keep_snapshots,
+        dedup_config: config.DedupConfig = None,
+        ingest_config: config.IngestConfig = None,
+    ):
+        self.embedding_service = embedding_service
+        self.vector_store = vector_store
+        self.loader = FileLoader(str(data_dir))
+        self.snapshot_dir = Path(snapshot_dir)
+        self.chunker_config = chunker_config or config.ChunkerConfig()
+        # Chunks are the unit of ids, dedup and prompts; with children only their children are embedded
+        self.child_chunker = None
+        if self.chunker_config.child_chunk_size:
+            self.child_chunker = ChildChunker(chunk_size=self.chunker_config.child_chunk_size,
+                                              chunk_overlap=self.chunker_config.child_chunk_overlap)
+        self.keep_snapshots = keep_snapshots
+        self.ingest_config = ingest_config or config.IngestConfig()
+        dedup_config = dedup_config or config.DedupConfig()
+        # Signatures of the indexed chunks; near-duplicates of them are recorded instead of embedded
+        self.dedup = None
+        if dedup_config.enabled:
+            self.dedup = NearDuplicateIndex(threshold=dedup_config.threshold, num_perm=dedup_config.num_perm,
+                                            bands=dedup_config.bands, shingle_size=dedup_config.shingle_size)
+        self.last_dedup = None
+        # Throughput and memory of the last full build
+        self.last_ingest = None
+        self.manifest = None
+        self._sync_lock = threading.RLock()
+        self._lock_file = None
+        self._watcher = None
+        self._follower = None
+        self._stop_watching = threading.Event()
+
+    @property
+    def index_version(self):
+        return self.manifest["index_version"] if self.manifest else None
+
+    def scan_files(self, previous: dict = None) -> dict:
+        #Hash every data file, keyed by its path relative to the data directory.
+        #Files whose size and mtime match the previous scan reuse its hash and chunk ids.
+        previous = previous or {}
+        files = {}
+        for path in self.loader.list_files():
+            stat = os.stat(path)
+            rel = os.path.relpath(path, self.loader.directory).replace(os.sep, "/")
+            old = previous.get(rel)
+            if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime:
+                files[rel] = dict(old)
+                continue
+            files[rel] = {
+                "sha256": hash_file(path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            if old and old["sha256"] == files[rel]["sha256"] and "chunk_ids" in old:
+                files[rel]["chunk_ids"] = old["chunk_ids"]
+        return files
+
+    def build_manifest(self, files: dict = None) -> dict:
+        #Describe everything that determines the index contents.
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "embedding": {
+                "model_name": self.embedding_service.model_name,
+                "backend": self.embedding_service.backend,
+                "embedding_dim": self.embedding_service.embedding_dim,
+            },
+            "chunker": asdict(self.chunker_config),
+            "index": self.vector_store.index_params(),
+            # Chunks carry prompt blocks whose token counts depend on the tokenizer
+            "context": {"tokenizer": PromptBuilder.tokenizer_name},
+            "dedup": self.dedup.settings() if self.dedup is not None else None,
+            "files": self.scan_files() if files is None else files,
+        }
+        manifest["index_version"] = self._version_of(manifest)
+        return manifest
+
+    @staticmethod
+    def _version_of(manifest: dict) -> str:
+        #Version id derived from the parts of the manifest that affect the index.
+        key = {
+            "format_version": manifest["format_version"],
+            "embedding": manifest["embedding"],
+            "chunker": manifest["chunker"],
+            "index": manifest["index"],
+            "context": manifest["context"],
+            "dedup": manifest["dedup"],
+            "files": {name: info["sha256"] for name, info in manifest["files"].items()},
+        }
+        blob = json.dumps(key, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(blob).hexdigest()[:16]
+
+    @staticmethod
+    def manifest_matches(saved: dict, current: dict) -> bool:
+        #File mtimes may differ after a checkout or copy; only contents and settings matter.
+        return saved is not None and saved.get("index_version") == current["index_version"]
+
+    def load_or_build(self) -> bool:
+        #Load the current snapshot when it matches the data files, otherwise rebuild and save.
+        manifest = self.build_manifest()
+        saved = self.read_manifest()
+
+        if self.manifest_matches(saved, manifest):
+            try:
+                self.vector_store.load(str(self._snapshot_path(saved["index_version"])))
+                self._load_dedup(saved["index_version"])
+                if self.vector_store.index.d != self.embedding_service.embedding_dim:
+                    raise ValueError(
+                        f"Snapshot dimension {self.vector_store.index.d} != "
+                        f"{self.embedding_service.embedding_dim}"
+                    )
+                self.manifest = saved
+                logger.info(f"Loaded index snapshot {saved['index_version']}")
+                return True
+            except Exception as e:
+                logger.warning(f"Snapshot could not be loaded, rebuilding: {e}")
+                self.vector_store.reset()
+        elif saved is not None:
+            logger.info("Index snapshot is stale, rebuilding")
+
+        self.rebuild(manifest)
+        return False
+
+    def _chunk_file(self, rel: str) -> tuple[list[int], list[dict]]:
+        #Chunk a single data file and assign chunk ids.
+        chunks = chunk_file(os.path.join(self.loader.directory, rel), self.chunker_config.chunk_size,
+                            self.chunker_config.chunk_overlap, self.ingest_config.stream_threshold_bytes)
+        return chunk_ids(rel, chunks), chunks
+
+    def _ingest_workers(self) -> int:
+        workers = self.ingest_config.workers
+        if workers is None:
+            workers = len(os.sched_getaffinity(0)) - 1
+        return max(0, workers)
+
+    def rebuild(self, manifest: dict = None):
+        #Re-chunk and re-embed the whole corpus into a new store, persist it as a snapshot and load it.
+        #Files stream through the ingest pipeline, so the build never holds every chunk or vector at
+        #once, and searches keep using the current store until the new one is complete.
+        manifest = manifest or self.build_manifest()
+        files = manifest["files"]
+        if not files:
+            raise RuntimeError("No documents found in data directory")
+        logger.info(f"Loaded {len(files)} documents")
+
+        duplicates = {}
+        dropped = {"bytes": 0}
+        if self.dedup is not None:
+            self.dedup.clear()
+        sources = {os.path.join(self.loader.directory, rel): rel for rel in files}
+
+        # Occurrence counts of the file whose batches are being indexed
+        current = {"path": None, "seen": None}
+
+        def index_file(path, chunks):
+            rel = sources[path]
+            if path != current["path"]:
+                current["path"], current["seen"] = path, {}
+                files[rel]["chunk_ids"] = []
+            ids = chunk_ids(rel, chunks, current["seen"])
+            files[rel]["chunk_ids"].extend(ids)
+            kept_ids, kept_chunks = self._deduplicate(ids, chunks, duplicates)
+            if len(kept_ids) < len(ids):
+                kept = set(kept_ids)
+                dropped["bytes"] += sum(len(chunk['text'].encode("utf-8"))
+                                        for chunk_id, chunk in zip(ids, chunks) if chunk_id not in kept)
+            return kept_ids, kept_chunks
+
+        store = self.vector_store.empty_copy()
+        pipeline = IngestPipeline(self.embedding_service, store,
+                                  chunk_size=self.chunker_config.chunk_size,
+                                  chunk_overlap=self.chunker_config.chunk_overlap,
+                                  batch_size=self.ingest_config.batch_size,
+                                  workers=self._ingest_workers(),
+                                  queue_size=self.ingest_config.queue_size,
+                                  progress_interval=self.ingest_config.progress_interval,
+                                  stream_threshold=self.ingest_config.stream_threshold_bytes,
+                                  children=self.child_chunker)
+        self.last_ingest = pipeline.run(list(sources), index_file)
+        if not self.last_ingest["added"]:
+            raise RuntimeError("Failed to chunk documents")
+
+        # Kept chunks list the documents their dropped duplicates came from
+        names = self._duplicate_sources(set(duplicates.values()), duplicates, files)
+        if names:
+            store.set_metadata(list(names), [self.with_sources(store.chunk(chunk_id), names[chunk_id])
+                                             for chunk_id in names])
+        self._report_dedup(self.last_ingest["chunks"], len(duplicates), dropped["bytes"],
+                           self.last_ingest["embed_seconds"])
+
+        manifest["duplicates"] = {str(dup): canonical for dup, canonical in duplicates.items()}
+        self.save_snapshot(manifest, store=store)
+        self.vector_store.load(str(self._snapshot_path(manifest["index_version"])))
+        logger.info(f"Populated vector store with {self.vector_store.index.ntotal} vectors")
+
+    def _deduplicate(self, ids: list, chunks: list, duplicates: dict) -> tuple[list, list]:
+        #The chunks that are not near-duplicates of an indexed chunk (or of one kept earlier in the
+        #list); those are registered as indexed, the others recorded in duplicates (id -> kept id)
+        if self.dedup is None:
+            return ids, chunks
+        kept_ids, kept_chunks = [], []
+        for chunk_id, chunk in zip(ids, chunks):
+            signature = self.dedup.signature(chunk['text'])
+            canonical = self.dedup.find(signature)
+            if canonical is None:
+                self.dedup.add(chunk_id, signature)
+                kept_ids.append(chunk_id)
+                kept_chunks.append(chunk)
+            else:
+                duplicates[chunk_id] = canonical
+        return kept_ids, kept_chunks
+
+    def _duplicate_sources(self, canonical_ids, duplicates: dict, files: dict) -> dict:
+        #Indexed chunk id -> names of the documents its dropped near-duplicates came from
+        wanted = set(canonical_ids).intersection(duplicates.values())
+        if not wanted:
+            return {}
+        source = {chunk_id: rel for rel, info in files.items() for chunk_id in info.get("chunk_ids", ())}
+        names = {chunk_id: set() for chunk_id in wanted}
+        for dup, canonical in duplicates.items():
+            if canonical in wanted:
+                names[canonical].add(self.loader.document_name(source[dup]))
+        return names
+
+    @staticmethod
+    def with_sources(chunk: dict, names) -> dict:
+        #Copy of the chunk listing the other documents that contain it under metadata "also_in";
+        #they are named in its prompt block, so its token count is taken again
+        others = sorted(set(names or ()) - {chunk['metadata'].get('filename')})
+        if not others and 'also_in' not in chunk['metadata']:
+            return chunk
+        meta = dict(chunk['metadata'])
+        if others:
+            meta['also_in'] = others
+        else:
+            meta.pop('also_in', None)
+        return PromptBuilder.prepare_chunk(dict(chunk, metadata=meta))
+
+    def _report_dedup(self, candidates: int, dropped: int, dropped_bytes: int, embed_seconds: float) -> dict:
+        #What dropping near-duplicates saved in this build or sync, extrapolated from the embedding time
+        kept = candidates - dropped
+        self.last_dedup = {
+            "chunks": candidates,
+            "duplicates": dropped,
+            "text_bytes_saved": dropped_bytes,
+            "vector_bytes_saved": dropped * self.embedding_service.embedding_dim * 4,
+            "embed_seconds_saved": embed_seconds / kept * dropped if kept else 0.0,
+        }
+        if dropped:
+            logger.info(f"Dropped {dropped} of {candidates} chunks as near-duplicates, saving "
+                        f"{self.last_dedup['vector_bytes_saved'] + self.last_dedup['text_bytes_saved']} bytes "
+                        f"and ~{self.last_dedup['embed_seconds_saved']:.2f}s of embedding")
+        return self.last_dedup
+
+    def dedup_stats(self) -> dict:
+        duplicates = (self.manifest or {}).get("duplicates") or {}
+        return {
+            "enabled": self.dedup is not None,
+            "indexed_chunks": len(self.dedup) if self.dedup is not None else None,
+            "duplicate_chunks": len(duplicates),
+            "last_run": self.last_dedup,
+        }
+
+    def _load_dedup(self, version: str):
+        if self.dedup is not None:
+            self.dedup.load(str(self._snapshot_path(version) / "dedup"))
+
+    def sync(self) -> dict:
+        #Bring the index in line with the data directory, re-embedding only new chunks.
+        with self._snapshot_lock():
+            # Start from what another worker may already have published, so its work is not redone
+            # and its snapshot directory, which other workers map, is not rewritten
+            self.reload_current()
+            try:
+                return self._sync()
+            except Exception:
+                # Signatures may already describe chunks that never reached the index
+                if self.manifest is not None:
+                    self._load_dedup(self.manifest["index_version"])
+                raise
+
+    def _sync(self) -> dict:
+        if self.manifest is None:
+            self.load_or_build()
+            return {"rebuilt": True, "index_version": self.index_version}
+
+        old_files = self.manifest["files"]
+        manifest = self.build_manifest(self.scan_files(previous=old_files))
+        if manifest["index_version"] == self.index_version:
+            return {"rebuilt": False, "changed_files": [], "deleted_files": [],
+                    "added": 0, "removed": 0, "index_version": self.index_version}
+
+        if (manifest["embedding"] != self.manifest["embedding"]
+                or manifest["chunker"] != self.manifest["chunker"]
+                or manifest["index"] != self.manifest["index"]
+                or manifest["context"] != self.manifest["context"]
+                or manifest["dedup"] != self.manifest["dedup"]):
+            logger.info("Embedding, chunker, index, tokenizer or dedup settings changed, rebuilding index")
+            self.rebuild(manifest)
+            return {"rebuilt": True, "dedup": self.last_dedup, "index_version": self.index_version}
+
+        changed = [rel for rel, info in manifest["files"].items() if "chunk_ids" not in info]
+        deleted = [rel for rel in old_files if rel not in manifest["files"]]
+
+        stale_ids = set()
+        for rel in deleted:
+            stale_ids.update(old_files[rel]["chunk_ids"])
+
+        new_ids, new_chunks = [], []
+        chunked = {}
+        for rel in changed:
+            ids, chunks = chunked[rel] = self._chunk_file(rel)
+            manifest["files"][rel]["chunk_ids"] = ids
+            previous = set(old_files.get(rel, {}).get("chunk_ids", []))
+            stale_ids.update(previous.difference(ids))
+            for chunk_id, chunk in zip(ids, chunks):
+                if chunk_id not in previous:
+                    new_ids.append(chunk_id)
+                    new_chunks.append(chunk)
+
+        duplicates = {int(dup): canonical for dup, canonical in self.manifest.get("duplicates", {}).items()}
+        # Dropped duplicates never reached the vector store
+        stale_duplicates = stale_ids.intersection(duplicates)
+        stale_ids -= stale_duplicates
+        touched = {duplicates.pop(dup) for dup in stale_duplicates}
+        if self.dedup is not None:
+            for chunk_id in stale_ids:
+                self.dedup.remove(chunk_id)
+            # Duplicates of a removed chunk are indexed (or matched again) in its place
+            orphans = {dup for dup, canonical in duplicates.items() if canonical in stale_ids}
+            source = {chunk_id: rel for rel, info in manifest["files"].items() for chunk_id in info["chunk_ids"]}
+            for rel in sorted({source[dup] for dup in orphans}):
+                ids, chunks = chunked[rel] if rel in chunked else self._chunk_file(rel)
+                for chunk_id, chunk in zip(ids, chunks):
+                    if chunk_id in orphans:
+                        del duplicates[chunk_id]
+                        new_ids.append(chunk_id)
+                        new_chunks.append(chunk)
+
+        candidates = new_chunks
+        before = set(duplicates)
+        new_ids, new_chunks = self._deduplicate(new_ids, new_chunks, duplicates)
+        touched.update(duplicates[dup] for dup in set(duplicates) - before)
+        names = self._duplicate_sources(touched, duplicates, manifest["files"])
+        new_chunks = [self.with_sources(chunk, names.get(chunk_id)) for chunk_id, chunk in zip(new_ids, new_chunks)]
+
+        # Embedding is the slow part and runs while queries keep hitting the old index
+        start = time.perf_counter()
+        embed_ids, embed_chunks, parents = new_ids, new_chunks, None
+        if self.child_chunker is not None:
+            parents = (new_ids, new_chunks)
+            embed_ids, embed_chunks = self.child_chunker.split(new_ids, new_chunks)
+        if embed_chunks:
+            embeds, metas = self.embedding_service.embed_documents(embed_chunks)
+        else:
+            embeds, metas = [], []
+        dropped_bytes = (sum(len(chunk['text'].encode("utf-8")) for chunk in candidates)
+                         - sum(len(chunk['text'].encode("utf-8")) for chunk in new_chunks))
+        report = self._report_dedup(len(candidates), len(candidates) - len(new_chunks), dropped_bytes,
+                                    time.perf_counter() - start)
+        self.vector_store.update(list(stale_ids), embeds, metas, embed_ids, parents=parents)
+
+        # Chunks that stay indexed but gained or lost duplicates get their document list updated
+        existing = {}
+        for chunk_id in touched.difference(new_ids, stale_ids):
+            chunk = self.vector_store.chunk(chunk_id)
+            if chunk is not None:
+                existing[chunk_id] = chunk
+        if existing:
+            self.vector_store.set_metadata(
+                list(existing), [self.with_sources(chunk, names.get(chunk_id)) for chunk_id, chunk in existing.items()])
+
+        manifest["duplicates"] = {str(dup): canonical for dup, canonical in duplicates.items()}
+        self.save_snapshot(manifest)
+
+        logger.info(f"Synced index: {len(changed)} changed, {len(deleted)} deleted files, "
+                    f"+{len(new_ids)} -{len(stale_ids)} chunks")
+        return {
+            "rebuilt": False,
+            "changed_files": changed,
+            "deleted_files": deleted,
+            "added": len(new_ids),
+            "removed": len(stale_ids),
+            "dedup": report,
+            "index_version": self.index_version,
+        }
+
+    def start_watcher(self, interval: float):
+        #Poll the data directory and sync in the background; unchanged files cost one stat call.
+        if self._watcher is not None:
+            return
+        self._stop_watching.clear()
+
+        def watch():
+            while not self._stop_watching.wait(interval):
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.error(f"Background index sync failed: {e}")
+
+        self._watcher = threading.Thread(target=watch, name="index-watcher", daemon=True)
+        self._watcher.start()
+        logger.info(f"Watching {self.loader.directory} for changes every {interval}s")
+
+    def reload_current(self) -> bool:
+        #Load the snapshot CURRENT points to when another process published a newer one.
+        #Snapshots built with other settings are left alone; this process would not search them correctly.
+        with self._snapshot_lock():
+            saved = self.read_manifest()
+            if saved is None or self.manifest is None or saved["index_version"] == self.index_version:
+                return False
+            if any(saved[key] != self.manifest[key] for key in ("embedding", "chunker", "index", "context", "dedup")):
+                logger.warning(f"Not following snapshot {saved['index_version']}: built with other settings")
+                return False
+            self.vector_store.load(str(self._snapshot_path(saved["index_version"])))
+            self._load_dedup(saved["index_version"])
+            self.manifest = saved
+            logger.info(f"Switched to index snapshot {saved['index_version']}")
+            return True
+
+    def follow_snapshots(self, interval: float):
+        #Poll CURRENT and pick up snapshots written by other worker processes; cheap with mmap loads
+        if self._follower is not None:
+            return
+        self._stop_watching.clear()
+
+        def follow():
+            while not self._stop_watching.wait(interval):
+                try:
+                    self.reload_current()
+                except Exception as e:
+                    logger.error(f"Following index snapshots failed: {e}")
+
+        self._follower = threading.Thread(target=follow, name="snapshot-follower", daemon=True)
+        self._follower.start()
+        logger.info(f"Following index snapshots in {self.snapshot_dir} every {interval}s")
+
+    def stop_watcher(self):
+        #Stop the data directory watcher and the snapshot follower
+        self._stop_watching.set()
+        for thread in (self._watcher, self._follower):
+            if thread is not None:
+                thread.join()
+        self._watcher = None
+        self._follower = None
+
+    def read_manifest(self):
+        #Manifest of the snapshot CURRENT points to, or None when there is none.
+        try:
+            version = (self.snapshot_dir / CURRENT_FILE).read_text(encoding="utf-8").strip()
+            with open(self._snapshot_path(version) / MANIFEST_FILE, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable snapshot manifest: {e}")
+            return None
+
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            logger.info(f"Snapshot format {manifest.get('format_version')} is outdated")
+            return None
+        return manifest
+
+    def save_snapshot(self, manifest: dict, store=None):
+        #Write the snapshot (of the live store unless another is given) to its own version directory
+        #and atomically point CURRENT at it.
+        store = self.vector_store if store is None else store
+        with self._snapshot_lock():
+            self._save_snapshot(manifest, store)
+
+    def _save_snapshot(self, manifest: dict, store):
+        manifest = dict(manifest, created_at=time.time(), num_vectors=int(store.index.ntotal))
+        version = manifest["index_version"]
+        final_path = self._snapshot_path(version)
+        # Unique per process, so a crashed writer's leftovers never clash with the next one
+        tmp_path = final_path.with_name(f"{version}.{os.getpid()}.tmp")
+
+        try:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            store.save(str(tmp_path))
+            if self.dedup is not None:
+                self.dedup.save(str(tmp_path / "dedup"))
+            with open(tmp_path / MANIFEST_FILE, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+
+            shutil.rmtree(final_path, ignore_errors=True)
+            os.replace(tmp_path, final_path)
+
+            current_tmp = self.snapshot_dir / f"{CURRENT_FILE}.{os.getpid()}.tmp"
+            current_tmp.write_text(version, encoding="utf-8")
+            os.replace(current_tmp, self.snapshot_dir / CURRENT_FILE)
+
+            self.manifest = manifest
+            logger.info(f"Saved index snapshot {version} to {final_path}")
+        except Exception as e:
+            logger.error(f"Failed saving index snapshot: {e}")
+            raise
+
+        self._prune_snapshots()
+
+    @contextmanager
+    def _snapshot_lock(self):
+        #Serialize syncs and snapshot writes between threads and between worker processes sharing
+        #snapshot_dir; re-entrant within a process, since sync may rebuild and save.
+        with self._sync_lock:
+            if self._lock_file is not None:
+                yield
+                return
+            self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.snapshot_dir / LOCK_FILE, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_file = lock_file
+                try:
+                    yield
+                finally:
+                    # Closing the file releases the lock
+                    self._lock_file = None
+
+    def _snapshot_path(self, version: str) -> Path:
+        return self.snapshot_dir / "snapshots" / version
+
+    def _prune_snapshots(self):
+        #Keep only the newest snapshots; older ones can no longer become CURRENT.
+        root = self.snapshot_dir / "snapshots"
+        current = self.index_version
+        # Writers hold the snapshot lock, so temporary directories left now belong to crashed ones
+        for leftover in root.glob("*.tmp"):
+            shutil.rmtree(leftover, ignore_errors=True)
+        dirs = sorted(
+            (p for p in root.iterdir() if p.is_dir() and not p.name.endswith(".tmp")),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for stale in [p for p in dirs if p.name != current][max(self.keep_snapshots - 1, 0):]:
+            shutil.rmtree(stale, ignore_errors=True)
+            logger.info(f"Removed old index snapshot {stale.name}")
@@ -0,0 +1,266 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PromptBuilder import PromptBuilder, load_token_counter
+from TextProcessor import FileLoader, StreamingTextChunker, TextChunker
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# Marks the end of the stream on the queues between stages
+_DONE = object()
+
+
+def is_large_file(path: str, stream_threshold: int = None) -> bool:
+    return stream_threshold is not None and os.path.getsize(path) >= stream_threshold
+
+
+def _stream_chunks(path: str, chunk_size: int, chunk_overlap: int):
+    chunker = StreamingTextChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    for chunk in chunker.split_file(path):
+        yield PromptBuilder.prepare_chunk({'text': chunk['text'], 'metadata': chunk['metadata']})
+
+
+def chunk_batches(path: str, chunk_size: int, chunk_overlap: int, stream_threshold: int = None,
+                  batch_size: int = 256):
+    #The chunks of chunk_file() in lists of at most batch_size, at least one (possibly empty) per file.
+    #Large files are chunked lazily, so only the batch being built is held, however big the file is.
+    if is_large_file(path, stream_threshold):
+        chunks = _stream_chunks(path, chunk_size, chunk_overlap)
+    else:
+        chunks = iter(chunk_file(path, chunk_size, chunk_overlap))
+    batch = list(itertools.islice(chunks, batch_size))
+    yield batch
+    while len(batch) == batch_size:
+        batch = list(itertools.islice(chunks, batch_size))
+        if batch:
+            yield batch
+
+
+def chunk_file(path: str, chunk_size: int, chunk_overlap: int, stream_threshold: int = None) -> list[dict]:
+    #Chunks of one data file with their prompt token counts, as they are indexed. Files of at least
+    #stream_threshold bytes are chunked from a memory map instead of being read into one string;
+    #the chunks are the same either way.
+    if is_large_file(path, stream_threshold):
+        return list(_stream_chunks(path, chunk_size, chunk_overlap))
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if not content.strip():
+        return []
+    chunker = TextChunker([(FileLoader.document_name(path), content)],
+                          chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [PromptBuilder.prepare_chunk(chunk) for chunk in chunker.split_docs()]
+
+
+def _init_worker(tokenizer_name: str):
+    #Chunking processes count context tokens with the same tokenizer as the parent
+    if tokenizer_name != PromptBuilder.tokenizer_name:
+        name, counter = load_token_counter(tokenizer_name)
+        if name != tokenizer_name:
+            raise RuntimeError(f"Tokenizer {tokenizer_name} unavailable in chunking process")
+        PromptBuilder.use_tokenizer(name, counter)
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class IngestPipeline:
+    #Streams data files through load -> chunk -> embed -> add. Files are chunked in a process pool a few
+    #at a time; files of at least stream_threshold bytes are chunked here instead, lazily and batch by
+    #batch, since a worker would have to send all of their chunks back at once. Chunks are embedded in fixed-size batches on one thread and appended to the VectorStore
+    #batch by batch on another, with bounded queues in between, so the memory used on the way does not
+    #grow with the number of files.
+
+    def __init__(
+        self,
+        embedding_service,
+        vector_store,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 100,
+        batch_size: int = 256,
+        workers: int = 0,
+        queue_size: int = 4,
+        progress_interval: float = 10.0,
+        stream_threshold: int = None,
+        children=None,
+    ):
+        self.embedding_service = embedding_service
+        self.vector_store = vector_store
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.workers = workers
+        self.queue_size = queue_size
+        self.progress_interval = progress_interval
+        self.stream_threshold = stream_threshold
+        # ChildChunker: embed the children of each chunk and add the chunks as their parents
+        self.children = children
+        self._error = None
+
+    def _batches(self, path: str):
+        return chunk_batches(path, self.chunk_size, self.chunk_overlap, self.stream_threshold, self.batch_size)
+
+    def _chunked_files(self, paths: list[str]):
+        #(path, chunks) in input order, one or more per file (large files come in batches); at most
+        #2 files per worker are read or chunked at a time
+        if self.workers <= 0:
+            for path in paths:
+                if is_large_file(path, self.stream_threshold):
+                    for batch in self._batches(path):
+                        yield path, batch
+                else:
+                    yield path, chunk_file(path, self.chunk_size, self.chunk_overlap)
+            return
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(PromptBuilder.tokenizer_name,)) as pool:
+            def submit(path):
+                if is_large_file(path, self.stream_threshold):
+                    return path, None
+                return path, pool.submit(chunk_file, path, self.chunk_size, self.chunk_overlap)
+
+            pending = deque()
+            paths = iter(paths)
+            for path in paths:
+                pending.append(submit(path))
+                if len(pending) >= 2 * self.workers:
+                    break
+            while pending:
+                path, future = pending.popleft()
+                if future is None:
+                    for batch in self._batches(path):
+                        yield path, batch
+                        if self._error is not None:
+                            return
+                else:
+                    yield path, future.result()
+                if self._error is not None:
+                    return
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending.append(submit(next_path))
+
+    def _embed(self, batches: queue.Queue, embedded: queue.Queue, stats: dict):
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                break
+            if self._error is not None:
+                continue
+            ids, chunks = batch
+            try:
+                parents = None
+                if self.children is not None:
+                    parents = (ids, chunks)
+                    ids, chunks = self.children.split(ids, chunks)
+                start = time.perf_counter()
+                vectors, chunks = self.embedding_service.embed_documents(chunks, show_progress=False)
+                stats["embed_seconds"] += time.perf_counter() - start
+                stats["embedded"] += len(ids)
+                embedded.put((ids, np.asarray(vectors, dtype=np.float32), chunks, parents))
+            except Exception as e:
+                self._error = e
+        embedded.put(_DONE)
+
+    def _add(self, embedded: queue.Queue, stats: dict):
+        #Append batches to the store; an untrained (IVF) index first collects its training sample
+        held = []
+        while True:
+            batch = embedded.get()
+            if batch is _DONE:
+                break
+            if self._error is not None:
+                continue
+            try:
+                if not self.vector_store.is_trained:
+                    held.append(batch)
+                    if sum(len(batch[0]) for batch in held) < self.vector_store.index_config.train_sample_size:
+                        continue
+                    batch, held = self._merge(held), []
+                self._store(batch, stats)
+            except Exception as e:
+                self._error = e
+        if held and self._error is None:
+            try:
+                self._store(self._merge(held), stats)
+            except Exception as e:
+                self._error = e
+
+    def _store(self, batch, stats: dict):
+        ids, vectors, chunks, parents = batch
+        self.vector_store.add(vectors, chunks, ids=ids, parents=parents)
+        # Vectors, i.e. the children when chunks are indexed as parents
+        stats["added"] += len(ids)
+        stats["parents"] += 0 if parents is None else len(parents[0])
+
+    @staticmethod
+    def _merge(batches):
+        parents = None
+        if batches[0][3] is not None:
+            parents = ([i for batch in batches for i in batch[3][0]], [c for batch in batches for c in batch[3][1]])
+        return ([i for ids, _, _, _ in batches for i in ids],
+                np.concatenate([vectors for _, vectors, _, _ in batches]),
+                [chunk for _, _, chunks, _ in batches for chunk in chunks],
+                parents)
+
+    def run(self, paths: list[str], on_file) -> dict:
+        #on_file(path, chunks) -> (ids, chunks) assigns ids and picks the chunks to index. It is called
+        #at least once per file, in file order; a large file's batches follow each other in order.
+        stats = {"files": len(paths), "chunks": 0, "embedded": 0, "added": 0, "parents": 0, "embed_seconds": 0.0}
+        self._error = None
+        batches = queue.Queue(maxsize=self.queue_size)
+        embedded = queue.Queue(maxsize=self.queue_size)
+        embedder = threading.Thread(target=self._embed, args=(batches, embedded, stats), name="ingest-embed")
+        adder = threading.Thread(target=self._add, args=(embedded, stats), name="ingest-add")
+        embedder.start()
+        adder.start()
+
+        start = last_report = time.perf_counter()
+        ids, chunks = [], []
+        done, last_path = 0, None
+        try:
+            for path, file_chunks in self._chunked_files(paths):
+                if path != last_path:
+                    done, last_path = done + 1, path
+                stats["chunks"] += len(file_chunks)
+                file_ids, file_chunks = on_file(path, file_chunks)
+                ids.extend(file_ids)
+                chunks.extend(file_chunks)
+                while len(ids) >= self.batch_size:
+                    batches.put((ids[:self.batch_size], chunks[:self.batch_size]))
+                    ids, chunks = ids[self.batch_size:], chunks[self.batch_size:]
+                if self._error is not None:
+                    break
+                if time.perf_counter() - last_report >= self.progress_interval:
+                    last_report = time.perf_counter()
+                    elapsed = last_report - start
+                    logger.info(f"Indexed {done}/{len(paths)} files: {stats['chunks']} chunks, "
+                                f"{stats['added']} vectors added ({stats['added'] / elapsed:.0f}/s)")
+            if ids and self._error is None:
+                batches.put((ids, chunks))
+        except Exception as e:
+            self._error = e
+        finally:
+            batches.put(_DONE)
+            embedder.join()
+            adder.join()
+        if self._error is not None:
+            raise self._error
+
+        stats["seconds"] = time.perf_counter() - start
+        stats["chunks_per_second"] = stats["chunks"] / stats["seconds"] if stats["seconds"] else 0.0
+        stats["peak_rss_mb"] = peak_rss_mb()
+        parents = f" of {stats['parents']} parent chunks" if self.children is not None else ""
+        logger.info(f"Indexed {stats['files']} files in {stats['seconds']:.1f}s: {stats['chunks']} chunks "
+                    f"({stats['chunks_per_second']:.0f}/s), {stats['added']} vectors{parents}, "
+                    f"{stats['embed_seconds']:.1f}s embedding, peak RSS {stats['peak_rss_mb']:.0f} MB")
+        return stats
@@ -1,71 +1,437 @@
-from typing import Type, TypeVar
-from google import genai
-from pydantic import BaseModel, ValidationError
-from logger_config import get_logger
-
-T = TypeVar("T", bound=BaseModel)
-
-
-class LLMServiceError(Exception):
-    """Base exception for LLM service errors."""
-
-
-class LLMService:
-
-    def __init__(
-        self,
-        api_key: str,
-        model: str = "gemini-3-flash-preview",
-    ):
-        self.model = model
-        self.logger = get_logger(__name__)
-
-        try:
-            self.client = genai.Client(api_key=api_key)
-            self.logger.info("Gemini client initialized")
-
-        except Exception as e:
-            self.logger.exception("Failed to initialize Gemini client")
-            raise LLMServiceError("Client initialization failed") from e
-
-    async def generate(
-        self,
-        prompt: str,
-        response_model: Type[T],
-        temperature: float = 0.0,
-    ) -> T:
-        #Generate structured response from LLM and validate via Pydantic.
-        
-
-        try:
-            self.logger.info("Sending request to Gemini")
-
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=prompt,
-                config={
-                    "response_mime_type": "application/json",
-                    "response_json_schema": response_model.model_json_schema(),
-                    "temperature": temperature,
-                },
-
-            )
-
-            if not response.text:
-                raise LLMServiceError("Empty response from model")
-
-            self.logger.debug("Raw LLM response: %s", response.text)
-
-            parsed = response_model.model_validate_json(response.text)
-
-            self.logger.info("Response validated successfully")
-
-            return parsed.model_dump()
-
-        except ValidationError as ve:
-            self.logger.exception("Schema validation failed")
-            raise LLMServiceError("LLM returned invalid schema") from ve
-
-        except Exception as e:
-            self.logger.exception("LLM generation failed")
-            raise LLMServiceError("LLM generation error") from e
\ No newline at end of file
+import asyncio
+import hashlib
+import json
+import time
+from typing import AsyncIterator, Optional, Type, TypeVar
+from google import genai
+from google.genai import errors as genai_errors
+from pydantic import BaseModel, ValidationError
+from logger_config import get_logger
+import Metrics
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class LLMServiceError(Exception):
+    """Base exception for LLM service errors."""
+
+
+class LLMTimeoutError(LLMServiceError):
+    """Raised when the model does not answer within the per-call timeout."""
+
+
+class JSONFieldStreamer:
+    #Incrementally decodes one top-level string field of a JSON object streamed in arbitrary pieces,
+    #so the field can be shown while the rest of the object is still being generated.
+
+    def __init__(self, field: str):
+        self.field = field
+        self._depth = 0
+        self._in_string = False
+        self._escape = None
+        self._key = []
+        self._last_key = None
+        self._expect_value = False
+        self._capturing = False
+        self.done = False
+
+    def feed(self, text: str) -> str:
+        #Consume the next piece of JSON and return the newly decoded characters of the field.
+        out = []
+        for c in text:
+            if self._in_string:
+                if self._escape is not None:
+                    self._escape += c
+                    decoded = self._decode_escape()
+                    if decoded is not None:
+                        self._emit(decoded, out)
+                elif c == "\\":
+                    self._escape = c
+                elif c == '"':
+                    self._in_string = False
+                    if self._capturing:
+                        self._capturing = False
+                        self.done = True
+                    elif self._depth == 1 and not self._expect_value:
+                        self._last_key = "".join(self._key)
+                else:
+                    self._emit(c, out)
+            elif c == '"':
+                self._in_string = True
+                self._key = []
+                self._capturing = (self._depth == 1 and self._expect_value
+                                   and self._last_key == self.field and not self.done)
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+            elif c == ":" and self._depth == 1:
+                self._expect_value = True
+            elif c == "," and self._depth == 1:
+                self._expect_value = False
+                self._last_key = None
+        return "".join(out)
+
+    def _emit(self, text: str, out: list):
+        if self._capturing:
+            out.append(text)
+        elif self._depth == 1 and not self._expect_value:
+            self._key.append(text)
+
+    def _decode_escape(self):
+        #Complete escape sequence -> decoded text; None while more characters are needed
+        escape = self._escape
+        if escape[1] != "u":
+            self._escape = None
+            return json.loads(f'"{escape}"')
+        if len(escape) < 6:
+            return None
+        # A UTF-16 high surrogate is only decodable together with the low surrogate after it
+        if 0xD800 <= int(escape[2:6], 16) <= 0xDBFF and len(escape) < 12:
+            return None
+        self._escape = None
+        return json.loads(f'"{escape}"')
+
+
+class PromptCache:
+    #Uploads a static prompt prefix once as Gemini cached content and hands out its resource name.
+    #The TTL is extended shortly before it runs out; after a failure prompts go inline for a while.
+
+    def __init__(
+        self,
+        client,
+        model: str,
+        ttl_seconds: float = 3600.0,
+        refresh_margin: float = 300.0,
+        retry_after: float = 600.0,
+        timeout: float = 30.0,
+    ):
+        self.client = client
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.logger = get_logger(__name__)
+        # prefix hash -> (cache name, local expiry time)
+        self._entries = {}
+        self._lock = asyncio.Lock()
+        self._disabled_until = 0.0
+
+        self.created = 0
+        self.refreshed = 0
+        self.failures = 0
+
+    @staticmethod
+    def _key(prefix: str) -> str:
+        return hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+    def _fresh(self, key: str, now: float) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and now < entry[1] - self.refresh_margin:
+            return entry[0]
+        return None
+
+    async def get(self, prefix: str) -> Optional[str]:
+        #Name of the cached content holding prefix, or None when the prefix has to be sent inline
+        now = time.monotonic()
+        if now < self._disabled_until:
+            return None
+        key = self._key(prefix)
+        name = self._fresh(key, now)
+        if name is not None:
+            return name
+
+        # One request creates or refreshes the cache; concurrent ones wait for it
+        async with self._lock:
+            now = time.monotonic()
+            name = self._fresh(key, now)
+            if name is not None:
+                return name
+
+            ttl = f"{int(self.ttl_seconds)}s"
+            entry = self._entries.get(key)
+            try:
+                if entry is not None and now < entry[1]:
+                    await asyncio.wait_for(
+                        self.client.aio.caches.update(name=entry[0], config={"ttl": ttl}),
+                        timeout=self.timeout,
+                    )
+                    name = entry[0]
+                    self.refreshed += 1
+                    self.logger.info(f"Extended prompt cache {name} by {ttl}")
+                else:
+                    cached = await asyncio.wait_for(
+                        self.client.aio.caches.create(
+                            model=self.model,
+                            config={
+                                "contents": [prefix],
+                                "ttl": ttl,
+                                "display_name": f"ticket-prompt-{key[:12]}",
+                            },
+                        ),
+                        timeout=self.timeout,
+                    )
+                    name = cached.name
+                    self.created += 1
+                    self.logger.info(f"Uploaded prompt prefix as cached content {name}")
+            except Exception as e:
+                # e.g. prefix below the provider's minimum cacheable size, or caching not offered
+                self.failures += 1
+                self._entries.pop(key, None)
+                self._disabled_until = now + self.retry_after
+                self.logger.warning(f"Prompt caching unavailable, sending prompts inline "
+                                    f"for {self.retry_after}s: {e}")
+                return None
+
+            self._entries[key] = (name, now + self.ttl_seconds)
+            return name
+
+    def invalidate(self, name: str):
+        #Forget a cache the provider no longer knows about
+        for key, entry in list(self._entries.items()):
+            if entry[0] == name:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        return {
+            "caches": len(self._entries),
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "failures": self.failures,
+        }
+
+
+class LLMService:
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gemini-3-flash-preview",
+        max_concurrency: int = 8,
+        timeout: float = 30.0,
+        base_url: Optional[str] = None,
+        prompt_cache: bool = True,
+        prompt_cache_ttl: float = 3600.0,
+        prompt_cache_refresh_margin: float = 300.0,
+    ):
+        self.model = model
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.logger = get_logger(__name__)
+        # Caps in-flight requests so a burst of tickets cannot exhaust the provider quota
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.cached_prefix_requests = 0
+        self.inline_prefix_requests = 0
+
+        try:
+            client_kwargs = {}
+            if base_url:
+                # Point the SDK at another Gemini-compatible endpoint, e.g. the local stub
+                client_kwargs["http_options"] = {"base_url": base_url}
+            self.client = genai.Client(api_key=api_key, **client_kwargs)
+            self.logger.info("Gemini client initialized")
+
+            self.prompt_cache = None
+            if prompt_cache:
+                self.prompt_cache = PromptCache(self.client, model, ttl_seconds=prompt_cache_ttl,
+                                                refresh_margin=prompt_cache_refresh_margin, timeout=timeout)
+
+        except Exception as e:
+            self.logger.exception("Failed to initialize Gemini client")
+            raise LLMServiceError("Client initialization failed") from e
+
+    async def _request(self, prompt: str, prefix: Optional[str], response_model: Type[T],
+                       temperature: float) -> tuple[str, dict]:
+        #Contents and config for a call; a static prefix is referenced by its cache when possible
+        request_config = {
+            "response_mime_type": "application/json",
+            "response_json_schema": response_model.model_json_schema(),
+            "temperature": temperature,
+        }
+        if prefix is None:
+            return prompt, request_config
+
+        name = await self.prompt_cache.get(prefix) if self.prompt_cache is not None else None
+        if name is None:
+            self.inline_prefix_requests += 1
+            return prefix + prompt, request_config
+
+        self.cached_prefix_requests += 1
+        return prompt, dict(request_config, cached_content=name)
+
+    def _inline_retry(self, error: Exception, prompt: str, prefix: Optional[str], request_config: dict):
+        #After a client error on a cached call, the same request with the prefix inline; else re-raise
+        name = request_config.get("cached_content")
+        if name is None or not isinstance(error, genai_errors.ClientError):
+            raise error
+        # The cache may have expired or been deleted on the provider side
+        self.logger.warning(f"Cached content {name} rejected, retrying inline: {error}")
+        self.prompt_cache.invalidate(name)
+        self.cached_prefix_requests -= 1
+        self.inline_prefix_requests += 1
+        inline_config = {k: v for k, v in request_config.items() if k != "cached_content"}
+        return prefix + prompt, inline_config
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "cached_prefix_requests": self.cached_prefix_requests,
+            "inline_prefix_requests": self.inline_prefix_requests,
+            "prompt_cache": self.prompt_cache.stats() if self.prompt_cache is not None else None,
+        }
+
+    def _parse(self, text: str, response_model: Type[T]) -> dict:
+        if not text:
+            raise LLMServiceError("Empty response from model")
+
+        self.logger.debug("Raw LLM response: %s", text)
+
+        parsed = response_model.model_validate_json(text)
+
+        self.logger.info("Response validated successfully")
+
+        return parsed.model_dump()
+
+    async def generate(
+        self,
+        prompt: str,
+        response_model: Type[T],
+        temperature: float = 0.0,
+        prefix: Optional[str] = None,
+    ) -> T:
+        #Generate structured response from LLM and validate via Pydantic.
+        #A static prefix (see PromptBuilder.build_prompt_parts) is served from the provider's cache.
+        #Cancelling the awaiting task (e.g. on client disconnect) aborts the request.
+
+        try:
+            async with self._semaphore:
+                self.in_flight += 1
+                try:
+                    self.logger.info("Sending request to Gemini")
+
+                    contents, request_config = await self._request(prompt, prefix, response_model, temperature)
+                    try:
+                        response = await asyncio.wait_for(
+                            self.client.aio.models.generate_content(
+                                model=self.model, contents=contents, config=request_config,
+                            ),
+                            timeout=self.timeout,
+                        )
+                    except genai_errors.ClientError as e:
+                        contents, request_config = self._inline_retry(e, prompt, prefix, request_config)
+                        response = await asyncio.wait_for(
+                            self.client.aio.models.generate_content(
+                                model=self.model, contents=contents, config=request_config,
+                            ),
+                            timeout=self.timeout,
+                        )
+                finally:
+                    self.in_flight -= 1
+
+            return self._parse(response.text, response_model)
+
+        except asyncio.TimeoutError as te:
+            self.logger.error(f"LLM request timed out after {self.timeout}s")
+            Metrics.LLM_ERRORS.labels("timeout").inc()
+            raise LLMTimeoutError(f"LLM request timed out after {self.timeout}s") from te
+
+        except ValidationError as ve:
+            self.logger.exception("Schema validation failed")
+            Metrics.LLM_SCHEMA_FAILURES.inc()
+            raise LLMServiceError("LLM returned invalid schema") from ve
+
+        except LLMServiceError:
+            self.logger.exception("LLM generation failed")
+            Metrics.LLM_ERRORS.labels("error").inc()
+            raise
+
+        except Exception as e:
+            self.logger.exception("LLM generation failed")
+            Metrics.LLM_ERRORS.labels("error").inc()
+            raise LLMServiceError("LLM generation error") from e
+
+    async def _open_stream(self, contents: str, request_config: dict):
+        #Start a streaming call and wait for its first chunk (None for an empty stream)
+        stream = await asyncio.wait_for(
+            self.client.aio.models.generate_content_stream(
+                model=self.model, contents=contents, config=request_config,
+            ),
+            timeout=self.timeout,
+        )
+        try:
+            first = await asyncio.wait_for(stream.__anext__(), timeout=self.timeout)
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+            raise
+        return stream, first
+
+    async def generate_stream(
+        self,
+        prompt: str,
+        response_model: Type[T],
+        stream_field: str = "answer",
+        temperature: float = 0.0,
+        prefix: Optional[str] = None,
+    ) -> AsyncIterator[tuple[str, object]]:
+        #Stream a structured response: yields ("delta", text) as the stream_field string arrives,
+        #then ("result", dict) once the whole response is validated.
+        #The timeout applies to the wait for each chunk, not to the whole stream.
+
+        streamer = JSONFieldStreamer(stream_field)
+        parts = []
+        try:
+            async with self._semaphore:
+                self.in_flight += 1
+                stream = None
+                try:
+                    self.logger.info("Sending streaming request to Gemini")
+
+                    contents, request_config = await self._request(prompt, prefix, response_model, temperature)
+                    try:
+                        stream, chunk = await self._open_stream(contents, request_config)
+                    except genai_errors.ClientError as e:
+                        contents, request_config = self._inline_retry(e, prompt, prefix, request_config)
+                        stream, chunk = await self._open_stream(contents, request_config)
+
+                    while chunk is not None:
+                        text = chunk.text or ""
+                        parts.append(text)
+                        delta = streamer.feed(text)
+                        if delta:
+                            yield "delta", delta
+                        try:
+                            chunk = await asyncio.wait_for(stream.__anext__(), timeout=self.timeout)
+                        except StopAsyncIteration:
+                            chunk = None
+                finally:
+                    self.in_flight -= 1
+                    # Releases the HTTP connection when the consumer stops early
+                    if stream is not None and hasattr(stream, "aclose"):
+                        await stream.aclose()
+
+            yield "result", self._parse("".join(parts), response_model)
+
+        except asyncio.TimeoutError as te:
+            self.logger.error(f"LLM stream stalled for more than {self.timeout}s")
+            Metrics.LLM_ERRORS.labels("timeout").inc()
+            raise LLMTimeoutError(f"LLM stream stalled for more than {self.timeout}s") from te
+
+        except ValidationError as ve:
+            self.logger.exception("Schema validation failed")
+            Metrics.LLM_SCHEMA_FAILURES.inc()
+            raise LLMServiceError("LLM returned invalid schema") from ve
+
+        except LLMServiceError:
+            self.logger.exception("LLM generation failed")
+            Metrics.LLM_ERRORS.labels("error").inc()
+            raise
+
+        except Exception as e:
+            self.logger.exception("LLM streaming failed")
+            Metrics.LLM_ERRORS.labels("error").inc()
+            raise LLMServiceError("LLM generation error") from e
@@ -0,0 +1,58 @@
+import os
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+
+# Every label takes one of these fixed values, so the number of series stays small
+STAGES = ("embed", "search", "rerank", "gate", "cache", "prompt", "llm")
+ENDPOINTS = ("/resolve-ticket", "/resolve-ticket/stream", "/resolve-tickets")
+LLM_ERROR_KINDS = ("timeout", "error")
+# From sub-millisecond gate and cache checks up to LLM calls near the timeout
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Time spent in one pipeline stage of a ticket",
+                          ["stage"], buckets=BUCKETS)
+REQUEST_SECONDS = Histogram("rag_request_seconds", "Time to serve a ticket request, including its streamed body",
+                            ["endpoint", "status"], buckets=BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("rag_requests_in_flight", "Ticket requests being served", ["endpoint"],
+                           multiprocess_mode="livesum")
+INDEX_VECTORS = Gauge("rag_index_vectors", "Vectors in the search index", multiprocess_mode="livemostrecent")
+LLM_ERRORS = Counter("rag_llm_errors_total", "Failed LLM calls other than schema validation failures", ["kind"])
+LLM_SCHEMA_FAILURES = Counter("rag_llm_schema_validation_failures_total",
+                              "LLM answers that did not match the response schema")
+
+# Label lookups resolved once; observing is then a dict lookup and a locked add
+_stage_children = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+_in_flight_children = {endpoint: REQUESTS_IN_FLIGHT.labels(endpoint) for endpoint in ENDPOINTS}
+# (endpoint, status class) -> histogram child, filled on first use
+_request_children = {}
+for kind in LLM_ERROR_KINDS:
+    LLM_ERRORS.labels(kind)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    child = _stage_children.get(stage)
+    if child is not None:
+        child.observe(seconds)
+
+
+def in_flight(endpoint: str):
+    #Gauge child of a ticket endpoint, or None for paths that are not measured
+    return _in_flight_children.get(endpoint)
+
+
+def observe_request(endpoint: str, status: int, seconds: float) -> None:
+    key = (endpoint, status // 100)
+    child = _request_children.get(key)
+    if child is None:
+        child = _request_children[key] = REQUEST_SECONDS.labels(endpoint, f"{status // 100}xx")
+    child.observe(seconds)
+
+
+def render() -> tuple[bytes, str]:
+    #Exposition of this process, or of every worker when they share PROMETHEUS_MULTIPROC_DIR (see serve.py)
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,208 +1,288 @@
-import json
-import logging
-logger = logging.getLogger(__name__)
-
-class PromptBuilder:
-  # Available actions for ticket resolution
-    ACTIONS = [
-        "none",
-        "escalate_to_abuse_team",
-        "escalate_to_legal_team", 
-        "escalate_to_sales_team",
-        "follow_up_required"
-    ]
-    
-    # System role defines assistant behavior and constraints
-    SYSTEM_ROLE = """You are an expert support assistant with access to a knowledge base.
-
-TASK: Answer customer support queries using ONLY the provided context documents.
-
-CORE RULES:
-1. Use ONLY information from the provided context documents
-2. Do NOT make up, infer, or hallucinate information
-3. If the answer is not in the context, explicitly state "This information is not available in our knowledge base" and Action is "follow_up_required"
-4. Always cite the source document(s) you used
-5. Choose an action from the provided list - do NOT infer actions
-6. Return ONLY valid JSON - no markdown, no explanations, no additional text"""
-
-    # JSON schema for valid responses
-    OUTPUT_SCHEMA = {
-        "type": "object",
-        "properties": {
-            "answer": {
-                "type": "string",
-                "description": "Clear answer based on context. Say unavailable if not found."
-            },
-            "references": {
-                "type": "array",
-                "items": {"type": "string"},
-                "description": "List of document filenames cited"
-            },
-            "action_required": {
-                "type": "string",
-                "enum": ACTIONS,
-                "description": "Recommended action from the provided list"
-            }
-        },
-        "required": ["answer", "references", "action_required"]
-    }
-    
-    # JSON schema for input context documents with relevance scores
-    INPUT_SCHEMA = {
-        "type": "object",
-        "properties": {
-            "text": {
-                "type": "string",
-                "description": "The document text content"
-            },
-            "metadata": {
-                "type": "object",
-                "description": "Document metadata",
-                "properties": {
-                    "filename": {
-                        "type": "string",
-                        "description": "Name of the source document"
-                    }
-                },
-                "required": ["filename"]
-            },
-        },
-        "required": ["text", "metadata"]
-    }
-    
-    # Few-shot examples for in-context learning
-    FEW_SHOT_EXAMPLES = [
-        {
-            "query": "My domain was suspended and I didn't get any notice. How can I reactivate it?",
-            "context_summary": "Document: domain_suspension_policy.txt - Contains policy on domain suspensions and reactivation steps",
-            "response": {
-                "answer": "Your domain may have been suspended due to a violation of our policy or missing WHOIS information. To reactivate it, update your WHOIS details with current information and contact our support team.",
-                "references": ["domain_suspension_policy.txt"],
-                "action_required": "escalate_to_abuse_team"
-            }
-        },
-        {
-            "query": "I can't remember my password. What should I do?",
-            "context_summary": "Document: account_recovery.txt - Provides account recovery and password reset procedures",
-            "response": {
-                "answer": "To recover your account, use the password reset link on the login page. If you don't receive the email, check your spam folder or contact support.",
-                "references": ["account_recovery.txt"],
-                "action_required": "follow_up_required"
-            }
-        }
-    ]
-
-    @classmethod
-    def build_prompt(cls, query: str, context_docs: list[dict]) -> str:
-        #builds prompt from all components
-        try:
-            # Validate inputs
-            if not query or not isinstance(query, str):
-                raise ValueError("Query must be a non-empty string")
-            
-            if not context_docs or not isinstance(context_docs, list):
-                raise ValueError("Context docs must be a non-empty list")
-            
-            logger.info(f"Building MCP prompt for query: {query[:50]}...")
-            
-            # Format context documents
-            formatted_context = cls._format_context_documents(context_docs)
-            
-            # Format few-shot examples
-            formatted_examples = cls._format_few_shot_examples()
-            
-            # Build complete prompt
-            prompt = f"""{cls.SYSTEM_ROLE}
-
-{'='*70}
-OUTPUT SCHEMA (respond with valid JSON only):
-{cls._format_json_schema()}
-
-{'='*70}
-AVAILABLE ACTIONS:
-{cls._format_actions()}
-
-{'='*70}
-IN-CONTEXT EXAMPLES (follow this pattern):
-
-{formatted_examples}
-
-{'='*70}
-KNOWLEDGE BASE DOCUMENTS:
-
-{formatted_context}
-
-{'='*70}
-CUSTOMER QUERY:
-
-{query}
-
-{'='*70}
-RESPONSE (JSON only):
-"""
-            
-            logger.info("MCP prompt built successfully")
-            return prompt
-            
-        except ValueError as e:
-            logger.error(f"Invalid input for prompt building: {str(e)}")
-            raise
-        except Exception as e:
-            logger.exception("Error building MCP prompt")
-            raise
-    
-    @classmethod
-    def _format_context_documents(cls, context_docs: list[dict]) -> str:
-        #extract information from docs
-        if not context_docs:
-            return "[No documents provided]"
-        
-        formatted = ""
-        for i, doc in enumerate(context_docs, 1):
-            text = doc['metadata']['text']
-            filename = doc['metadata']['metadata']['filename']
-            
-            
-            # Cut long documents to save tokens
-            if len(text) > 1000:
-                text = text[:1000]
-            
-            formatted += f"\n[Document {i}: {filename}]\n"
-            formatted += f"{text}\n"
-            formatted += "-" * 50 + "\n"
-        
-        return formatted
-    
-    @classmethod
-    def _format_few_shot_examples(cls) -> str:
-        """Format few-shot examples for in-context learning"""
-        formatted = ""
-        
-        for i, example in enumerate(cls.FEW_SHOT_EXAMPLES, 1):
-            formatted += f"\nEXAMPLE {i}:\n"
-            formatted += f"Context: {example['context_summary']}\n"
-            formatted += f"Query: {example['query']}\n"
-            formatted += f"Response: {cls._dict_to_json(example['response'])}\n"
-            formatted += "-" * 50
-        
-        return formatted
-    
-    @classmethod
-    def _format_actions(cls) -> str:
-        """Format available actions list"""
-        return "\n".join([f"  • {action}" for action in cls.ACTIONS])
-    
-    @classmethod
-    def _format_json_schema(cls) -> str:
-        """Format JSON schema for clarity"""
-        return """{
-  "answer": "string - your response based on context only",
-  "references": ["array of document filenames used"],
-  "action_required": "one of: none|escalate_to_abuse_team|escalate_to_legal_team|escalate_to_sales_team|follow_up_required"
-}"""
-    
-    @classmethod
-    def _dict_to_json(cls, data: dict) -> str:
-        """Convert dict to JSON string"""
-        return json.dumps(data, indent=2)
+import json
+import logging
+import config
+logger = logging.getLogger(__name__)
+
+SECTION_RULE = "=" * 70
+
+
+def estimate_tokens(text: str) -> int:
+    #Rough token count for when no tokenizer is available: about four characters per token
+    return (len(text) + 3) // 4
+
+
+def load_token_counter(model_name: str = None):
+    #(name, counter) for the Gemini tokenizer of model_name, or the estimate when it cannot be loaded.
+    #The local Gemini tokenizer needs sentencepiece and downloads its model file once.
+    if not model_name:
+        return "estimate", estimate_tokens
+    try:
+        from google.genai.local_tokenizer import LocalTokenizer
+        tokenizer = LocalTokenizer(model_name=model_name)
+        tokenizer.count_tokens("warm up")
+    except Exception as e:
+        logger.warning(f"Tokenizer for {model_name} unavailable, estimating 4 characters per token: {e}")
+        return "estimate", estimate_tokens
+
+    def count(text: str) -> int:
+        return tokenizer.count_tokens(text).total_tokens if text else 0
+
+    logger.info(f"Counting prompt tokens with the {model_name} tokenizer")
+    return model_name, count
+
+class PromptBuilder:
+  # Available actions for ticket resolution
+    ACTIONS = [
+        "none",
+        "escalate_to_abuse_team",
+        "escalate_to_legal_team", 
+        "escalate_to_sales_team",
+        "follow_up_required"
+    ]
+    
+    # System role defines assistant behavior and constraints
+    SYSTEM_ROLE = """You are an expert support assistant with access to a knowledge base.
+
+TASK: Answer customer support queries using ONLY the provided context documents.
+
+CORE RULES:
+1. Use ONLY information from the provided context documents
+2. Do NOT make up, infer, or hallucinate information
+3. If the answer is not in the context, explicitly state "This information is not available in our knowledge base" and Action is "follow_up_required"
+4. Always cite the source document(s) you used
+5. Choose an action from the provided list - do NOT infer actions
+6. Return ONLY valid JSON - no markdown, no explanations, no additional text"""
+
+    # JSON schema for valid responses
+    OUTPUT_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "answer": {
+                "type": "string",
+                "description": "Clear answer based on context. Say unavailable if not found."
+            },
+            "references": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "List of document filenames cited"
+            },
+            "action_required": {
+                "type": "string",
+                "enum": ACTIONS,
+                "description": "Recommended action from the provided list"
+            }
+        },
+        "required": ["answer", "references", "action_required"]
+    }
+    
+    # JSON schema for input context documents with relevance scores
+    INPUT_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "text": {
+                "type": "string",
+                "description": "The document text content"
+            },
+            "metadata": {
+                "type": "object",
+                "description": "Document metadata",
+                "properties": {
+                    "filename": {
+                        "type": "string",
+                        "description": "Name of the source document"
+                    }
+                },
+                "required": ["filename"]
+            },
+        },
+        "required": ["text", "metadata"]
+    }
+    
+    # Few-shot examples for in-context learning
+    FEW_SHOT_EXAMPLES = [
+        {
+            "query": "My domain was suspended and I didn't get any notice. How can I reactivate it?",
+            "context_summary": "Document: domain_suspension_policy.txt - Contains policy on domain suspensions and reactivation steps",
+            "response": {
+                "answer": "Your domain may have been suspended due to a violation of our policy or missing WHOIS information. To reactivate it, update your WHOIS details with current information and contact our support team.",
+                "references": ["domain_suspension_policy.txt"],
+                "action_required": "escalate_to_abuse_team"
+            }
+        },
+        {
+            "query": "I can't remember my password. What should I do?",
+            "context_summary": "Document: account_recovery.txt - Provides account recovery and password reset procedures",
+            "response": {
+                "answer": "To recover your account, use the password reset link on the login page. If you don't receive the email, check your spam folder or contact support.",
+                "references": ["account_recovery.txt"],
+                "action_required": "follow_up_required"
+            }
+        }
+    ]
+
+    # Input tokens allowed for retrieved context; the most relevant chunks are packed first
+    context_token_budget = config.PromptConfig.context_token_budget
+    min_partial_tokens = config.PromptConfig.min_partial_tokens
+    count_tokens = staticmethod(estimate_tokens)
+    tokenizer_name = "estimate"
+    _prefix = None
+
+    @classmethod
+    def use_tokenizer(cls, name: str, counter):
+        #Measure context with a real tokenizer; chunks indexed with another one need re-indexing
+        cls.tokenizer_name = name
+        cls.count_tokens = staticmethod(counter)
+
+    @classmethod
+    def prompt_prefix(cls) -> str:
+        #Static part of every prompt (role, schema, actions, examples), rendered once
+        if cls._prefix is None:
+            cls._prefix = "\n".join([
+                cls.SYSTEM_ROLE,
+                "",
+                SECTION_RULE,
+                "OUTPUT SCHEMA (respond with valid JSON only):",
+                cls._format_json_schema(),
+                "",
+                SECTION_RULE,
+                "AVAILABLE ACTIONS:",
+                cls._format_actions(),
+                "",
+                SECTION_RULE,
+                "IN-CONTEXT EXAMPLES (follow this pattern):",
+                "",
+                cls._format_few_shot_examples(),
+                "",
+                SECTION_RULE,
+                "KNOWLEDGE BASE DOCUMENTS:",
+                "",
+                "",
+            ])
+        return cls._prefix
+
+    @classmethod
+    def build_prompt(cls, query: str, context_docs: list[dict], token_budget: int = None) -> str:
+        #builds the complete prompt from the cached prefix, the packed context and the query
+        return "".join(cls.build_prompt_parts(query, context_docs, token_budget))
+
+    @classmethod
+    def build_prompt_parts(cls, query: str, context_docs: list[dict], token_budget: int = None) -> tuple[str, str]:
+        #(prefix, suffix): the prefix is byte-identical for every ticket so providers can cache it
+        try:
+            # Validate inputs
+            if not query or not isinstance(query, str):
+                raise ValueError("Query must be a non-empty string")
+            
+            if not context_docs or not isinstance(context_docs, list):
+                raise ValueError("Context docs must be a non-empty list")
+            
+            logger.info(f"Building MCP prompt for query: {query[:50]}...")
+            
+            suffix = "".join([
+                cls._format_context_documents(context_docs, token_budget),
+                "\n\n", SECTION_RULE, "\nCUSTOMER QUERY:\n\n",
+                query,
+                "\n\n", SECTION_RULE, "\nRESPONSE (JSON only):\n",
+            ])
+            
+            logger.info("MCP prompt built successfully")
+            return cls.prompt_prefix(), suffix
+            
+        except ValueError as e:
+            logger.error(f"Invalid input for prompt building: {str(e)}")
+            raise
+        except Exception as e:
+            logger.exception("Error building MCP prompt")
+            raise
+
+    @staticmethod
+    def format_context_block(filename: str, text: str, also_in=()) -> str:
+        #The header names the documents a deduplicated chunk was also found in, so they can be cited
+        name = f"{filename} (also in: {', '.join(also_in)})" if also_in else filename
+        return "".join(["\n[Document: ", name, "]\n", text, "\n", "-" * 50, "\n"])
+
+    @classmethod
+    def chunk_block(cls, chunk: dict, text: str = None) -> str:
+        #Context block of an indexed chunk, optionally with other text
+        meta = chunk['metadata']
+        return cls.format_context_block(meta['filename'], chunk['text'] if text is None else text,
+                                        meta.get('also_in', ()))
+
+    @classmethod
+    def prepare_chunk(cls, chunk: dict) -> dict:
+        #Count the tokens of a chunk's context block once, when it is indexed. The block itself is
+        #rendered when the prompt is packed; storing it would keep every chunk's text twice.
+        chunk['context_tokens'] = cls.count_tokens(cls.chunk_block(chunk))
+        return chunk
+
+    @classmethod
+    def _format_context_documents(cls, context_docs: list[dict], token_budget: int = None) -> str:
+        #pack the most relevant documents first until the token budget is spent
+        if not context_docs:
+            return "[No documents provided]"
+
+        budget = cls.context_token_budget if token_budget is None else token_budget
+        blocks = []
+        for doc in context_docs:
+            chunk = doc['metadata']
+            block = cls.chunk_block(chunk)
+            tokens = chunk.get('context_tokens')
+            if tokens is None:
+                tokens = cls.count_tokens(block)
+
+            if tokens <= budget:
+                blocks.append(block)
+                budget -= tokens
+                continue
+            # Cut the first document that does not fit, unless too little room is left for it to help
+            if budget >= cls.min_partial_tokens or not blocks:
+                blocks.append(cls._truncate_block(chunk, max(budget, cls.min_partial_tokens)))
+            break
+
+        return "".join(blocks)
+
+    @classmethod
+    def _truncate_block(cls, chunk: dict, token_budget: int) -> str:
+        #Longest prefix of the chunk text whose block fits the budget, shrinking a proportional guess
+        text = chunk['text']
+        overhead = cls.count_tokens(cls.chunk_block(chunk, ""))
+        text_tokens = max(cls.count_tokens(text), 1)
+        length = int(len(text) * max(token_budget - overhead, 0) / text_tokens)
+        while length > 0:
+            block = cls.chunk_block(chunk, text[:length])
+            if cls.count_tokens(block) <= token_budget:
+                return block
+            length = int(length * 0.9)
+        return cls.chunk_block(chunk, "")
+    
+    @classmethod
+    def _format_few_shot_examples(cls) -> str:
+        """Format few-shot examples for in-context learning"""
+        return "".join(
+            f"\nEXAMPLE {i}:\n"
+            f"Context: {example['context_summary']}\n"
+            f"Query: {example['query']}\n"
+            f"Response: {cls._dict_to_json(example['response'])}\n"
+            + "-" * 50
+            for i, example in enumerate(cls.FEW_SHOT_EXAMPLES, 1)
+        )
+    
+    @classmethod
+    def _format_actions(cls) -> str:
+        """Format available actions list"""
+        return "\n".join([f"  • {action}" for action in cls.ACTIONS])
+    
+    @classmethod
+    def _format_json_schema(cls) -> str:
+        """Format JSON schema for clarity"""
+        return """{
+  "answer": "string - your response based on context only",
+  "references": ["array of document filenames used, including the ones a used document is also in"],
+  "action_required": "one of: none|escalate_to_abuse_team|escalate_to_legal_team|escalate_to_sales_team|follow_up_required"
+}"""
+    
+    @classmethod
+    def _dict_to_json(cls, data: dict) -> str:
+        """Convert dict to JSON string"""
+        return json.dumps(data, indent=2)
     
\ No newline at end of file
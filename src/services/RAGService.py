@@ -1,74 +1,285 @@
-from typing import List, Optional
-from PromptBuilder import PromptBuilder
-import config
-from logger_config import get_logger
-import numpy as np
-
-
-class RAGAgent:
-    #RAG Agent class to carry out user queries and return responses
-
-    def __init__(
-        self,
-        llm_service,
-        vector_store,
-        embedding_service,
-        output_schema: config.TicketResponse,
-    ):
-        self.llm = llm_service
-        self.vector_store = vector_store
-        self.embedding_service = embedding_service
-        self.prompter = PromptBuilder()
-        self.logger = get_logger(__name__)
-
-        self.logger.info("RAG Agent initialized")
-
-
-    def embed_query(self, query: str) -> List[float]:
-        try:
-            self.logger.info("Embedding user query")
-            embedding = self.embedding_service.embed_query(query)
-            return embedding
-        except Exception as e:
-            self.logger.exception("Failed to embed query", exc_info=True)
-
-
-    def retrieve_documents(self, embedding: List[float], top_k: int = 5) -> List[dict]:
-        #retrieve docs from vector store
-        try:
-            self.logger.info("Retrieving documents from vector store")
-            docs = self.vector_store.search(embedding, top_k=top_k)
-            return docs
-        except Exception as e:
-            self.logger.exception("Vector store retrieval failed", exc_info=True)
-
-
-    def check_relevancy(self, retrieved_docs: List[dict], threshold: float = 0.6) -> bool:
-        #check if retrieved docs are relevant enough
-        if not retrieved_docs:
-            return False
-
-        score = sum(r['score'] for r in retrieved_docs) / len(retrieved_docs)
-        self.logger.info(f"Average document score: {score}")
-
-        return score >= threshold
-    
-
-    async def answer_query(self, query: str, top_k: int = 5) -> config.TicketResponse:
-        #RAG Pipeline
-        try:
-            embedding = self.embed_query([query])
-            docs = self.retrieve_documents(embedding, top_k=top_k)
-            relevant = self.check_relevancy(docs)
-            if not relevant:
-                self.logger.info("No relevant documents found")
-                return config.TicketResponse(
-                    answer="I'm sorry, but I couldn't find relevant information to answer your question.",
-                    references=[],
-                    action_required="follow_up_required"
-                )
-            prompt = self.prompter.build_prompt(query, docs)
-            response = await self.llm.generate(prompt, config.TicketResponse)
-            return response
-        except Exception as e:
-            self.logger.exception("Unexpected RAG error", exc_info=True)
\ No newline at end of file
+import asyncio
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
+from PromptBuilder import PromptBuilder
+import config
+from logger_config import get_logger
+from EmbeddingBatcher import EmbeddingQueueFull
+from StageTimings import StageTimings
+import numpy as np
+
+
+class RAGAgent:
+    #RAG Agent class to carry out user queries and return responses
+
+    def __init__(
+        self,
+        llm_service,
+        vector_store,
+        embedding_service,
+        output_schema: config.TicketResponse,
+        cache=None,
+        batcher=None,
+        relevance_config: config.RelevanceGateConfig = None,
+        reranker=None,
+    ):
+        self.llm = llm_service
+        self.vector_store = vector_store
+        self.embedding_service = embedding_service
+        self.cache = cache
+        self.batcher = batcher
+        self.relevance_config = relevance_config or config.RelevanceGateConfig()
+        self.reranker = reranker
+        self.prompter = PromptBuilder()
+        self.logger = get_logger(__name__)
+
+        self.llm_calls = 0
+        # LLM calls skipped, by the reason they were not needed
+        self.llm_calls_avoided = {"relevance_gate": 0, "answer_cache": 0}
+
+        self.logger.info("RAG Agent initialized")
+
+
+    def embed_query(self, query: str) -> List[float]:
+        try:
+            self.logger.info("Embedding user query")
+            embedding = self.embedding_service.embed_query(query)
+            return embedding
+        except Exception as e:
+            self.logger.exception("Failed to embed query", exc_info=True)
+
+
+    def retrieve_documents(self, embedding: List[float], top_k: int = 5, query: str = None) -> List[dict]:
+        #retrieve docs from vector store; with the query text, keyword matches are fused in
+        try:
+            self.logger.info("Retrieving documents from vector store")
+            docs = self.vector_store.search(embedding, top_k=top_k, query_text=query)
+            return docs
+        except Exception as e:
+            self.logger.exception("Vector store retrieval failed", exc_info=True)
+
+
+    def candidate_count(self, top_k: int) -> int:
+        #Chunks to retrieve per query; the reranker needs a larger pool to choose from
+        return max(top_k, self.reranker.candidates) if self.reranker is not None else top_k
+
+
+    async def rerank_documents(self, query: str, docs: List[dict], top_k: int = 5) -> List[dict]:
+        #Keep the best chunks by cross-encoder score; scoring runs off the event loop
+        if self.reranker is None or not docs:
+            return docs[:top_k] if docs else docs
+        with StageTimings.stage("rerank"):
+            return await asyncio.to_thread(self.reranker.rerank, query, docs, min(top_k, self.reranker.top_n))
+
+
+    async def embed_and_retrieve(self, query: str, top_k: int = 5):
+        #Query embedding and retrieval shared by answer_query and answer_query_stream
+        with StageTimings.stage("embed"):
+            if self.batcher is not None:
+                # Coalesced with concurrent tickets into one encode call, off the event loop
+                embedding = await self.batcher.embed_query(query)
+            else:
+                embedding = self.embed_query(query)
+        with StageTimings.stage("search"):
+            docs = self.retrieve_documents(embedding, top_k=self.candidate_count(top_k), query=query)
+        return embedding, docs
+
+
+    def check_relevancy(self, retrieved_docs: List[dict], threshold: float = None, rule: str = None) -> bool:
+        #check if retrieved docs are relevant enough; scores are cosine similarities, higher is better
+        if not retrieved_docs:
+            return False
+
+        threshold = self.relevance_config.threshold if threshold is None else threshold
+        rule = rule or self.relevance_config.rule
+        scores = np.array([r['score'] for r in retrieved_docs], dtype=np.float32)
+        best = float(scores.max())
+
+        if rule == "max":
+            relevant = best >= threshold
+        elif rule == "mean":
+            relevant = float(scores.mean()) >= threshold
+        elif rule == "margin":
+            # Off-topic queries tend to score every chunk about the same
+            margin = best - float(np.median(scores))
+            relevant = best >= threshold and (len(scores) == 1 or margin >= self.relevance_config.min_margin)
+        else:
+            raise ValueError(f"Unknown relevance rule {rule!r}")
+
+        self.logger.info(f"Document scores: best={best:.3f} mean={float(scores.mean()):.3f} "
+                         f"({rule} rule, threshold {threshold}): {'relevant' if relevant else 'not relevant'}")
+        return relevant
+
+    def stats(self) -> dict:
+        return {
+            "llm_calls": self.llm_calls,
+            "llm_calls_avoided": dict(self.llm_calls_avoided),
+        }
+
+
+    async def answer_query(self, query: str, top_k: int = 5) -> config.TicketResponse:
+        #RAG Pipeline
+        try:
+            embedding, docs = await self.embed_and_retrieve(query, top_k)
+            docs = await self.rerank_documents(query, docs, top_k)
+            return await self.answer_from_documents(query, embedding, docs)
+        except EmbeddingQueueFull:
+            self.logger.warning("Embedding queue full, rejecting query")
+            raise
+        except Exception as e:
+            self.logger.exception("Unexpected RAG error", exc_info=True)
+
+
+    async def answer_queries(self, queries: List[str], top_k: int = 5, max_concurrency: int = 4) -> list:
+        #Batch pipeline: one encode call, one index search, bounded concurrent LLM calls.
+        #Returns one entry per query, in order: the response, or the exception that query raised.
+        results = [None] * len(queries)
+        valid = [i for i, q in enumerate(queries) if q and q.strip()]
+        for i in set(range(len(queries))).difference(valid):
+            results[i] = ValueError("Unable to process empty query")
+        if not valid:
+            return results
+
+        self.logger.info(f"Embedding {len(valid)} queries in one batch")
+        with StageTimings.stage("embed"):
+            embeddings = await asyncio.to_thread(self.embedding_service.embed_queries, [queries[i] for i in valid])
+        self.logger.info("Retrieving documents for the batch from vector store")
+        with StageTimings.stage("search"):
+            docs_per_query = self.vector_store.search_batch(embeddings, top_k=self.candidate_count(top_k),
+                                                            query_texts=[queries[i] for i in valid])
+        if len(docs_per_query) != len(valid):
+            raise RuntimeError("Vector store batch search failed")
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(row: int, i: int):
+            async with semaphore:
+                docs = await self.rerank_documents(queries[i], docs_per_query[row], top_k)
+                return await self.answer_from_documents(queries[i], embeddings[row:row + 1], docs)
+
+        answers = await asyncio.gather(*[answer(row, i) for row, i in enumerate(valid)], return_exceptions=True)
+        for i, answer_or_error in zip(valid, answers):
+            results[i] = answer_or_error
+        return results
+
+
+    @staticmethod
+    def no_relevant_documents_response() -> config.TicketResponse:
+        return config.TicketResponse(
+            answer="I'm sorry, but I couldn't find relevant information to answer your question.",
+            references=[],
+            action_required="follow_up_required"
+        )
+
+
+    def _cached_answer(self, embedding, chunk_ids) -> Optional[dict]:
+        # Paraphrases of an answered ticket that retrieve the same chunks reuse its answer
+        if self.cache is None:
+            return None
+        cached = self.cache.lookup(embedding, chunk_ids, getattr(self.vector_store, 'version', None))
+        if cached is not None:
+            self.llm_calls_avoided["answer_cache"] += 1
+        return cached
+
+
+    def _store_answer(self, embedding, chunk_ids, response):
+        if self.cache is not None and response:
+            self.cache.store(embedding, chunk_ids, response, getattr(self.vector_store, 'version', None))
+
+
+    async def answer_from_documents(self, query: str, embedding, docs: List[dict]) -> config.TicketResponse:
+        #Relevancy gate, answer cache and LLM call for an already retrieved query.
+        with StageTimings.stage("gate"):
+            relevant = self.check_relevancy(docs)
+        if not relevant:
+            self.logger.info("No relevant documents found, skipping LLM call")
+            self.llm_calls_avoided["relevance_gate"] += 1
+            return self.no_relevant_documents_response()
+
+        chunk_ids = [d.get('id') for d in docs]
+        with StageTimings.stage("cache"):
+            cached = self._cached_answer(embedding, chunk_ids)
+        if cached is not None:
+            return cached
+
+        # The static prefix is uploaded to the provider's context cache once and referenced after that
+        with StageTimings.stage("prompt"):
+            prefix, prompt = self.prompter.build_prompt_parts(query, docs)
+        self.llm_calls += 1
+        with StageTimings.stage("llm"):
+            response = await self.llm.generate(prompt, config.TicketResponse, prefix=prefix)
+        response = self.with_duplicate_references(response, docs)
+        self._store_answer(embedding, chunk_ids, response)
+        return response
+
+
+    @staticmethod
+    def with_duplicate_references(response, docs: List[dict]):
+        #Follow every cited document with the documents whose near-duplicate chunks were dropped in
+        #favour of its chunk; the model may cite only the indexed name
+        if not isinstance(response, dict) or not response.get("references"):
+            return response
+        also_in = {}
+        for d in docs:
+            meta = d['metadata'].get('metadata') or {}
+            if meta.get('also_in'):
+                also_in.setdefault(meta.get('filename'), []).extend(meta['also_in'])
+        references = list(dict.fromkeys(name for cited in response["references"]
+                                        for name in [cited, *also_in.get(cited, ())]))
+        return dict(response, references=references)
+
+
+    @staticmethod
+    def describe_documents(docs: List[dict]) -> dict:
+        #Retrieval results as sent to streaming clients before the answer is ready
+        documents = [{
+            "id": d.get('id'),
+            "name": d['metadata']['metadata']['filename'],
+            # Documents holding near-duplicates of this chunk that were not indexed separately
+            "also_in": d['metadata']['metadata'].get('also_in', []),
+            "score": d['score'],
+        } for d in docs]
+        return {
+            "references": list(dict.fromkeys(name for d in documents for name in [d["name"], *d["also_in"]])),
+            "documents": documents,
+        }
+
+
+    async def answer_query_stream(self, query: str, top_k: int = 5) -> AsyncIterator[tuple[str, object]]:
+        #Streaming RAG pipeline. Yields ("references", ...) as soon as retrieval is done,
+        #("answer", text) pieces while the model writes the answer, then ("result", response).
+        embedding, docs = await self.embed_and_retrieve(query, top_k)
+        docs = await self.rerank_documents(query, docs or [], top_k)
+        yield "references", self.describe_documents(docs)
+
+        with StageTimings.stage("gate"):
+            relevant = self.check_relevancy(docs)
+        if not relevant:
+            self.logger.info("No relevant documents found, skipping LLM call")
+            self.llm_calls_avoided["relevance_gate"] += 1
+            yield "result", self.no_relevant_documents_response()
+            return
+
+        chunk_ids = [d.get('id') for d in docs]
+        with StageTimings.stage("cache"):
+            cached = self._cached_answer(embedding, chunk_ids)
+        if cached is not None:
+            yield "answer", cached["answer"]
+            yield "result", cached
+            return
+
+        with StageTimings.stage("prompt"):
+            prefix, prompt = self.prompter.build_prompt_parts(query, docs)
+        self.llm_calls += 1
+        response = None
+        # Time spent by the client reading the answer pieces is not LLM time
+        stream = StageTimings.stream("llm", self.llm.generate_stream(prompt, config.TicketResponse, prefix=prefix))
+        async with aclosing(stream):
+            async for kind, payload in stream:
+                if kind == "delta":
+                    yield "answer", payload
+                else:
+                    response = payload
+        response = self.with_duplicate_references(response, docs)
+        self._store_answer(embedding, chunk_ids, response)
+        yield "result", response
@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import List
+import numpy as np
+from sentence_transformers import CrossEncoder
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class Reranker:
+    #Rescores retrieved chunks against the query with a cross-encoder and keeps the best ones.
+    #Scoring runs in batches; once the time budget is spent the dense order is kept instead.
+
+    def __init__(
+        self,
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        top_n: int = 3,
+        candidates: int = 20,
+        batch_size: int = 16,
+        budget_ms: float = 150.0,
+        max_length: int = 256,
+        model=None,
+    ):
+        self.model_name = model_name
+        self.top_n = top_n
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.model = model if model is not None else CrossEncoder(model_name, max_length=max_length)
+
+        self._lock = threading.Lock()
+        self.reranked = 0
+        self.fallbacks = 0
+        self.errors = 0
+        self.total_ms = 0.0
+
+    @staticmethod
+    def passage(doc: dict) -> str:
+        #Text the cross-encoder reads for a retrieved chunk
+        meta = doc['metadata']
+        filename = (meta.get('metadata') or {}).get('filename')
+        text = meta.get('text', '')
+        return f"{filename}: {text}" if filename else text
+
+    def rerank(self, query: str, docs: List[dict], top_n: int = None) -> List[dict]:
+        #Best top_n docs by cross-encoder score, each with a rerank_score; the dense top_n on timeout or error
+        top_n = self.top_n if top_n is None else top_n
+        if len(docs) <= 1:
+            return docs[:top_n]
+
+        start = time.perf_counter()
+        deadline = start + self.budget_ms / 1000.0
+        pairs = [(query, self.passage(doc)) for doc in docs]
+        scores = []
+        try:
+            for i in range(0, len(pairs), self.batch_size):
+                if time.perf_counter() >= deadline:
+                    break
+                batch = self.model.predict(pairs[i:i + self.batch_size], batch_size=self.batch_size,
+                                           show_progress_bar=False, convert_to_numpy=True)
+                scores.extend(np.asarray(batch, dtype=np.float32).reshape(-1).tolist())
+        except Exception as e:
+            logger.error(f"Reranking failed, keeping dense order: {e}")
+            with self._lock:
+                self.errors += 1
+            return docs[:top_n]
+
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        with self._lock:
+            self.total_ms += elapsed_ms
+            if len(scores) < len(docs):
+                self.fallbacks += 1
+            else:
+                self.reranked += 1
+
+        if len(scores) < len(docs):
+            logger.warning(f"Reranking {len(docs)} chunks exceeded the {self.budget_ms}ms budget "
+                           f"after {len(scores)}, keeping dense order")
+            return docs[:top_n]
+
+        order = np.argsort(-np.asarray(scores), kind="stable")[:top_n]
+        logger.info(f"Reranked {len(docs)} chunks in {elapsed_ms:.1f}ms")
+        return [dict(docs[i], rerank_score=scores[i]) for i in order]
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = self.reranked + self.fallbacks
+            return {
+                "model": self.model_name,
+                "reranked": self.reranked,
+                "budget_fallbacks": self.fallbacks,
+                "errors": self.errors,
+                "mean_ms": self.total_ms / calls if calls else 0.0,
+            }
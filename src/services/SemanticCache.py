@@ -0,0 +1,150 @@
+import copy
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Optional
+import numpy as np
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class CacheEntry:
+    __slots__ = ("embedding", "doc_key", "response", "created_at", "nbytes")
+
+    def __init__(self, embedding: np.ndarray, doc_key: tuple, response: dict):
+        self.embedding = embedding
+        self.doc_key = doc_key
+        self.response = response
+        self.created_at = time.monotonic()
+        # Rough footprint: vector + serialized answer + key and bookkeeping
+        self.nbytes = (embedding.nbytes + len(json.dumps(response))
+                       + sys.getsizeof(doc_key) + 8 * len(doc_key) + 256)
+
+
+class SemanticCache:
+    #Answer cache keyed on the query embedding and the chunk ids retrieved for it.
+    #A lookup hits when a cached query is similar enough AND was answered from the same chunks.
+
+    def __init__(
+        self,
+        similarity_threshold: float = 0.95,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600.0,
+        max_bytes: int = 32 * 1024 * 1024,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        # Chunk-id set -> keys of entries answered from it; narrows the similarity scan
+        self._by_docs = {}
+        self._keys = count()
+        self._lock = threading.Lock()
+        self.index_version = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _doc_key(chunk_ids) -> tuple:
+        return tuple(sorted(chunk_ids))
+
+    def _check_version(self, index_version):
+        #Answers from an older index may cite chunks that no longer exist
+        if index_version != self.index_version:
+            if self._entries:
+                logger.info(f"Index version changed, dropping {len(self._entries)} cached answers")
+            self._entries.clear()
+            self._by_docs.clear()
+            self.nbytes = 0
+            self.index_version = index_version
+
+    def _expired(self, entry: CacheEntry, now: float) -> bool:
+        return self.ttl_seconds is not None and now - entry.created_at > self.ttl_seconds
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        keys = self._by_docs[entry.doc_key]
+        keys.discard(key)
+        if not keys:
+            del self._by_docs[entry.doc_key]
+        self.nbytes -= entry.nbytes
+
+    def lookup(self, embedding, chunk_ids, index_version=None) -> Optional[dict]:
+        #Return a cached answer for a similar query backed by the same chunks, or None.
+        query = self._normalize(embedding)
+        doc_key = self._doc_key(chunk_ids)
+        now = time.monotonic()
+
+        with self._lock:
+            self._check_version(index_version)
+
+            best_key, best_score = None, self.similarity_threshold
+            for key in list(self._by_docs.get(doc_key, ())):
+                entry = self._entries[key]
+                if self._expired(entry, now):
+                    self._drop(key)
+                    self.evictions += 1
+                    continue
+                score = float(np.dot(query, entry.embedding))
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            logger.info(f"Semantic cache hit (similarity={best_score:.3f})")
+            return copy.deepcopy(self._entries[best_key].response)
+
+    def store(self, embedding, chunk_ids, response: dict, index_version=None):
+        #Cache an answer, evicting least recently used entries to stay within bounds.
+        entry = CacheEntry(self._normalize(embedding), self._doc_key(chunk_ids), copy.deepcopy(response))
+        if entry.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            self._check_version(index_version)
+
+            key = next(self._keys)
+            self._entries[key] = entry
+            self._by_docs.setdefault(entry.doc_key, set()).add(key)
+            self.nbytes += entry.nbytes
+
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_docs.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "index_version": self.index_version,
+            }
@@ -0,0 +1,95 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
+import Metrics
+
+
+_current: ContextVar[Optional["StageTimings"]] = ContextVar("stage_timings", default=None)
+
+
+class StageTimings:
+    #Wall time per pipeline stage of one request. The request handler calls begin(); code anywhere
+    #below it records with StageTimings.stage(name), or StageTimings.stream(name, items) for a stage
+    #that hands out results while it runs. Every stage is also observed in the
+    #rag_stage_seconds histogram, inside a request or not.
+    #Tasks and threads started for the request copy the context, so they record into the same object;
+    #in a batch the stage times of all its tickets add up.
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # stage -> seconds, in the order the stages first ran
+        self.stages: dict[str, float] = {}
+        # The stage that raised, if any
+        self.failed: Optional[str] = None
+
+    @classmethod
+    def begin(cls) -> "StageTimings":
+        timings = cls()
+        _current.set(timings)
+        return timings
+
+    @staticmethod
+    def current() -> Optional["StageTimings"]:
+        return _current.get()
+
+    @staticmethod
+    def record(name: str, seconds: float, failed: bool = False):
+        timings = _current.get()
+        Metrics.observe_stage(name, seconds)
+        if timings is not None:
+            timings.stages[name] = timings.stages.get(name, 0.0) + seconds
+            if failed:
+                timings.failed = timings.failed or name
+
+    @staticmethod
+    @contextmanager
+    def stage(name: str):
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            StageTimings.record(name, time.perf_counter() - start, failed)
+
+    @staticmethod
+    async def stream(name: str, items: AsyncIterator):
+        #Pass on the items of an async iterator as one stage. Only the waits for the next item count,
+        #not the time the consumer spends between items; `items` is closed along with this generator.
+        seconds = 0.0
+        failed = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = await anext(items)
+                except StopAsyncIteration:
+                    return
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            StageTimings.record(name, seconds, failed)
+            aclose = getattr(items, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def header(self) -> str:
+        #Server-Timing header value, durations in milliseconds; the failed stage carries desc="failed"
+        entries = []
+        for name, seconds in self.stages.items():
+            entry = f"{name};dur={seconds * 1000.0:.2f}"
+            if name == self.failed:
+                entry += ';desc="failed"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.total() * 1000.0:.2f}")
+        return ", ".join(entries)
@@ -1,76 +1,246 @@
-import os
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from typing import List
-from logger_config import get_logger
-
-logger = get_logger(__name__)
-
-class FileLoader:
-    def __init__(self, directory: str = "data"):
-        self.directory = directory
-
-    def load_files(self):
-        #Load all .txt files from the specified directory.
-        files = []
-        if not os.path.exists(self.directory):
-            logger.error(f"Directory does not exist: {self.directory}")
-            return files
-
-        for root, _, filenames in os.walk(self.directory):
-            for fname in filenames:
-                if fname.lower().endswith('.txt'):
-                    path = os.path.join(root, fname)
-                    try:
-                        with open(path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            files.append((os.path.splitext(fname)[0].replace("_", " ").title(), content))
-                            logger.info(f"Loaded file: {path}")
-                    except Exception as e:
-                        logger.error(f"Failed to load file {path}: {e}")
-        if not files:
-            logger.warning("No text files found in directory.")
-        return files
-
-      
-class TextChunker:
-    def __init__(self, documents: List[dict]=None, chunk_size: int=1000, chunk_overlap: int=100):
-      if documents is None:
-          raise ValueError("documents must be provided")
-
-      if not documents:
-          raise ValueError("documents list is empty")
-
-      self.documents = documents
-      self.chunk_size = chunk_size
-      self.chunk_overlap = chunk_overlap
-      self.text_splitter = RecursiveCharacterTextSplitter(
-          chunk_size=self.chunk_size,
-          chunk_overlap=self.chunk_overlap
-      )
-
-    def split_into_chunks(self, filename: str, text: str) -> List[dict]:
-        #Split a single document into chunks with metadata.
-        metadata = {
-            'filename': filename,
-        }
-
-        try:
-            chunks = self.text_splitter.split_text(text)
-            logger.info(f"Split {filename} into {len(chunks)} chunks.")
-            return [{'text': chunk, 'metadata': metadata} for chunk in chunks]
-        except Exception as e:
-            logger.error(f"Failed to split file {filename}: {e}")
-            return []
-
-    def split_docs(self) -> List[dict]:
-        #Split all loaded documents into chunks.
-        all_chunks = []
-        try:
-          for fname, content in self.documents:
-              chunks = self.split_into_chunks(fname, content)
-              all_chunks.extend(chunks)
-          logger.info(f"Total chunks generated: {len(all_chunks)}")
-          return all_chunks
-        except Exception as e:
-            logger.error(f"Failed to split file: {e}")
-            return []
\ No newline at end of file
+import hashlib
+import mmap
+import os
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from typing import Iterator, List
+import numpy as np
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+class FileLoader:
+    def __init__(self, directory: str = "data"):
+        self.directory = directory
+
+    def list_files(self) -> List[str]:
+        #List all .txt files under the directory in a stable order.
+        paths = []
+        if not os.path.exists(self.directory):
+            return paths
+
+        for root, _, filenames in os.walk(self.directory):
+            for fname in filenames:
+                if fname.lower().endswith('.txt'):
+                    paths.append(os.path.join(root, fname))
+        return sorted(paths)
+
+    @staticmethod
+    def document_name(path: str) -> str:
+        #Human readable document name used as the chunk filename metadata.
+        return os.path.splitext(os.path.basename(path))[0].replace("_", " ").title()
+
+    def load_files(self):
+        #Load all .txt files from the specified directory.
+        files = []
+        if not os.path.exists(self.directory):
+            logger.error(f"Directory does not exist: {self.directory}")
+            return files
+
+        for path in self.list_files():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                    files.append((self.document_name(path), content))
+                    logger.info(f"Loaded file: {path}")
+            except Exception as e:
+                logger.error(f"Failed to load file {path}: {e}")
+        if not files:
+            logger.warning("No text files found in directory.")
+        return files
+
+      
+class TextChunker:
+    def __init__(self, documents: List[dict]=None, chunk_size: int=1000, chunk_overlap: int=100):
+      if documents is None:
+          raise ValueError("documents must be provided")
+
+      if not documents:
+          raise ValueError("documents list is empty")
+
+      self.documents = documents
+      self.chunk_size = chunk_size
+      self.chunk_overlap = chunk_overlap
+      self.text_splitter = RecursiveCharacterTextSplitter(
+          chunk_size=self.chunk_size,
+          chunk_overlap=self.chunk_overlap
+      )
+
+    def split_into_chunks(self, filename: str, text: str) -> List[dict]:
+        #Split a single document into chunks with metadata.
+        metadata = {
+            'filename': filename,
+        }
+
+        try:
+            chunks = self.text_splitter.split_text(text)
+            logger.info(f"Split {filename} into {len(chunks)} chunks.")
+            return [{'text': chunk, 'metadata': metadata} for chunk in chunks]
+        except Exception as e:
+            logger.error(f"Failed to split file {filename}: {e}")
+            return []
+
+    def split_docs(self) -> List[dict]:
+        #Split all loaded documents into chunks.
+        all_chunks = []
+        try:
+          for fname, content in self.documents:
+              chunks = self.split_into_chunks(fname, content)
+              all_chunks.extend(chunks)
+          logger.info(f"Total chunks generated: {len(all_chunks)}")
+          return all_chunks
+        except Exception as e:
+            logger.error(f"Failed to split file: {e}")
+            return []
+
+
+class ChildChunker:
+    #Splits indexed (parent) chunks into the smaller child chunks that are embedded. A child records its
+    #parent's id, and its own id is derived from the parent's, so children stay stable with their parent.
+
+    def __init__(self, chunk_size: int = 250, chunk_overlap: int = 50):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    @staticmethod
+    def child_id(parent_id: int, position: int) -> int:
+        digest = hashlib.blake2b(f"{parent_id}\0{position}".encode("utf-8"), digest_size=8).digest()
+        # FAISS ids are signed 64-bit
+        return int.from_bytes(digest, "big") & ((1 << 63) - 1)
+
+    def split(self, parent_ids: List[int], parents: List[dict]) -> tuple[List[int], List[dict]]:
+        ids, children = [], []
+        for parent_id, parent in zip(parent_ids, parents):
+            metadata = {'filename': parent['metadata']['filename']}
+            for position, text in enumerate(self.text_splitter.split_text(parent['text'])):
+                ids.append(self.child_id(parent_id, position))
+                children.append({'text': text, 'metadata': metadata, 'parent': parent_id})
+        return ids, children
+
+
+class StreamingTextChunker:
+    #Chunks one file like TextChunker (RecursiveCharacterTextSplitter with its default separators)
+    #without loading it: the file is memory-mapped, separators are searched in byte ranges of the map and
+    #only the text of finished chunks is decoded. Splits are contiguous ranges of the text (separators are
+    #kept at their start), so a merged chunk is a byte range too and memory stays at a few chunks.
+
+    SEPARATORS = ("\n\n", "\n", " ", "")
+
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 100, block_size: int = 1 << 20):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.block_size = block_size
+
+    @contextmanager
+    def _open_text(self, path: str):
+        #UTF-8 text of the file as TextChunker reads it. Text mode turns \r\n and \r into \n, so a file
+        #containing \r is first copied with its newlines translated, in blocks, to a temporary file.
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data.find(b"\r") < 0:
+                    yield data
+                    return
+        with open(path, "r", encoding="utf-8") as src, tempfile.TemporaryFile() as tmp:
+            for block in iter(lambda: src.read(self.block_size), ""):
+                tmp.write(block.encode("utf-8"))
+            tmp.flush()
+            with mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    def split_file(self, path: str, filename: str = None) -> Iterator[dict]:
+        #Lazily yield the chunks of a file with their byte offsets (start_byte, end_byte) in its text;
+        #these are file offsets unless the file has \r line endings
+        metadata = {'filename': filename or FileLoader.document_name(path)}
+        count = 0
+        with self._open_text(path) as data:
+            for start, end, strip in self._split(data, 0, len(data), self.SEPARATORS):
+                text = data[start:end].decode("utf-8")
+                if strip:
+                    stripped = text.strip()
+                    if not stripped:
+                        continue
+                    lead = len(text) - len(text.lstrip())
+                    start += len(text[:lead].encode("utf-8"))
+                    end = start + len(stripped.encode("utf-8"))
+                    text = stripped
+                count += 1
+                yield {'text': text, 'metadata': metadata, 'start_byte': start, 'end_byte': end}
+        logger.info(f"Split {metadata['filename']} into {count} chunks.")
+
+    def _split(self, data, start: int, end: int, separators: tuple):
+        #(start, end, strip) of the chunks of data[start:end], following RecursiveCharacterTextSplitter._split_text
+        separator, rest = "", ()
+        for i, candidate in enumerate(separators):
+            if not candidate:
+                break
+            if data.find(candidate.encode("utf-8"), start, end) >= 0:
+                separator, rest = candidate, separators[i + 1:]
+                break
+
+        # Splits shorter than chunk_size are merged with the ones next to them; longer ones are split
+        # again with the remaining separators
+        current, total = deque(), 0
+        for piece_start, piece_end, length in self._pieces(data, start, end, separator):
+            if length < self.chunk_size:
+                if total + length > self.chunk_size:
+                    if current:
+                        yield current[0][0], current[-1][1], True
+                        while total > self.chunk_overlap or (total + length > self.chunk_size and total > 0):
+                            total -= current.popleft()[2]
+                current.append((piece_start, piece_end, length))
+                total += length
+                continue
+            if current:
+                yield current[0][0], current[-1][1], True
+                current, total = deque(), 0
+            if rest:
+                yield from self._split(data, piece_start, piece_end, rest)
+            else:
+                yield piece_start, piece_end, False
+        if current:
+            yield current[0][0], current[-1][1], True
+
+    def _pieces(self, data, start: int, end: int, separator: str):
+        #(start, end, length in characters) of each split, every one but the first starting with the separator
+        if not separator:
+            yield from self._characters(data, start, end)
+            return
+        pattern = separator.encode("utf-8")
+        piece_start = start
+        position = data.find(pattern, start, end)
+        while position >= 0:
+            if position > piece_start:
+                yield piece_start, position, self._length(data, piece_start, position)
+            piece_start = position
+            position = data.find(pattern, position + len(pattern), end)
+        if end > piece_start:
+            yield piece_start, end, self._length(data, piece_start, end)
+
+    def _length(self, data, start: int, end: int) -> int:
+        #Characters in a UTF-8 byte range: every byte that is not a continuation byte starts one
+        if end - start <= self.block_size:
+            return len(data[start:end].decode("utf-8"))
+        length = 0
+        for offset in range(start, end, self.block_size):
+            block = np.frombuffer(data, dtype=np.uint8, count=min(self.block_size, end - offset), offset=offset)
+            length += len(block) - int(np.count_nonzero((block & 0xC0) == 0x80))
+        return length
+
+    def _characters(self, data, start: int, end: int):
+        #Single characters of a range, decoded a block at a time
+        position = start
+        while position < end:
+            stop = min(position + self.block_size, end)
+            while stop < end and data[stop] & 0xC0 == 0x80:
+                stop -= 1
+            for char in data[position:stop].decode("utf-8"):
+                size = 1 if char < "\x80" else len(char.encode("utf-8"))
+                yield position, position + size, 1
+                position += size
@@ -1,80 +1,463 @@
-import faiss
-import pickle
-import os
-from logger_config import get_logger
-
-logger = get_logger(__name__)
-
-class VectorStore:
-    def __init__(self, embedding_dim: int = 384):
-        self.embedding_dim = embedding_dim
-        self.index = faiss.IndexFlatL2(embedding_dim)
-        self.metadata = []
-
-        logger.info(f"Initialized FAISS index with dim={embedding_dim}")
-
-    def add(self, embeddings, metadatas):
-        #add embeddings to the index
-        if len(embeddings) != len(metadatas):
-            raise ValueError("Embeddings and metadata length mismatch")
-
-        try:
-            self.index.add(embeddings)
-            self.metadata.extend(metadatas)
-            logger.info(f"Added {len(embeddings)} vectors. Total: {self.index.ntotal}")
-        except Exception as e:
-            logger.error(f"Failed adding vectors: {e}")
-            raise
-
-    def search(self, query_embedding, top_k=5):
-        #search for similar vectors in the index
-        try:
-            distances, indices = self.index.search(query_embedding, top_k)
-
-            results = []
-            for dist, idx in zip(distances[0], indices[0]):
-                if idx < len(self.metadata):
-                    results.append({
-                        "score": float(dist),
-                        "metadata": self.metadata[idx]
-                    })
-
-            return results
-
-        except Exception as e:
-            logger.error(f"FAISS search failed: {e}")
-            return []
-
-
-    def save(self, path="faiss_store"):
-        #save faiss index to disk
-        try:
-            os.makedirs(path, exist_ok=True)
-
-            faiss.write_index(self.index, f"{path}/index.faiss")
-
-            with open(f"{path}/metadata.pkl", "wb") as f:
-                pickle.dump(self.metadata, f)
-
-            logger.info(f"FAISS store saved to {path}")
-
-        except Exception as e:
-            logger.error(f"Failed saving FAISS store: {e}")
-            raise
-
-
-    def load(self, path="faiss_store"):
-        #load faiss index from disk
-        try:
-            self.index = faiss.read_index(f"{path}/index.faiss")
-
-            with open(f"{path}/metadata.pkl", "rb") as f:
-                self.metadata = pickle.load(f)
-
-            logger.info(
-                f"Loaded FAISS store from {path}. Total vectors: {self.index.ntotal}"
-            )
-
-        except Exception as e:
-            logger.error(f"Failed loading FAISS store: {e}")
-            raise
\ No newline at end of file
+import faiss
+import json
+import numpy as np
+import os
+import threading
+import config
+from BM25Index import BM25Index
+from ChunkStore import ChunkStore, write_atomic
+from logger_config import get_logger
+
+logger = get_logger(__name__)
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+IVF_TYPES = ("ivf_flat", "ivf_pq")
+# k-means wants roughly this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+# Vectors are L2-normalized, so inner product is cosine similarity and higher scores are better
+METRIC = "inner_product"
+
+
+class VectorStore:
+    def __init__(self, embedding_dim: int = 384, index_config: config.VectorStoreConfig = None,
+                 hybrid_config: config.HybridSearchConfig = None):
+        self.embedding_dim = embedding_dim
+        self.index_config = index_config or config.VectorStoreConfig()
+        self.hybrid_config = hybrid_config or config.HybridSearchConfig()
+        if self.index_config.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {self.index_config.index_type!r}, "
+                             f"expected one of {', '.join(INDEX_TYPES)}")
+        if self.index_config.index_type == "ivf_pq" and embedding_dim % self.index_config.pq_m:
+            raise ValueError(f"pq_m={self.index_config.pq_m} must divide embedding_dim={embedding_dim}")
+        self.nprobe = self.index_config.nprobe
+        self.ef_search = self.index_config.ef_search
+        # Keyword index over the same chunks, fused with the dense results when a query text is given
+        self.lexical = None
+        if self.hybrid_config.enabled:
+            self.lexical = BM25Index(k1=self.hybrid_config.k1, b=self.hybrid_config.b)
+        self._lock = threading.RLock()
+        # Bumped on every change so caches built on search results can tell they are stale
+        self.version = 0
+        self.reset()
+
+        logger.info(f"Initialized FAISS {self.index_type} index with dim={embedding_dim}")
+
+    def reset(self):
+        #drop all vectors and metadata
+        with self._lock:
+            self.index_type = self.index_config.index_type
+            self.index = self._new_index(self.index_type, self.index_config.nlist)
+            self._apply_search_params()
+            # Chunk id -> chunk, stored column-wise and decoded when a search returns it
+            self.metadata = ChunkStore()
+            # Parent id -> parent chunk, for indexed chunks that are children (their "parent" field)
+            self.parents = ChunkStore()
+            # True while the index is a read-only view of a mapped snapshot file
+            self._mapped = False
+            if self.lexical is not None:
+                self.lexical.clear()
+            self.next_id = 0
+            self.version += 1
+
+    def empty_copy(self) -> "VectorStore":
+        #New empty store with the same settings, e.g. to build a replacement index next to this one
+        return VectorStore(self.embedding_dim, self.index_config, self.hybrid_config)
+
+    def lexical_stats(self):
+        if self.lexical is None:
+            return None
+        with self._lock:
+            return self.lexical.stats()
+
+    def index_params(self) -> dict:
+        #build settings of the configured index; changing any of them means re-indexing
+        cfg = self.index_config
+        params = {"index_type": cfg.index_type, "metric": METRIC}
+        if cfg.index_type in IVF_TYPES:
+            params.update(nlist=cfg.nlist, train_sample_size=cfg.train_sample_size)
+        if cfg.index_type == "hnsw":
+            params.update(hnsw_m=cfg.hnsw_m, ef_construction=cfg.ef_construction)
+        if cfg.index_type == "ivf_pq":
+            params.update(pq_m=cfg.pq_m, pq_nbits=cfg.pq_nbits)
+        return params
+
+    def _new_index(self, index_type: str, nlist: int):
+        cfg = self.index_config
+        d = self.embedding_dim
+        if index_type == "flat":
+            # IDMap2 lets vectors be addressed (and removed) by stable chunk id
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+        if index_type == "hnsw":
+            hnsw = faiss.IndexHNSWFlat(d, cfg.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            hnsw.hnsw.efConstruction = cfg.ef_construction
+            return faiss.IndexIDMap2(hnsw)
+        # IVF indexes store ids themselves
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, cfg.pq_m, cfg.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        # Vectors found only by keyword search are scored by reconstructing them from their id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        #unit-length float32 copy of a (n, dim) matrix; zero vectors stay zero
+        vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def set_search_params(self, nprobe: int = None, ef_search: int = None):
+        #tune the recall/latency trade-off of approximate indexes without rebuilding them
+        with self._lock:
+            if nprobe is not None:
+                self.nprobe = nprobe
+            if ef_search is not None:
+                self.ef_search = ef_search
+            self._apply_search_params()
+
+    def _apply_search_params(self):
+        if self.index_type in IVF_TYPES:
+            index = faiss.extract_index_ivf(self.index)
+            index.nprobe = max(1, min(self.nprobe, index.nlist))
+        elif self.index_type == "hnsw":
+            faiss.downcast_index(self.index.index).hnsw.efSearch = self.ef_search
+
+    @property
+    def is_trained(self) -> bool:
+        return getattr(self.index, "is_trained", True)
+
+    def _train(self, embeddings):
+        #IVF and PQ indexes learn their clusters from a sample of the first (normalized) vectors added
+        cfg = self.index_config
+        if len(embeddings) > cfg.train_sample_size:
+            rows = np.random.default_rng(0).choice(len(embeddings), cfg.train_sample_size, replace=False)
+            embeddings = embeddings[np.sort(rows)]
+        n = len(embeddings)
+
+        if self.index_type == "ivf_pq" and n < (1 << cfg.pq_nbits):
+            # Each PQ codebook needs at least one training point per code
+            logger.warning(f"{n} vectors are too few to train IVF-PQ, using a flat index instead")
+            self.index_type = "flat"
+            self.index = self._new_index("flat", 0)
+            return
+
+        nlist = max(1, min(cfg.nlist, n // MIN_POINTS_PER_CENTROID))
+        if nlist != self.index.nlist:
+            logger.warning(f"Reducing nlist from {cfg.nlist} to {nlist} for {n} training vectors")
+            self.index = self._new_index(self.index_type, nlist)
+            self._apply_search_params()
+        self.index.train(embeddings)
+        logger.info(f"Trained {self.index_type} index with nlist={nlist} on {n} vectors")
+
+    @property
+    def supports_remove(self) -> bool:
+        return self.index_type != "hnsw"
+
+    def add(self, embeddings, metadatas, ids=None, parents=None):
+        #add embeddings to the index, under the given chunk ids or freshly assigned ones;
+        #parents is (ids, chunks) of the parent chunks the added chunks point to
+        if len(embeddings) != len(metadatas):
+            raise ValueError("Embeddings and metadata length mismatch")
+        if ids is not None and len(ids) != len(metadatas):
+            raise ValueError("Ids and metadata length mismatch")
+
+        try:
+            with self._lock:
+                if ids is None:
+                    ids = range(self.next_id, self.next_id + len(metadatas))
+                ids = np.asarray(list(ids), dtype=np.int64)
+                self._add(embeddings, metadatas, ids, parents)
+                self.version += 1
+            logger.info(f"Added {len(embeddings)} vectors. Total: {self.index.ntotal}")
+        except Exception as e:
+            logger.error(f"Failed adding vectors: {e}")
+            raise
+
+    def remove(self, ids):
+        #remove vectors by chunk id, returns the number removed
+        try:
+            with self._lock:
+                removed = self._remove(ids)
+                self.version += 1
+            logger.info(f"Removed {removed} vectors. Total: {self.index.ntotal}")
+            return removed
+        except Exception as e:
+            logger.error(f"Failed removing vectors: {e}")
+            raise
+
+    def update(self, remove_ids, embeddings, metadatas, ids, parents=None):
+        #swap stale vectors for new ones in one step so searches never see a half-applied change
+        if not (len(embeddings) == len(metadatas) == len(ids)):
+            raise ValueError("Embeddings, metadata and ids length mismatch")
+
+        try:
+            with self._lock:
+                removed = self._remove(remove_ids)
+                self._add(embeddings, metadatas, np.asarray(list(ids), dtype=np.int64), parents)
+                self.version += 1
+            logger.info(f"Updated index: -{removed} +{len(metadatas)} vectors. Total: {self.index.ntotal}")
+        except Exception as e:
+            logger.error(f"Failed updating vectors: {e}")
+            raise
+
+    def set_metadata(self, ids, metadatas):
+        #replace the stored chunks (or parent chunks) of indexed ids without touching their vectors
+        with self._lock:
+            ids = [int(i) for i in ids]
+            missing = [i for i in ids if i not in self.parents and i not in self.metadata]
+            if missing:
+                raise KeyError(f"Chunks {missing[:5]} are not indexed")
+            parents = [(i, meta) for i, meta in zip(ids, metadatas) if i in self.parents]
+            chunks = [(i, meta) for i, meta in zip(ids, metadatas) if i not in self.parents]
+            for store, pairs in ((self.parents, parents), (self.metadata, chunks)):
+                if pairs:
+                    store.add([i for i, _ in pairs], [meta for _, meta in pairs])
+            self.version += 1
+
+    def chunk(self, chunk_id: int):
+        #The chunk an id was indexed as: a parent chunk, or a chunk embedded as it is; None if unknown
+        with self._lock:
+            return self.parents.get(int(chunk_id)) or self.metadata.get(int(chunk_id))
+
+    def _make_writable(self):
+        #Copy a memory-mapped index into private memory before the first change; the chunk store
+        #never writes to its mapped columns, it replaces them when it changes
+        if not self._mapped:
+            return
+        self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+        self._apply_search_params()
+        self._mapped = False
+        logger.info("Copied the memory-mapped store into private memory for an update")
+
+    def _add(self, embeddings, metadatas, ids, parents=None):
+        if parents is not None and len(parents[0]):
+            self.parents.add(*parents)
+        if len(ids) == 0:
+            return
+        self._make_writable()
+        embeddings = self.normalize(embeddings)
+        if not self.is_trained:
+            self._train(embeddings)
+        self.index.add_with_ids(embeddings, ids)
+        self.metadata.add(ids, metadatas)
+        if self.lexical is not None:
+            self.lexical.add(ids.tolist(), [BM25Index.document_text(meta) for meta in metadatas])
+        self.next_id = max(self.next_id, int(ids.max()) + 1)
+
+    def _remove(self, ids):
+        #Removing a parent chunk removes its children
+        ids = [int(i) for i in ids]
+        parent_ids = [i for i in ids if i in self.parents]
+        if parent_ids:
+            self.parents.remove(parent_ids)
+            ids.extend(self.metadata.ids_where("parent", parent_ids).tolist())
+        ids = [i for i in ids if i in self.metadata]
+        if not ids:
+            return 0
+        self._make_writable()
+        if self.supports_remove:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+        else:
+            self._rebuild_without(ids)
+        self.metadata.remove(ids)
+        if self.lexical is not None:
+            self.lexical.remove(ids)
+        return len(ids)
+
+    def _rebuild_without(self, ids):
+        #HNSW graphs cannot drop nodes, so re-insert the surviving vectors into a fresh graph
+        all_ids = faiss.vector_to_array(self.index.id_map)
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+        keep = ~np.isin(all_ids, np.asarray(ids, dtype=np.int64))
+        self.index = self._new_index(self.index_type, 0)
+        self._apply_search_params()
+        if keep.any():
+            self.index.add_with_ids(vectors[keep], all_ids[keep])
+        logger.info(f"Rebuilt {self.index_type} graph without {int((~keep).sum())} vectors")
+
+    def search(self, query_embedding, top_k=5, query_text: str = None):
+        #search for similar vectors in the index, fused with keyword matches when query_text is given
+        results = self.search_batch(query_embedding, top_k=top_k,
+                                    query_texts=None if query_text is None else [query_text])
+        return results[0] if results else []
+
+    def search_batch(self, query_embeddings, top_k=5, query_texts=None):
+        #search many queries with one index call; returns one result list per query row
+        try:
+            queries = self.normalize(query_embeddings)
+            if query_texts is not None and self.lexical is not None:
+                return self._hybrid_search(queries, query_texts, top_k)
+            with self._lock:
+                similarities, indices = self.index.search(queries, self._child_depth(top_k))
+
+                batch = []
+                for row_scores, row_ids in zip(similarities, indices):
+                    results = []
+                    for score, idx in zip(row_scores, row_ids):
+                        meta = self.metadata.get(int(idx))
+                        if meta is not None:
+                            results.append({
+                                "id": int(idx),
+                                "score": float(score),
+                                "metadata": meta
+                            })
+                    batch.append(self._collapse(results, top_k))
+
+            return batch
+
+        except Exception as e:
+            logger.error(f"FAISS search failed: {e}")
+            return []
+
+    def _hybrid_search(self, queries: np.ndarray, query_texts, top_k: int):
+        #Dense and BM25 candidates merged by reciprocal rank fusion. "score" stays the cosine
+        #similarity so the relevance gate means the same thing with or without keyword search.
+        if len(query_texts) != len(queries):
+            raise ValueError("Query texts and embeddings length mismatch")
+        rrf_k = self.hybrid_config.rrf_k
+
+        with self._lock:
+            hits = self._child_depth(top_k)
+            depth = max(hits, self.hybrid_config.candidates)
+            similarities, indices = self.index.search(queries, depth)
+            batch = []
+            for query, text, row_scores, row_ids in zip(queries, query_texts, similarities, indices):
+                cosine = {int(i): float(s) for s, i in zip(row_scores, row_ids) if int(i) in self.metadata}
+                keyword = self.lexical.search(text, top_k=depth) if text else []
+
+                fused = {}
+                for rank, chunk_id in enumerate(cosine, start=1):
+                    fused[chunk_id] = 1.0 / (rrf_k + rank)
+                for rank, (chunk_id, _) in enumerate(keyword, start=1):
+                    fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank)
+                best = sorted(fused, key=fused.get, reverse=True)[:hits]
+
+                missing = [i for i in best if i not in cosine]
+                if missing:
+                    vectors = self.index.reconstruct_batch(np.asarray(missing, dtype=np.int64))
+                    cosine.update(zip(missing, (vectors @ query).tolist()))
+
+                bm25 = dict(keyword)
+                batch.append(self._collapse([{
+                    "id": chunk_id,
+                    "score": cosine[chunk_id],
+                    "bm25_score": bm25.get(chunk_id, 0.0),
+                    "rrf_score": fused[chunk_id],
+                    "metadata": self.metadata[chunk_id],
+                } for chunk_id in best], top_k))
+        return batch
+
+    def _child_depth(self, top_k: int) -> int:
+        #Hits to search for top_k results; several children of one parent collapse into one result
+        return top_k * self.index_config.child_fanout if len(self.parents) else top_k
+
+    def _collapse(self, results: list, top_k: int) -> list:
+        #Replace child hits by their parent chunk, ranked by its best child and listing the children hit;
+        #chunks without a parent are kept as they are
+        collapsed, by_parent = [], {}
+        for result in results:
+            parent_id = result["metadata"].get("parent")
+            if parent_id is None:
+                collapsed.append(result)
+            elif parent_id in by_parent:
+                by_parent[parent_id]["children"].append(result["id"])
+            else:
+                parent = self.parents.get(parent_id)
+                if parent is not None:
+                    by_parent[parent_id] = dict(result, id=parent_id, metadata=parent, children=[result["id"]])
+                    collapsed.append(by_parent[parent_id])
+        return collapsed[:top_k]
+
+
+    def save(self, path="faiss_store"):
+        #save faiss index to disk
+        try:
+            os.makedirs(path, exist_ok=True)
+
+            # Copy under the lock, write outside it so searches are not blocked on disk I/O
+            with self._lock:
+                index_bytes = faiss.serialize_index(self.index)
+                chunks = self.metadata.arrays()
+                parents = self.parents.arrays()
+                # The index type actually built, which can differ from the config for tiny corpora
+                info = dict(self.index_params(), built_index_type=self.index_type, next_id=self.next_id)
+                lexical = self.lexical.arrays() if self.lexical is not None else None
+
+            # Files are replaced rather than rewritten, other processes may have them mapped
+            write_atomic(f"{path}/index.faiss", lambda f: f.write(index_bytes.tobytes()))
+            ChunkStore.write(f"{path}/chunks", chunks)
+            ChunkStore.write(f"{path}/parents", parents)
+            if lexical is not None:
+                BM25Index.write(f"{path}/lexical", lexical)
+            write_atomic(f"{path}/index.json",
+                         lambda f: f.write(json.dumps(info, indent=2).encode("utf-8")))
+
+            logger.info(f"FAISS store saved to {path}")
+
+        except Exception as e:
+            logger.error(f"Failed saving FAISS store: {e}")
+            raise
+
+
+    def _load_lexical(self, path: str, mmap: bool):
+        #Postings are derived from the chunk text, so missing or outdated files are rebuilt from metadata
+        try:
+            self.lexical.load(path, mmap=mmap)
+            if len(self.lexical) == len(self.metadata):
+                return
+            logger.warning("Lexical index does not match the stored chunks, rebuilding it")
+        except FileNotFoundError:
+            logger.info("No lexical index in store, building it from the stored chunks")
+        except Exception as e:
+            logger.warning(f"Rebuilding unreadable lexical index: {e}")
+        self.lexical.clear()
+        self.lexical.add(list(self.metadata), [BM25Index.document_text(m) for m in self.metadata.values()])
+
+    def load(self, path="faiss_store", mmap: bool = None):
+        #load faiss index from disk; with mmap the index vectors and chunk records stay in the
+        #page cache, shared by every process that loads the same snapshot
+        mmap = self.index_config.mmap if mmap is None else mmap
+        try:
+            flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+            index = faiss.read_index(f"{path}/index.faiss", flags)
+            # Plain JSON and arrays: loading a snapshot never runs code from it
+            metadata = ChunkStore.open(f"{path}/chunks", mmap=mmap)
+            parents = ChunkStore.open(f"{path}/parents", mmap=mmap)
+
+            info = {}
+            if os.path.exists(f"{path}/index.json"):
+                with open(f"{path}/index.json", "r", encoding="utf-8") as f:
+                    info = json.load(f)
+            if info.get("metric") != METRIC:
+                # Older stores hold raw vectors under L2 distance; their scores mean something else
+                raise ValueError(f"Store at {path} uses metric {info.get('metric', 'l2')}, "
+                                 f"expected {METRIC}; rebuild the index")
+
+            with self._lock:
+                self.index = index
+                self.index_type = info["built_index_type"]
+                # Search-time knobs come from the current settings, not the saved ones
+                self._apply_search_params()
+                self.metadata = metadata
+                self.parents = parents
+                self._mapped = mmap
+                self.next_id = info["next_id"]
+                if self.index_type in IVF_TYPES:
+                    if faiss.extract_index_ivf(self.index).direct_map.type == faiss.DirectMap.NoMap:
+                        self._make_writable()
+                        faiss.extract_index_ivf(self.index).set_direct_map_type(faiss.DirectMap.Hashtable)
+                if self.lexical is not None:
+                    self._load_lexical(f"{path}/lexical", mmap)
+                self.version += 1
+
+            logger.info(
+                f"Loaded FAISS {self.index_type} store from {path}{' (memory-mapped)' if mmap else ''}. "
+                f"Total vectors: {self.index.ntotal}"
+            )
+
+        except Exception as e:
+            logger.error(f"Failed loading FAISS store: {e}")
+            raise
@@ -1,44 +1,195 @@
-from pydantic import BaseModel, ValidationError
-from dataclasses import dataclass
-from typing import Optional, Literal
-from pathlib import Path
-from typing import List
-
-ROOT = Path(__file__).resolve().parents[1]
-
-
-@dataclass
-class ChunkerConfig:
-    chunk_size: int = 1000
-    chunk_overlap: int = 100
-
-@dataclass
-class FileLoaderConfig:
-    path: str = ROOT / "data"
-
-@dataclass
-class VectorStoreConfig:
-    embedding_dim: int = 384
-    top_k: int=5
-    path: str=ROOT / "faiss_store"
-
-@dataclass
-class EmbeddingServiceConfig:
-    model_name: str="all-MiniLM-L6-v2"
-
-@dataclass
-class LLMServiceConfig:
-    api_key: str = ""
-    model: str = "gemini-3-flash-preview"
-
-
-class TicketResponse(BaseModel):
-    answer: str
-    references: List[str]
-    action_required: str
-
-
-class TicketRequest(BaseModel):
-    query: str
-
-
+from pydantic import BaseModel, ValidationError
+from dataclasses import dataclass
+from typing import Optional, Literal
+from pathlib import Path
+from typing import List
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@dataclass
+class ChunkerConfig:
+    chunk_size: int = 1000
+    chunk_overlap: int = 100
+    # Chunks are split again into children of this size; only the children are embedded and searched,
+    # and hits are collapsed to their parent chunk for the prompt. None embeds the chunks themselves.
+    child_chunk_size: Optional[int] = 250
+    child_chunk_overlap: int = 50
+
+@dataclass
+class FileLoaderConfig:
+    path: str = ROOT / "data"
+
+@dataclass
+class VectorStoreConfig:
+    embedding_dim: int = 384
+    top_k: int=5
+    path: str=ROOT / "faiss_store"
+    keep_snapshots: int = 2
+    # Seconds between background syncs of the data directory; 0 disables the watcher
+    sync_interval: float = 0.0
+    # Pre-forked workers check this often for a snapshot published by another worker
+    follow_interval: float = 5.0
+    # flat is exact; ivf_flat, hnsw and ivf_pq trade some recall for sub-linear search
+    index_type: str = "flat"
+    # IVF: clusters built at training time (reduced for small corpora) and clusters scanned per query
+    nlist: int = 1024
+    nprobe: int = 16
+    # HNSW: links per node and beam widths while building and searching the graph
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    # IVF-PQ: sub-quantizers (must divide embedding_dim) and bits per sub-quantizer code
+    pq_m: int = 48
+    pq_nbits: int = 8
+    # Child hits searched per requested parent chunk, so top_k distinct parents are usually found
+    child_fanout: int = 4
+    # Vectors sampled to train IVF and PQ indexes
+    train_sample_size: int = 100_000
+    # Memory-map snapshots instead of reading them, so worker processes share one copy of the
+    # index and chunk text through the page cache; a worker copies it only when it applies an update
+    mmap: bool = True
+
+@dataclass
+class IngestConfig:
+    # Processes chunking files during a full build; None uses all cores but one, 0 chunks in-process
+    workers: Optional[int] = None
+    # Chunks embedded (and added to the index) per batch
+    batch_size: int = 256
+    # Batches waiting between the chunk, embed and add stages; bounds the memory of a build
+    queue_size: int = 4
+    # Seconds between progress log lines
+    progress_interval: float = 10.0
+    # Files this large are chunked from a memory map instead of being read whole; same chunks either way
+    stream_threshold_bytes: Optional[int] = 16 * 1024 * 1024
+
+@dataclass
+class DedupConfig:
+    # Chunks whose word shingles overlap an already indexed chunk by at least `threshold` (MinHash
+    # estimate of the Jaccard similarity) are not embedded; the kept chunk lists their documents
+    enabled: bool = True
+    threshold: float = 0.8
+    # Signature length and LSH bands (num_perm / bands rows each); more bands find weaker matches
+    num_perm: int = 64
+    bands: int = 16
+    # Words per shingle
+    shingle_size: int = 5
+
+@dataclass
+class HybridSearchConfig:
+    # BM25 keyword search over the chunk text, merged with the dense results by reciprocal rank
+    # fusion, so exact identifiers (error codes, WHOIS, product names) rank without raising top_k
+    enabled: bool = True
+    # Results taken from each retriever before fusion
+    candidates: int = 50
+    rrf_k: int = 60
+    # BM25 term-frequency saturation and document-length normalization
+    k1: float = 1.2
+    b: float = 0.75
+
+@dataclass
+class RerankerConfig:
+    # Rescore retrieved chunks with a local cross-encoder and send only the best top_n to the LLM
+    enabled: bool = False
+    model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    # Chunks retrieved per query for the cross-encoder to choose from
+    candidates: int = 20
+    top_n: int = 3
+    batch_size: int = 16
+    # Scoring time allowed per ticket; past it the dense order is used
+    budget_ms: float = 150.0
+    # Query plus chunk tokens seen by the cross-encoder
+    max_length: int = 256
+
+@dataclass
+class RelevanceGateConfig:
+    # Scores are cosine similarities (higher is better). Tickets failing the gate get the
+    # canned follow-up answer without an LLM call.
+    # max: best chunk reaches threshold; mean: average of the retrieved chunks reaches it;
+    # margin: best chunk reaches it AND stands out from the median by at least min_margin
+    rule: str = "max"
+    threshold: float = 0.35
+    min_margin: float = 0.05
+
+@dataclass
+class EmbeddingServiceConfig:
+    model_name: str="all-MiniLM-L6-v2"
+    query_cache_size: int = 4096
+    # Where the query embedding cache is kept across restarts; None keeps it in memory only
+    query_cache_path: Optional[str] = ROOT / "faiss_store" / "query_cache.npz"
+    # torch, or onnx to run the model with ONNX Runtime (needs optimum[onnxruntime])
+    backend: str = "torch"
+    # int8 dynamic quantization of the ONNX model for the given CPU family: arm64, avx2, avx512, avx512_vnni
+    quantize: bool = False
+    quantization_target: str = "avx2"
+    # Where exported ONNX models are kept so the export runs once
+    model_cache_dir: str = ROOT / "models"
+
+@dataclass
+class EmbeddingBatcherConfig:
+    enabled: bool = True
+    max_batch_size: int = 32
+    # How long the first query of a batch waits for others to join
+    max_wait_ms: float = 5.0
+    # Queries allowed to wait for a batch before new ones are rejected with 503
+    max_queue_size: int = 1024
+
+@dataclass
+class LLMServiceConfig:
+    api_key: str = ""
+    model: str = "gemini-3-flash-preview"
+    max_concurrency: int = 8
+    timeout: float = 30.0
+    # Overrides the Gemini endpoint, e.g. http://localhost:8090 for src/tools/llm_stub.py
+    base_url: Optional[str] = None
+    # Upload the static prompt prefix once as cached content and reference it from every request
+    prompt_cache: bool = True
+    prompt_cache_ttl: float = 3600.0
+    # Extend the cache TTL when less than this many seconds remain
+    prompt_cache_refresh_margin: float = 300.0
+
+@dataclass
+class SemanticCacheConfig:
+    enabled: bool = True
+    # Cosine similarity a new query needs to a cached one (same retrieved chunks) to reuse its answer
+    similarity_threshold: float = 0.95
+    max_entries: int = 1024
+    ttl_seconds: float = 3600.0
+    max_bytes: int = 32 * 1024 * 1024
+
+@dataclass
+class PromptConfig:
+    # Input tokens spent on retrieved context; the most relevant chunks are packed first
+    context_token_budget: int = 1500
+    # A chunk that does not fit is cut to the remaining budget unless fewer tokens than this are left
+    min_partial_tokens: int = 64
+    # Gemini model whose tokenizer measures context (needs sentencepiece); None estimates 4 chars/token
+    tokenizer_model: Optional[str] = "gemini-2.5-flash"
+
+@dataclass
+class TicketBatchConfig:
+    max_batch_size: int = 100
+    # LLM calls one batch may have in flight; LLMServiceConfig.max_concurrency caps the total
+    max_concurrency: int = 4
+
+@dataclass
+class ServerTimingConfig:
+    # Send each request's per-stage durations (embed, search, gate, prompt, llm, ...) in a
+    # Server-Timing response header, as read by src/tools/loadgen.py and browser dev tools
+    enabled: bool = True
+
+
+class TicketResponse(BaseModel):
+    answer: str
+    references: List[str]
+    action_required: str
+
+
+class TicketRequest(BaseModel):
+    query: str
+
+
+class TicketResult(BaseModel):
+    index: int
+    response: Optional[TicketResponse] = None
+    error: Optional[str] = None
@@ -0,0 +1,62 @@
+import json
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+
+from benchmark import best_of, compare, main, run_benchmarks
+
+
+def report(chunks=1000, **stages):
+    return {"meta": {"chunks": chunks, "embedder": "hash", "embedding_dim": 384, "index_type": "flat",
+                     "chunk_size": 1000}, "stages": stages}
+
+
+def test_small_run_times_every_stage_without_a_model():
+    result = run_benchmarks(chunks=200, queries=5, log=lambda message: None)
+
+    assert set(result["stages"]) == {"chunking", "vector_store_add", "search", "hybrid_search", "save", "load",
+                                     "build_prompt", "answer_query"}
+    assert result["meta"]["chunks"] == 200
+    assert all(value > 0 for metrics in result["stages"].values() for value in metrics.values())
+
+
+def test_slower_stages_beyond_the_threshold_are_regressions():
+    baseline = report(search={"p50_ms": 1.0, "p95_ms": 2.0, "mean_ms": 1.0}, save={"seconds": 0.5})
+    current = report(search={"p50_ms": 1.3, "p95_ms": 2.1, "mean_ms": 9.0}, save={"seconds": 0.1})
+
+    rows = {(row["stage"], row["metric"]): row for row in compare(current, baseline, threshold=0.2)}
+
+    assert rows[("search", "p50_ms")]["regression"]
+    assert not rows[("search", "p95_ms")]["regression"]
+    assert not rows[("save", "seconds")]["regression"]
+    assert ("search", "mean_ms") not in rows
+
+
+def test_differences_within_the_noise_floor_are_not_regressions():
+    rows = compare(report(build_prompt={"p50_ms": 0.02}), report(build_prompt={"p50_ms": 0.01}))
+    assert rows[0]["change"] == pytest.approx(1.0) and not rows[0]["regression"]
+
+
+def test_baselines_of_another_workload_are_rejected():
+    with pytest.raises(ValueError, match="chunks"):
+        compare(report(chunks=1000), report(chunks=10_000))
+
+
+def test_main_exits_with_a_message_for_a_baseline_of_another_workload(tmp_path, monkeypatch):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps(report(chunks=10_000)))
+    monkeypatch.setattr(sys, "argv", ["benchmark.py", "--chunks", "200", "--queries", "5", "--rounds", "1",
+                                      "--baseline", str(baseline)])
+
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert "chunks" in str(exit_info.value.code) and "--update-baseline" in str(exit_info.value.code)
+
+
+def test_best_of_keeps_the_fastest_round():
+    rounds = [report(chunking={"seconds": 2.0, "chunks_per_second": 50.0}),
+              report(chunking={"seconds": 1.0, "chunks_per_second": 100.0})]
+    assert best_of(rounds)["stages"]["chunking"] == {"seconds": 1.0, "chunks_per_second": 100.0}
+    assert best_of(rounds)["meta"]["rounds"] == 2
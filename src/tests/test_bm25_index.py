@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from BM25Index import BM25Index, tokenize
+
+
+DOCS = {
+    11: "Domain suspended after abuse report. Contact the abuse team.",
+    22: "WHOIS privacy hides the registrant contact details in WHOIS lookups.",
+    33: "Error ERR_DNS_404 means the zone has no record for the host name.",
+    44: "Reset your password with the link sent to your email address.",
+}
+
+
+@pytest.fixture
+def index():
+    bm25 = BM25Index()
+    bm25.add(list(DOCS), list(DOCS.values()))
+    return bm25
+
+
+def test_tokenize_keeps_identifiers_whole_and_split():
+    terms = tokenize("Got ERR_DNS_404 on example.com, what now?")
+    assert 'err_dns_404' in terms and 'dns' in terms and '404' in terms
+    assert 'example.com' in terms and 'example' in terms
+    assert 'what' not in terms
+
+
+def test_exact_identifier_ranks_first(index):
+    results = index.search("seeing err_dns_404 when loading my site", top_k=2)
+    assert results[0][0] == 33
+    assert index.search("whois", top_k=4)[0][0] == 22
+
+
+def test_unknown_terms_match_nothing(index):
+    assert index.search("kubernetes", top_k=3) == []
+    assert index.search("", top_k=3) == []
+
+
+def test_scores_follow_bm25(index):
+    # Single term in a single document: idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / avg))
+    (chunk_id, score), = index.search("password", top_k=5)
+    lengths = {i: len(tokenize(text)) for i, text in DOCS.items()}
+    avg = np.mean(list(lengths.values()))
+    idf = np.log1p((4 - 1 + 0.5) / (1 + 0.5))
+    expected = idf * 2.2 / (1 + 1.2 * (0.25 + 0.75 * lengths[44] / avg))
+    assert chunk_id == 44
+    assert score == pytest.approx(expected, rel=1e-5)
+
+
+def test_remove_and_add_recompile_postings(index):
+    index.remove([33])
+    assert index.search("err_dns_404") == []
+    index.add([55], ["ERR_DNS_404 troubleshooting guide"])
+    assert index.search("err_dns_404")[0][0] == 55
+    assert index.stats()['chunks'] == 4
+
+
+def test_save_and_load_roundtrip(index, tmp_path):
+    path = str(tmp_path / 'lexical.npz')
+    index.save(path)
+    loaded = BM25Index()
+    loaded.load(path)
+    assert loaded.search("abuse report", top_k=4) == index.search("abuse report", top_k=4)
+
+    # The forward index is restored too, so updates keep working after a load
+    loaded.remove([11])
+    loaded.add([66], ["Abuse desk escalation"])
+    assert [i for i, _ in loaded.search("abuse", top_k=4)] == [66]
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from ChunkStore import ChunkStore
+
+
+def test_chunks_roundtrip_through_mapped_files(tmp_path):
+    chunks = {
+        42: {'text': 'DNS zone records', 'metadata': {'filename': 'Dns'}},
+        7: {'text': 'Réinitialiser le mot de passe', 'metadata': {'filename': 'Compte'}, 'context_tokens': 9},
+        3: {'id': 1},
+    }
+    store = ChunkStore()
+    store.add(chunks.keys(), chunks.values())
+    store.save(str(tmp_path))
+    mapped = ChunkStore.open(str(tmp_path))
+
+    assert isinstance(mapped.text, np.memmap)
+    assert len(mapped) == 3
+    assert list(mapped) == [3, 7, 42]
+    assert mapped[7] == chunks[7]
+    assert 42 in mapped and 43 not in mapped
+    assert mapped.get(43) is None
+    assert dict(mapped.items()) == chunks
+    with pytest.raises(KeyError):
+        mapped[1]
+
+
+def test_fields_are_interned_and_text_is_one_buffer():
+    store = ChunkStore()
+    store.add(range(100), [{'text': f'chunk {i}', 'metadata': {'filename': f'doc{i % 2}'}, 'context_tokens': i,
+                            'kind': 'parent'} for i in range(100)])
+    assert len(store) == 100
+    assert store.field_values[store.fields.index(('metadata', 'filename'))] == ['doc0', 'doc1']
+    assert store.field_values[store.fields.index((None, 'kind'))] == ['parent']
+    assert store.text.tobytes().decode('utf-8') == ''.join(f'chunk {i}' for i in range(100))
+    assert store.field_ids.dtype == np.int32 and store.field_ids.shape == (100, 2)
+    # Per-chunk integers are a plain column, not interned
+    assert store.number_fields == ['context_tokens'] and store.numbers.tolist() == [[i] for i in range(100)]
+    assert store[51] == {'text': 'chunk 51', 'metadata': {'filename': 'doc1'}, 'context_tokens': 51,
+                         'kind': 'parent'}
+
+
+def test_values_of_removed_rows_are_forgotten(tmp_path):
+    store = ChunkStore()
+    store.add(range(4), [{'text': f'chunk {i}', 'metadata': {'filename': f'doc{i}'}, 'parent': 100 + i}
+                         for i in range(4)])
+    store.save(str(tmp_path))
+    mapped = ChunkStore.open(str(tmp_path))
+
+    mapped.remove([0, 2])
+    mapped.add([3], [{'text': 'edited', 'metadata': {'filename': 'doc5'}, 'parent': 7}])
+    assert dict(mapped.items()) == {1: {'text': 'chunk 1', 'metadata': {'filename': 'doc1'}, 'parent': 101},
+                                    3: {'text': 'edited', 'metadata': {'filename': 'doc5'}, 'parent': 7}}
+    assert mapped.field_values[mapped.fields.index(('metadata', 'filename'))] == ['doc1', 'doc5']
+    assert mapped.ids_where('parent', [7, 102]).tolist() == [3]
+
+    # New values are interned against the compacted table
+    mapped.add([4], [{'text': 'new', 'metadata': {'filename': 'doc1'}}])
+    assert mapped[4] == {'text': 'new', 'metadata': {'filename': 'doc1'}}
+    assert mapped.field_values[mapped.fields.index(('metadata', 'filename'))] == ['doc1', 'doc5']
+    assert mapped.ids_where('parent', [101, 7]).tolist() == [1, 3]
+
+
+def test_updates_replace_and_remove_chunks(tmp_path):
+    store = ChunkStore()
+    store.add([1, 2, 3], [{'text': 'one'}, {'text': 'two'}, {'text': 'three'}])
+    store.save(str(tmp_path))
+    mapped = ChunkStore.open(str(tmp_path))
+
+    mapped.remove([2, 99])
+    mapped.add([3, 4], [{'text': 'drei', 'metadata': {'filename': 'de'}}, {'text': 'vier'}])
+    assert dict(mapped.items()) == {1: {'text': 'one'}, 3: {'text': 'drei', 'metadata': {'filename': 'de'}},
+                                    4: {'text': 'vier'}}
+    assert mapped.text.tobytes() == b'onedreivier'
+    # The mapped files are replaced on save, never written through
+    assert dict(ChunkStore.open(str(tmp_path)).items()) == {1: {'text': 'one'}, 2: {'text': 'two'},
+                                                           3: {'text': 'three'}}
+
+
+def test_empty_store_can_be_opened(tmp_path):
+    ChunkStore().save(str(tmp_path))
+    mapped = ChunkStore.open(str(tmp_path))
+    assert len(mapped) == 0 and 1 not in mapped
+
+
+def test_inconsistent_files_are_rejected(tmp_path):
+    store = ChunkStore()
+    store.add([1, 2], [{'text': 'a'}, {'text': 'b'}])
+    store.save(str(tmp_path))
+    with open(tmp_path / 'text.bin', 'ab') as f:
+        f.write(b'garbage')
+    with pytest.raises(ValueError):
+        ChunkStore.open(str(tmp_path))
@@ -0,0 +1,38 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from Deduplicator import NearDuplicateIndex, shingles
+
+POLICY = ("Accounts are suspended when the WHOIS contact data is missing or invalid for more than fifteen "
+          "days after the registrar sends a verification email to the registrant. Suspended domains stop "
+          "resolving until the contact data is verified again, after which service is restored within "
+          "one hour and no reactivation fee is charged for the first suspension in a calendar year.")
+
+
+def test_shingles_are_word_ngrams():
+    assert shingles('Reset the  Password now', size=2) == {'reset the', 'the password', 'password now'}
+    assert shingles('short text', size=5) == {'short text'}
+
+
+def test_near_duplicate_is_found_and_unrelated_text_is_not():
+    index = NearDuplicateIndex(threshold=0.8)
+    index.add(1, index.signature(POLICY))
+    index.add(2, index.signature("Invoices are sent monthly to the billing contact of the account."))
+
+    assert index.find(index.signature(POLICY)) == 1
+    assert index.find(index.signature(POLICY.replace('one hour', 'sixty minutes'))) == 1
+    assert index.find(index.signature(POLICY[:len(POLICY) // 2])) is None
+    assert index.find(index.signature("Transfers need an authorization code from the current registrar.")) is None
+
+
+def test_removed_chunks_are_not_matched(tmp_path):
+    index = NearDuplicateIndex()
+    index.add(1, index.signature(POLICY))
+    index.save(str(tmp_path))
+    index.remove(1)
+    assert index.find(index.signature(POLICY)) is None and len(index) == 0
+
+    restored = NearDuplicateIndex()
+    restored.load(str(tmp_path))
+    assert restored.find(restored.signature(POLICY)) == 1
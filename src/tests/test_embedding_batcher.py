@@ -0,0 +1,105 @@
+import asyncio
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from EmbeddingBatcher import EmbeddingBatcher, EmbeddingQueueFull
+
+
+class DummyEmbeddingService:
+    def __init__(self, fail=False):
+        self.batches = []
+        self.cache = {}
+        self.fail = fail
+
+    def cached_query(self, query):
+        vector = self.cache.get(query)
+        return None if vector is None else vector[np.newaxis, :]
+
+    def embed_queries(self, queries):
+        if self.fail:
+            raise RuntimeError("model crashed")
+        self.batches.append(list(queries))
+        return np.array([[float(len(q)), 0.0, 1.0] for q in queries], dtype=np.float32)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_share_one_encode_call():
+    svc = DummyEmbeddingService()
+    batcher = EmbeddingBatcher(svc, max_batch_size=32, max_wait_ms=20)
+    queries = [f"query {'x' * i}" for i in range(10)]
+    results = await asyncio.gather(*[batcher.embed_query(q) for q in queries])
+
+    assert len(svc.batches) == 1
+    assert sorted(svc.batches[0]) == sorted(queries)
+    for q, r in zip(queries, results):
+        assert r.shape == (1, 3)
+        assert r[0, 0] == len(q)
+    assert batcher.stats()["max_batch_size"] == 10
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_batches_respect_max_batch_size():
+    svc = DummyEmbeddingService()
+    batcher = EmbeddingBatcher(svc, max_batch_size=4, max_wait_ms=20)
+    await asyncio.gather(*[batcher.embed_query(f"q{i}") for i in range(10)])
+
+    assert [len(b) for b in svc.batches] == [4, 4, 2]
+    stats = batcher.stats()
+    assert stats["batches"] == 3
+    assert stats["batched_queries"] == 10
+    assert stats["batch_size_counts"] == {2: 1, 4: 2}
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_cached_queries_skip_the_queue():
+    svc = DummyEmbeddingService()
+    svc.cache["known"] = np.ones(3, dtype=np.float32)
+    batcher = EmbeddingBatcher(svc)
+    result = await batcher.embed_query("known")
+    assert result.shape == (1, 3)
+    assert svc.batches == []
+    assert batcher.stats()["cache_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_queries():
+    svc = DummyEmbeddingService()
+    batcher = EmbeddingBatcher(svc, max_batch_size=1, max_wait_ms=0, max_queue_size=2)
+    tasks = [asyncio.ensure_future(batcher.embed_query(f"q{i}")) for i in range(5)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    rejected = [r for r in results if isinstance(r, EmbeddingQueueFull)]
+    assert len(rejected) == 3
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_encode_errors_reach_every_waiting_caller():
+    batcher = EmbeddingBatcher(DummyEmbeddingService(fail=True), max_wait_ms=10)
+    results = await asyncio.gather(*[batcher.embed_query(f"q{i}") for i in range(3)],
+                                   return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_requests_are_not_encoded():
+    svc = DummyEmbeddingService()
+    batcher = EmbeddingBatcher(svc, max_wait_ms=50)
+    keep = asyncio.ensure_future(batcher.embed_query("keep"))
+    drop = asyncio.ensure_future(batcher.embed_query("drop"))
+    await asyncio.sleep(0.01)
+    drop.cancel()
+    await keep
+    assert svc.batches == [["keep"]]
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_empty_query_raises():
+    with pytest.raises(ValueError):
+        await EmbeddingBatcher(DummyEmbeddingService()).embed_query("  ")
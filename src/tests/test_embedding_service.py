@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from EmbeddingService import EmbeddingService, QueryEmbeddingCache
+
+
+class FakeTokenizer:
+    do_lower_case = True
+
+
+class FakeSentenceTransformer:
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.tokenizer = FakeTokenizer()
+        self.encoded = []
+
+    def encode(self, texts, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        single = isinstance(texts, str)
+        batch = [texts] if single else list(texts)
+        self.encoded.extend(batch)
+        vectors = np.array([[len(t), t.count(' '), 1.0] for t in batch], dtype=np.float32)
+        return vectors[0] if single else vectors
+
+
+@pytest.fixture
+def embedding_service(monkeypatch):
+    monkeypatch.setattr('EmbeddingService.SentenceTransformer', FakeSentenceTransformer)
+    return EmbeddingService(model_name='fake-model', embedding_dim=3)
+
+
+def test_embed_documents_returns_embeddings_and_chunks(embedding_service):
+    chunks = [{'text': 'first chunk', 'metadata': {'filename': 'a'}},
+              {'text': 'second', 'metadata': {'filename': 'b'}}]
+    embeddings, metas = embedding_service.embed_documents(chunks)
+    assert embeddings.shape == (2, 3)
+    assert metas == chunks
+
+
+def test_embed_query_returns_row_matrix(embedding_service):
+    embedding = embedding_service.embed_query('reset my password')
+    assert embedding.shape == (1, 3)
+    assert embedding.dtype == np.float32
+
+
+def test_embed_query_empty_raises(embedding_service):
+    with pytest.raises(ValueError):
+        embedding_service.embed_query('   ')
+
+
+def test_repeated_query_is_served_from_cache(embedding_service):
+    first = embedding_service.embed_query('Reset my  password')
+    second = embedding_service.embed_query('  reset my password ')
+    np.testing.assert_array_equal(first, second)
+    assert embedding_service.model.encoded == ['reset my password']
+    stats = embedding_service.query_cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+
+
+def test_case_is_kept_for_cased_models(embedding_service):
+    embedding_service._fold_case = False
+    embedding_service.embed_query('WHOIS')
+    embedding_service.embed_query('whois')
+    assert embedding_service.model.encoded == ['WHOIS', 'whois']
+
+
+def test_cached_vectors_are_read_only(embedding_service):
+    embedding = embedding_service.embed_query('domain suspended')
+    with pytest.raises(ValueError):
+        embedding[0, 0] = 42.0
+
+
+def test_query_cache_lru_bound():
+    cache = QueryEmbeddingCache(max_entries=2)
+    cache.put('a', np.ones(3))
+    cache.put('b', np.ones(3))
+    cache.get('a')
+    cache.put('c', np.ones(3))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert len(cache) == 2
+
+
+def test_query_cache_persists_across_restarts(monkeypatch, tmp_path):
+    monkeypatch.setattr('EmbeddingService.SentenceTransformer', FakeSentenceTransformer)
+    path = str(tmp_path / 'query_cache.npz')
+    svc = EmbeddingService(model_name='fake-model', embedding_dim=3, query_cache_path=path)
+    expected = svc.embed_query('billing question')
+    svc.save_query_cache()
+
+    restarted = EmbeddingService(model_name='fake-model', embedding_dim=3, query_cache_path=path)
+    np.testing.assert_array_equal(restarted.embed_query('billing question'), expected)
+    assert restarted.model.encoded == []
+
+
+def test_query_cache_ignores_other_model(monkeypatch, tmp_path):
+    monkeypatch.setattr('EmbeddingService.SentenceTransformer', FakeSentenceTransformer)
+    path = str(tmp_path / 'query_cache.npz')
+    svc = EmbeddingService(model_name='fake-model', embedding_dim=3, query_cache_path=path)
+    svc.embed_query('billing question')
+    svc.save_query_cache()
+
+    other = EmbeddingService(model_name='other-model', embedding_dim=3, query_cache_path=path)
+    assert len(other.query_cache) == 0
+
+
+def test_embed_queries_encodes_misses_in_one_call(embedding_service):
+    embedding_service.embed_query('cached query')
+    embedding_service.model.encoded.clear()
+
+    vectors = embedding_service.embed_queries(['cached query', 'new one', 'New  one', 'another'])
+    assert vectors.shape == (4, 3)
+    assert embedding_service.model.encoded == ['new one', 'another']
+    np.testing.assert_array_equal(vectors[1], vectors[2])
+
+
+def test_cached_query_does_not_count_misses(embedding_service):
+    assert embedding_service.cached_query('unknown') is None
+    assert embedding_service.query_cache.stats()['misses'] == 0
+    embedding_service.embed_query('unknown')
+    assert embedding_service.cached_query('unknown').shape == (1, 3)
+
+
+def test_backend_is_part_of_cache_identity(monkeypatch, tmp_path):
+    import EmbeddingService as embedding_module
+    loaded = []
+
+    def fake_load_model(model_name, backend='torch', quantize=False, quantization_target='avx2', cache_dir=None):
+        loaded.append((backend, quantize, quantization_target, cache_dir))
+        return FakeSentenceTransformer(model_name)
+
+    monkeypatch.setattr(embedding_module, 'load_model', fake_load_model)
+    path = str(tmp_path / 'query_cache.npz')
+    torch_svc = EmbeddingService(model_name='fake-model', embedding_dim=3, query_cache_path=path)
+    torch_svc.embed_query('billing question')
+    torch_svc.save_query_cache()
+
+    onnx_svc = EmbeddingService(model_name='fake-model', embedding_dim=3, query_cache_path=path,
+                                backend='onnx', quantize=True, model_cache_dir=str(tmp_path))
+    assert onnx_svc.backend == 'onnx-qint8-avx2'
+    assert onnx_svc.cache_identity == 'fake-model:onnx-qint8-avx2'
+    assert len(onnx_svc.query_cache) == 0
+    assert loaded[-1] == ('onnx', True, 'avx2', str(tmp_path))
+
+
+def test_load_model_rejects_bad_backend_settings():
+    from EmbeddingService import load_model
+    with pytest.raises(ValueError):
+        load_model('fake-model', backend='tensorrt')
+    with pytest.raises(ValueError):
+        load_model('fake-model', backend='torch', quantize=True)
+
+
+def test_embedding_report_picks_fastest_backend_within_tolerance():
+    sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+    from embedding_report import agreement, fastest_within_tolerance, run_report
+
+    class ScaledModel(FakeSentenceTransformer):
+        def __init__(self, noise):
+            super().__init__('fake-model')
+            self.noise = noise
+
+        def encode(self, texts, **kwargs):
+            vectors = super().encode(texts, **kwargs)
+            return vectors + self.noise
+
+    texts = ['reset my password', 'domain suspended for abuse', 'dns records', 'billing']
+    rows = run_report(texts, ['torch', 'onnx', 'onnx-int8'], query_count=2,
+                      models={'torch': ScaledModel(0.0), 'onnx': ScaledModel(0.0), 'onnx-int8': ScaledModel(5.0)})
+    assert rows[1]['min_cosine'] == pytest.approx(1.0)
+    assert rows[2]['min_cosine'] < 0.99
+    for row, speed in zip(rows, [10.0, 20.0, 40.0]):
+        row['texts_per_second'] = speed
+    assert fastest_within_tolerance(rows, 0.99)['backend'] == 'onnx'
+    assert agreement(np.eye(2), np.eye(2) * 3)['min_cosine'] == pytest.approx(1.0)
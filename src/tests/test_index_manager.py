@@ -0,0 +1,459 @@
+import json
+import numpy as np
+import pytest
+import sys
+import threading
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+import config
+from IndexManager import IndexManager, chunk_ids, hash_file
+
+
+class DummyEmbeddingService:
+    def __init__(self, model_name='dummy-model', embedding_dim=3):
+        self.model_name = model_name
+        self.backend = 'torch'
+        self.embedding_dim = embedding_dim
+        self.calls = 0
+        self.embedded = []
+
+    def embed_documents(self, chunks, show_progress=True):
+        self.calls += 1
+        self.embedded.extend(c['text'] for c in chunks)
+        return np.ones((len(chunks), self.embedding_dim), dtype='float32'), chunks
+
+
+class DummyIndex:
+    def __init__(self, d):
+        self.d = d
+        self.ntotal = 0
+
+
+class DummyVectorStore:
+    is_trained = True
+
+    def __init__(self, embedding_dim=3):
+        self.embedding_dim = embedding_dim
+        self.reset()
+
+    def empty_copy(self):
+        return DummyVectorStore(self.embedding_dim)
+
+    def reset(self):
+        self.index = DummyIndex(self.embedding_dim)
+        self.metadata = {}
+        self.parents = {}
+
+    def index_params(self):
+        return {'index_type': 'flat'}
+
+    def add(self, embeddings, metadatas, ids=None, parents=None):
+        self.update([], embeddings, metadatas, ids, parents)
+
+    def update(self, remove_ids, embeddings, metadatas, ids, parents=None):
+        for i in remove_ids:
+            if i in self.parents:
+                del self.parents[i]
+                for child in [c for c, meta in self.metadata.items() if meta.get('parent') == i]:
+                    del self.metadata[child]
+            else:
+                self.metadata.pop(i)
+        if parents is not None:
+            self.parents.update(zip(*parents))
+        self.metadata.update(zip(ids, metadatas))
+        self.index.ntotal = len(self.metadata)
+
+    def set_metadata(self, ids, metadatas):
+        for i, meta in zip(ids, metadatas):
+            (self.parents if i in self.parents else self.metadata)[i] = meta
+
+    def chunk(self, chunk_id):
+        return self.parents.get(chunk_id) or self.metadata.get(chunk_id)
+
+    def save(self, path):
+        Path(path).mkdir(parents=True, exist_ok=True)
+        (Path(path) / 'store.json').write_text(json.dumps({'chunks': list(self.metadata.items()),
+                                                           'parents': list(self.parents.items())}))
+
+    def load(self, path):
+        saved = json.loads((Path(path) / 'store.json').read_text())
+        self.metadata = dict(saved['chunks'])
+        self.parents = dict(saved['parents'])
+        self.index = DummyIndex(self.embedding_dim)
+        self.index.ntotal = len(self.metadata)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    d = tmp_path / 'data'
+    d.mkdir()
+    (d / 'account_recovery.txt').write_text('Reset your password from the login page.')
+    (d / 'domain_policy.txt').write_text('Domains are suspended for missing WHOIS data.')
+    return d
+
+
+def make_manager(data_dir, tmp_path, embedder=None, store=None, chunker_config=None, ingest_config=None):
+    return IndexManager(
+        embedder or DummyEmbeddingService(),
+        store or DummyVectorStore(),
+        data_dir=data_dir,
+        snapshot_dir=tmp_path / 'store',
+        chunker_config=chunker_config or config.ChunkerConfig(chunk_size=100, chunk_overlap=10),
+        ingest_config=ingest_config or config.IngestConfig(workers=0),
+    )
+
+
+def test_hash_file_matches_content(tmp_path):
+    a = tmp_path / 'a.txt'
+    b = tmp_path / 'b.txt'
+    a.write_text('same')
+    b.write_text('same')
+    assert hash_file(str(a)) == hash_file(str(b))
+    b.write_text('different')
+    assert hash_file(str(a)) != hash_file(str(b))
+
+
+def test_manifest_records_files_chunker_and_model(data_dir, tmp_path):
+    manifest = make_manager(data_dir, tmp_path).build_manifest()
+    assert set(manifest['files']) == {'account_recovery.txt', 'domain_policy.txt'}
+    assert manifest['chunker'] == {'chunk_size': 100, 'chunk_overlap': 10,
+                                   'child_chunk_size': 250, 'child_chunk_overlap': 50}
+    assert manifest['embedding'] == {'model_name': 'dummy-model', 'backend': 'torch', 'embedding_dim': 3}
+    assert manifest['index_version']
+
+
+def test_first_start_builds_and_saves_snapshot(data_dir, tmp_path):
+    embedder = DummyEmbeddingService()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder)
+    assert manager.load_or_build() is False
+    assert embedder.calls == 1
+    assert (tmp_path / 'store' / 'CURRENT').read_text() == manager.index_version
+
+
+def test_restart_loads_snapshot_without_embedding(data_dir, tmp_path):
+    make_manager(data_dir, tmp_path).load_or_build()
+
+    embedder = DummyEmbeddingService()
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder, store=store)
+    assert manager.load_or_build() is True
+    assert embedder.calls == 0
+    assert store.index.ntotal == 2
+
+
+def test_changed_file_triggers_rebuild(data_dir, tmp_path):
+    first = make_manager(data_dir, tmp_path)
+    first.load_or_build()
+
+    (data_dir / 'domain_policy.txt').write_text('Updated suspension policy.')
+    embedder = DummyEmbeddingService()
+    second = make_manager(data_dir, tmp_path, embedder=embedder)
+    assert second.load_or_build() is False
+    assert embedder.calls == 1
+    assert second.index_version != first.index_version
+
+
+def test_changed_settings_trigger_rebuild(data_dir, tmp_path):
+    make_manager(data_dir, tmp_path).load_or_build()
+
+    embedder = DummyEmbeddingService(model_name='other-model')
+    assert make_manager(data_dir, tmp_path, embedder=embedder).load_or_build() is False
+
+    embedder = DummyEmbeddingService()
+    chunking = config.ChunkerConfig(chunk_size=50, chunk_overlap=5)
+    assert make_manager(data_dir, tmp_path, embedder=embedder, chunker_config=chunking).load_or_build() is False
+
+
+def test_old_snapshots_are_pruned(data_dir, tmp_path):
+    for i in range(4):
+        (data_dir / 'domain_policy.txt').write_text(f'Policy revision {i}.')
+        make_manager(data_dir, tmp_path).load_or_build()
+    snapshots = [p for p in (tmp_path / 'store' / 'snapshots').iterdir()]
+    assert len(snapshots) == config.VectorStoreConfig.keep_snapshots
+
+
+def test_failed_rebuild_leaves_the_live_store_untouched(data_dir, tmp_path):
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, store=store)
+    manager.load_or_build()
+    version = manager.index_version
+    assert manager.last_ingest['files'] == 2 and manager.last_ingest['added'] == 2
+
+    class FailingEmbedder(DummyEmbeddingService):
+        def embed_documents(self, chunks, show_progress=True):
+            raise RuntimeError('model unavailable')
+
+    manager.embedding_service = FailingEmbedder()
+    with pytest.raises(RuntimeError, match='model unavailable'):
+        manager.rebuild()
+    assert store.index.ntotal == 2
+    assert manager.index_version == version
+
+
+def test_empty_data_dir_raises(tmp_path):
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    with pytest.raises(RuntimeError):
+        make_manager(empty, tmp_path).load_or_build()
+
+
+def test_chunk_ids_are_stable_and_distinct():
+    chunks = [{'text': 'a'}, {'text': 'b'}, {'text': 'a'}]
+    ids = chunk_ids('doc.txt', chunks)
+    assert ids == chunk_ids('doc.txt', chunks)
+    assert len(set(ids)) == 3
+    assert chunk_ids('other.txt', chunks) != ids
+    assert all(0 <= i < 2 ** 63 for i in ids)
+    # Numbering a file batch by batch gives the same ids
+    seen = {}
+    assert chunk_ids('doc.txt', chunks[:2], seen) + chunk_ids('doc.txt', chunks[2:], seen) == ids
+
+
+def test_large_files_are_indexed_in_batches_with_the_same_ids(data_dir, tmp_path):
+    (data_dir / 'long.txt').write_text(' '.join(f'Step {i} of the transfer.' for i in range(40)))
+    manager = make_manager(data_dir, tmp_path / 'whole')
+    manager.load_or_build()
+    batched = make_manager(data_dir, tmp_path / 'batched',
+                           ingest_config=config.IngestConfig(workers=0, batch_size=2, stream_threshold_bytes=0))
+    batched.load_or_build()
+
+    assert len(manager.manifest['files']['long.txt']['chunk_ids']) > 2
+    assert batched.manifest['files'] == manager.manifest['files']
+
+
+def test_sync_without_changes_is_a_noop(data_dir, tmp_path):
+    embedder = DummyEmbeddingService()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder)
+    manager.load_or_build()
+    result = manager.sync()
+    assert result['added'] == 0 and result['removed'] == 0
+    assert embedder.calls == 1
+
+
+def test_sync_reembeds_only_changed_file(data_dir, tmp_path):
+    embedder = DummyEmbeddingService()
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder, store=store)
+    manager.load_or_build()
+    embedder.embedded.clear()
+
+    (data_dir / 'domain_policy.txt').write_text('Domains are reactivated after WHOIS is updated.')
+    result = manager.sync()
+
+    assert result['changed_files'] == ['domain_policy.txt']
+    assert result['added'] == 1 and result['removed'] == 1
+    assert embedder.embedded == ['Domains are reactivated after WHOIS is updated.']
+    texts = sorted(m['text'] for m in store.metadata.values())
+    assert texts == ['Domains are reactivated after WHOIS is updated.',
+                     'Reset your password from the login page.']
+
+
+def test_sync_handles_added_and_deleted_files(data_dir, tmp_path):
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, store=store)
+    manager.load_or_build()
+
+    (data_dir / 'domain_policy.txt').unlink()
+    (data_dir / 'billing.txt').write_text('Invoices are sent monthly.')
+    result = manager.sync()
+
+    assert result['deleted_files'] == ['domain_policy.txt']
+    assert result['changed_files'] == ['billing.txt']
+    assert sorted(manager.manifest['files']) == ['account_recovery.txt', 'billing.txt']
+    assert store.index.ntotal == 2
+
+
+def test_sync_keeps_unchanged_chunks_of_edited_file(data_dir, tmp_path):
+    (data_dir / 'guide.txt').write_text('First paragraph stays.\n\nSecond paragraph.')
+    embedder = DummyEmbeddingService()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder,
+                           chunker_config=config.ChunkerConfig(chunk_size=30, chunk_overlap=0))
+    manager.load_or_build()
+    embedder.embedded.clear()
+
+    (data_dir / 'guide.txt').write_text('First paragraph stays.\n\nSecond paragraph, edited.')
+    manager.sync()
+    assert embedder.embedded == ['Second paragraph, edited.']
+
+
+def test_sync_persists_new_snapshot(data_dir, tmp_path):
+    manager = make_manager(data_dir, tmp_path)
+    manager.load_or_build()
+    (data_dir / 'billing.txt').write_text('Invoices are sent monthly.')
+    manager.sync()
+
+    embedder = DummyEmbeddingService()
+    restarted = make_manager(data_dir, tmp_path, embedder=embedder)
+    assert restarted.load_or_build() is True
+    assert embedder.calls == 0
+    assert restarted.index_version == manager.index_version
+
+
+def test_sync_waits_for_a_snapshot_written_by_another_worker(data_dir, tmp_path):
+    other = make_manager(data_dir, tmp_path)
+    other.load_or_build()
+    manager = make_manager(data_dir, tmp_path)
+    manager.load_or_build()
+    # A writer that crashed mid-save left its temporary directory behind
+    leftover = tmp_path / 'store' / 'snapshots' / 'deadbeef.12345.tmp'
+    leftover.mkdir()
+    (data_dir / 'billing.txt').write_text('Invoices are sent monthly.')
+
+    synced = threading.Event()
+    with other._snapshot_lock():
+        worker = threading.Thread(target=lambda: (manager.sync(), synced.set()))
+        worker.start()
+        assert not synced.wait(0.2)
+    worker.join(5)
+
+    assert synced.is_set()
+    assert not leftover.exists()
+    assert not list((tmp_path / 'store').glob('*.tmp'))
+
+
+def test_sync_starts_from_the_snapshot_another_worker_published(data_dir, tmp_path):
+    first = make_manager(data_dir, tmp_path)
+    first.load_or_build()
+    embedder = DummyEmbeddingService()
+    second = make_manager(data_dir, tmp_path, embedder=embedder)
+    second.load_or_build()
+
+    (data_dir / 'billing.txt').write_text('Invoices are sent monthly.')
+    first.sync()
+    published = first._snapshot_path(first.index_version)
+    written = (published / 'manifest.json').stat().st_mtime_ns
+    embedder.calls = 0
+
+    result = second.sync()
+    assert embedder.calls == 0
+    assert result['rebuilt'] is False and result['index_version'] == first.index_version
+    assert (published / 'manifest.json').stat().st_mtime_ns == written
+
+
+def test_indexed_chunks_carry_prompt_token_counts(data_dir, tmp_path):
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, store=store)
+    manager.load_or_build()
+    chunk = next(iter(store.parents.values()))
+    assert 'context' not in chunk
+    assert chunk['context_tokens'] > 0
+    assert manager.manifest['context'] == {'tokenizer': 'estimate'}
+
+
+def test_worker_follows_snapshot_published_by_another(data_dir, tmp_path):
+    writer = make_manager(data_dir, tmp_path)
+    writer.load_or_build()
+    store = DummyVectorStore()
+    follower = make_manager(data_dir, tmp_path, store=store)
+    follower.load_or_build()
+    assert follower.reload_current() is False
+
+    (data_dir / 'billing.txt').write_text('Invoices are sent monthly.')
+    writer.sync()
+    assert follower.reload_current() is True
+    assert follower.index_version == writer.index_version
+    assert store.index.ntotal == 3
+
+
+def test_follower_ignores_snapshot_with_other_settings(data_dir, tmp_path):
+    follower = make_manager(data_dir, tmp_path)
+    follower.load_or_build()
+    other = make_manager(data_dir, tmp_path, chunker_config=config.ChunkerConfig(chunk_size=50, chunk_overlap=0))
+    other.load_or_build()
+    version = follower.index_version
+    assert follower.reload_current() is False
+    assert follower.index_version == version
+
+
+BOILERPLATE = ("Abuse reports are reviewed by the trust and safety team within two business days. "
+               "During the review the domain stays active unless the report concerns malware, phishing "
+               "or spam that is still being sent, in which case the domain is suspended immediately and "
+               "the registrant is notified by email with the steps required to restore service.")
+
+
+def test_near_duplicate_chunks_are_embedded_once(data_dir, tmp_path):
+    (data_dir / 'abuse_policy.txt').write_text(BOILERPLATE)
+    (data_dir / 'malware_policy.txt').write_text(BOILERPLATE + ' Thank you.')
+    embedder = DummyEmbeddingService()
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder, store=store,
+                           chunker_config=config.ChunkerConfig(chunk_size=1000, chunk_overlap=0))
+    manager.load_or_build()
+
+    assert len(store.parents) == 3
+    assert sum('trust and safety' in text for text in embedder.embedded) == 1
+    kept = next(c for c in store.parents.values() if 'trust and safety' in c['text'])
+    other = ({'Abuse Policy', 'Malware Policy'} - {kept['metadata']['filename']}).pop()
+    assert kept['metadata']['also_in'] == [other]
+    assert manager.last_dedup['duplicates'] == 1
+    assert manager.last_dedup['vector_bytes_saved'] == 3 * 4
+    assert manager.dedup_stats()['duplicate_chunks'] == 1
+
+    # The signatures travel with the snapshot
+    restarted = make_manager(data_dir, tmp_path, chunker_config=config.ChunkerConfig(chunk_size=1000, chunk_overlap=0))
+    assert restarted.load_or_build() is True
+    assert len(restarted.dedup) == 3
+
+
+def test_duplicate_takes_over_when_indexed_copy_is_deleted(data_dir, tmp_path):
+    (data_dir / 'abuse_policy.txt').write_text(BOILERPLATE)
+    (data_dir / 'malware_policy.txt').write_text(BOILERPLATE)
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, store=store,
+                           chunker_config=config.ChunkerConfig(chunk_size=1000, chunk_overlap=0))
+    manager.load_or_build()
+    kept = next(c for c in store.metadata.values() if 'trust and safety' in c['text'])
+    kept_file = kept['metadata']['filename'].lower().replace(' ', '_') + '.txt'
+
+    (data_dir / kept_file).unlink()
+    result = manager.sync()
+    assert result['added'] == 1 and result['removed'] == 1
+    survivor = next(c for c in store.metadata.values() if 'trust and safety' in c['text'])
+    assert survivor['metadata']['filename'] != kept['metadata']['filename']
+    assert 'also_in' not in survivor['metadata']
+    assert manager.manifest['duplicates'] == {}
+
+
+def test_new_duplicate_is_listed_on_the_indexed_chunk(data_dir, tmp_path):
+    (data_dir / 'abuse_policy.txt').write_text(BOILERPLATE)
+    embedder = DummyEmbeddingService()
+    store = DummyVectorStore()
+    manager = make_manager(data_dir, tmp_path, embedder=embedder, store=store,
+                           chunker_config=config.ChunkerConfig(chunk_size=1000, chunk_overlap=0))
+    manager.load_or_build()
+    embedder.embedded.clear()
+
+    (data_dir / 'spam_policy.txt').write_text(BOILERPLATE)
+    result = manager.sync()
+    assert result['added'] == 0 and result['dedup']['duplicates'] == 1
+    assert embedder.embedded == []
+    kept = next(c for c in store.parents.values() if 'trust and safety' in c['text'])
+    assert kept['metadata']['also_in'] == ['Spam Policy']
+
+    (data_dir / 'spam_policy.txt').unlink()
+    manager.sync()
+    kept = next(c for c in store.parents.values() if 'trust and safety' in c['text'])
+    assert 'also_in' not in kept['metadata']
+
+
+def test_children_are_embedded_and_removed_with_their_parent(data_dir, tmp_path):
+    (data_dir / 'abuse_policy.txt').write_text(BOILERPLATE)
+    embedder = DummyEmbeddingService()
+    store = DummyVectorStore()
+    chunker_config = config.ChunkerConfig(chunk_size=1000, chunk_overlap=0, child_chunk_size=120, child_chunk_overlap=0)
+    manager = make_manager(data_dir, tmp_path, embedder=embedder, store=store, chunker_config=chunker_config)
+    manager.load_or_build()
+
+    parent_id = manager.manifest['files']['abuse_policy.txt']['chunk_ids'][0]
+    children = [c for c in store.metadata.values() if c['parent'] == parent_id]
+    assert len(children) > 1 and all(len(c['text']) <= 120 for c in children)
+    assert store.parents[parent_id]['text'] == BOILERPLATE
+    assert BOILERPLATE not in embedder.embedded
+
+    (data_dir / 'abuse_policy.txt').unlink()
+    result = manager.sync()
+    assert result['removed'] == 1
+    assert parent_id not in store.parents
+    assert all(c['parent'] != parent_id for c in store.metadata.values())
+
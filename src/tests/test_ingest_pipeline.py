@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+import config
+from IngestPipeline import IngestPipeline, chunk_batches, chunk_file
+from TextProcessor import ChildChunker
+from VectorStore import VectorStore
+
+
+class HashEmbedder:
+    #Deterministic vectors from the chunk text, recording the batch sizes it is called with
+    embedding_dim = 8
+
+    def __init__(self, fail_after=None):
+        self.batches = []
+        self.fail_after = fail_after
+
+    def embed_documents(self, chunks, show_progress=True):
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise RuntimeError("embedding failed")
+        self.batches.append(len(chunks))
+        vectors = [np.random.default_rng(abs(hash(c['text'])) % (1 << 32)).standard_normal(self.embedding_dim)
+                   for c in chunks]
+        return np.array(vectors, dtype=np.float32), chunks
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    paths = []
+    for i in range(12):
+        path = tmp_path / f"doc_{i:02d}.txt"
+        path.write_text(" ".join(f"Ticket {i} sentence {j} about domain renewals." for j in range(30)))
+        paths.append(str(path))
+    (tmp_path / "empty.txt").write_text("  \n")
+    paths.append(str(tmp_path / "empty.txt"))
+    return paths
+
+
+def numbered(path, chunks):
+    #Ids by file and position, like IndexManager's content ids but easy to check
+    base = int(Path(path).stem.split("_")[1]) * 1000 if "_" in Path(path).stem else 99000
+    return [base + i for i in range(len(chunks))], chunks
+
+
+def make_pipeline(embedder, store, **kwargs):
+    return IngestPipeline(embedder, store, chunk_size=200, chunk_overlap=20, **kwargs)
+
+
+def test_chunks_are_embedded_in_fixed_batches_and_added_in_file_order(corpus):
+    embedder = HashEmbedder()
+    store = VectorStore(embedding_dim=8, hybrid_config=config.HybridSearchConfig(enabled=False))
+    seen = []
+
+    def on_file(path, chunks):
+        seen.append(path)
+        return numbered(path, chunks)
+
+    stats = make_pipeline(embedder, store, batch_size=16, queue_size=1).run(corpus, on_file)
+
+    expected = sum(len(chunk_file(path, 200, 20)) for path in corpus)
+    assert seen == corpus
+    assert stats['files'] == len(corpus) and stats['chunks'] == stats['added'] == expected
+    assert all(size == 16 for size in embedder.batches[:-1]) and sum(embedder.batches) == expected
+    assert len(store.metadata) == expected
+    assert store.metadata[3001]['text'] == chunk_file(corpus[3], 200, 20)[1]['text']
+
+
+def test_large_files_are_chunked_from_a_memory_map_with_the_same_result(corpus):
+    assert chunk_file(corpus[0], 200, 20, stream_threshold=0) == chunk_file(corpus[0], 200, 20)
+
+
+def test_large_files_reach_the_pipeline_in_bounded_batches(corpus):
+    assert [len(batch) for batch in chunk_batches(corpus[12], 200, 20, stream_threshold=0, batch_size=4)] == [0]
+    results = {}
+    for workers in (0, 2):
+        calls, ids = [], {}
+
+        def on_file(path, chunks):
+            # numbered across the batches of a file
+            calls.append((path, len(chunks)))
+            start = ids.get(path, 0)
+            ids[path] = start + len(chunks)
+            return numbered(path, [None] * start + chunks)[0][start:], chunks
+
+        store = VectorStore(embedding_dim=8, hybrid_config=config.HybridSearchConfig(enabled=False))
+        pipeline = make_pipeline(HashEmbedder(), store, batch_size=4, workers=workers, stream_threshold=0)
+        stats = pipeline.run(corpus, on_file)
+
+        assert all(size <= 4 for _, size in calls)
+        assert list(dict.fromkeys(path for path, _ in calls)) == corpus
+        assert stats['chunks'] == sum(len(chunk_file(path, 200, 20)) for path in corpus)
+        results[workers] = {chunk_id: store.metadata[chunk_id] for chunk_id in store.metadata}
+
+    store = VectorStore(embedding_dim=8, hybrid_config=config.HybridSearchConfig(enabled=False))
+    make_pipeline(HashEmbedder(), store, batch_size=4).run(corpus, numbered)
+    assert results[0] == results[2] == {chunk_id: store.metadata[chunk_id] for chunk_id in store.metadata}
+
+
+def test_process_pool_chunks_files_like_the_main_process(corpus):
+    results = {}
+    for workers in (0, 2):
+        store = VectorStore(embedding_dim=8, hybrid_config=config.HybridSearchConfig(enabled=False))
+        make_pipeline(HashEmbedder(), store, batch_size=32, workers=workers).run(corpus, numbered)
+        results[workers] = {chunk_id: store.metadata[chunk_id] for chunk_id in store.metadata}
+    assert results[2] == results[0]
+
+
+def test_untrained_index_collects_its_training_sample_first(corpus):
+    index_config = config.VectorStoreConfig(index_type="ivf_flat", nlist=2, train_sample_size=100)
+    store = VectorStore(embedding_dim=8, index_config=index_config,
+                        hybrid_config=config.HybridSearchConfig(enabled=False))
+    stats = make_pipeline(HashEmbedder(), store, batch_size=16).run(corpus, numbered)
+
+    assert store.is_trained and store.index_type == "ivf_flat"
+    assert store.index.ntotal == stats['added'] == stats['chunks']
+
+
+def test_embedding_errors_stop_the_run(corpus):
+    store = VectorStore(embedding_dim=8, hybrid_config=config.HybridSearchConfig(enabled=False))
+    with pytest.raises(RuntimeError, match="embedding failed"):
+        make_pipeline(HashEmbedder(fail_after=1), store, batch_size=8, queue_size=1).run(corpus, numbered)
+
+
+def test_children_are_embedded_and_chunks_added_as_their_parents(corpus):
+    embedder = HashEmbedder()
+    store = VectorStore(embedding_dim=8, hybrid_config=config.HybridSearchConfig(enabled=False))
+    pipeline = make_pipeline(embedder, store, batch_size=16, children=ChildChunker(chunk_size=60, chunk_overlap=0))
+    stats = pipeline.run(corpus, numbered)
+
+    assert stats['parents'] == stats['chunks'] == len(store.parents)
+    assert stats['added'] == stats['embedded'] == sum(embedder.batches) == store.index.ntotal > len(store.parents)
+    children = [store.metadata[i] for i in store.metadata.ids_where('parent', [3001])]
+    assert children and all(len(c['text']) <= 60 for c in children)
+    assert store.parents[3001]['text'].startswith(children[0]['text'])
@@ -1,78 +1,483 @@
-import asyncio
-import pytest
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-
-from LLMService import LLMService, LLMServiceError
-
-
-class FakeModels:
-    def __init__(self, response_text, empty=False):
-        self._response_text = response_text
-        self._empty = empty
-
-    def generate_content(self, **kwargs):
-        class R:
-            def __init__(self, t, empty=False):
-                self.text = '' if empty else t
-        return R(self._response_text, self._empty)
-
-
-class FakeClient:
-    def __init__(self, response_text, empty=False):
-        self.models = FakeModels(response_text, empty)
-
-
-class FakeResponseModel:
-    @classmethod
-    def model_json_schema(cls):
-        return {}
-
-    @classmethod
-    def model_validate_json(cls, text):
-        class Parsed:
-            def model_dump(self):
-                return {"answer": "success", "references": ["doc1"], "action_required": "none"}
-        return Parsed()
-
-
-@pytest.fixture
-def llm_service(monkeypatch):
-    def make_client(api_key):
-        return FakeClient('{"test": true}')
-    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': make_client}))
-    return LLMService(api_key='test_key')
-
-
-def test_llm_service_initialization(monkeypatch):
-    def make_client(api_key):
-        return FakeClient('{}')
-    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': make_client}))
-    svc = LLMService(api_key='test_key', model='gemini-pro')
-    assert svc.model == 'gemini-pro'
-
-
-@pytest.mark.asyncio
-async def test_generate_success(llm_service):
-    result = await llm_service.generate("hello", FakeResponseModel, temperature=0.5)
-    assert isinstance(result, dict)
-    assert result['answer'] == 'success'
-    assert 'references' in result
-
-
-@pytest.mark.asyncio
-async def test_generate_with_different_temperature(llm_service):
-    result = await llm_service.generate("test query", FakeResponseModel, temperature=0.8)
-    assert isinstance(result, dict)
-    assert result['action_required'] == 'none'
-
-
-@pytest.mark.asyncio
-async def test_generate_empty_response_raises(monkeypatch):
-    def make_client(api_key):
-        return FakeClient('', empty=True)
-    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': make_client}))
-    svc = LLMService(api_key='test_key')
-    with pytest.raises(LLMServiceError):
-        await svc.generate("query", FakeResponseModel)
+import asyncio
+import json
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from LLMService import LLMService, LLMServiceError, LLMTimeoutError
+
+
+class FakeModels:
+    def __init__(self, response_text, empty=False, delay=0.0):
+        self._response_text = response_text
+        self._empty = empty
+        self._delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+
+    async def generate_content(self, **kwargs):
+        class R:
+            def __init__(self, t, empty=False):
+                self.text = '' if empty else t
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        return R(self._response_text, self._empty)
+
+
+class FakeClient:
+    def __init__(self, response_text, empty=False, delay=0.0):
+        self.aio = type('aio', (), {})()
+        self.aio.models = FakeModels(response_text, empty, delay)
+
+
+class FakeResponseModel:
+    @classmethod
+    def model_json_schema(cls):
+        return {}
+
+    @classmethod
+    def model_validate_json(cls, text):
+        class Parsed:
+            def model_dump(self):
+                return {"answer": "success", "references": ["doc1"], "action_required": "none"}
+        return Parsed()
+
+
+@pytest.fixture
+def llm_service(monkeypatch):
+    def make_client(api_key):
+        return FakeClient('{"test": true}')
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': make_client}))
+    return LLMService(api_key='test_key')
+
+
+def test_llm_service_initialization(monkeypatch):
+    def make_client(api_key):
+        return FakeClient('{}')
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': make_client}))
+    svc = LLMService(api_key='test_key', model='gemini-pro')
+    assert svc.model == 'gemini-pro'
+
+
+@pytest.mark.asyncio
+async def test_generate_success(llm_service):
+    result = await llm_service.generate("hello", FakeResponseModel, temperature=0.5)
+    assert isinstance(result, dict)
+    assert result['answer'] == 'success'
+    assert 'references' in result
+
+
+@pytest.mark.asyncio
+async def test_generate_with_different_temperature(llm_service):
+    result = await llm_service.generate("test query", FakeResponseModel, temperature=0.8)
+    assert isinstance(result, dict)
+    assert result['action_required'] == 'none'
+
+
+@pytest.mark.asyncio
+async def test_generate_empty_response_raises(monkeypatch):
+    def make_client(api_key):
+        return FakeClient('', empty=True)
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': make_client}))
+    svc = LLMService(api_key='test_key')
+    with pytest.raises(LLMServiceError):
+        await svc.generate("query", FakeResponseModel)
+
+
+@pytest.mark.asyncio
+async def test_schema_failures_and_errors_are_counted(monkeypatch):
+    from prometheus_client import REGISTRY
+    from pydantic import BaseModel
+
+    class Answer(BaseModel):
+        answer: str
+
+    def count(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    schema, errors = count('rag_llm_schema_validation_failures_total'), count('rag_llm_errors_total', kind='error')
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': lambda api_key: FakeClient('{"other": 1}')}))
+    with pytest.raises(LLMServiceError, match="invalid schema"):
+        await LLMService(api_key='test_key').generate("query", Answer)
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': lambda api_key: FakeClient('', empty=True)}))
+    with pytest.raises(LLMServiceError):
+        await LLMService(api_key='test_key').generate("query", Answer)
+
+    assert count('rag_llm_schema_validation_failures_total') == schema + 1
+    assert count('rag_llm_errors_total', kind='error') == errors + 1
+
+
+def make_slow_service(monkeypatch, delay, **kwargs):
+    client = FakeClient('{}', delay=delay)
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': lambda api_key: client}))
+    return LLMService(api_key='test_key', **kwargs), client.aio.models
+
+
+@pytest.mark.asyncio
+async def test_generate_limits_concurrency(monkeypatch):
+    svc, models = make_slow_service(monkeypatch, delay=0.05, max_concurrency=2)
+    await asyncio.gather(*[svc.generate("q", FakeResponseModel) for _ in range(6)])
+    assert models.max_in_flight == 2
+    assert svc.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_generate_runs_requests_concurrently(monkeypatch):
+    svc, _ = make_slow_service(monkeypatch, delay=0.2, max_concurrency=10)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*[svc.generate("q", FakeResponseModel) for _ in range(10)])
+    assert loop.time() - start < 1.0
+
+
+@pytest.mark.asyncio
+async def test_generate_timeout_raises(monkeypatch):
+    svc, models = make_slow_service(monkeypatch, delay=1.0, timeout=0.05)
+    with pytest.raises(LLMTimeoutError):
+        await svc.generate("q", FakeResponseModel)
+    assert models.cancelled == 1
+
+
+@pytest.mark.asyncio
+async def test_generate_cancellation_aborts_request(monkeypatch):
+    svc, models = make_slow_service(monkeypatch, delay=1.0)
+    task = asyncio.ensure_future(svc.generate("q", FakeResponseModel))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert models.cancelled == 1
+    assert svc.in_flight == 0
+
+
+def test_stub_server_answers_with_prompt_references():
+    from fastapi.testclient import TestClient
+    sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+    from llm_stub import create_app
+
+    client = TestClient(create_app())
+    body = {"contents": [{"role": "user", "parts": [{"text": "[Document 1: Account Recovery]\nreset"}]}]}
+    response = client.post("/v1beta/models/gemini-test:generateContent", json=body)
+    assert response.status_code == 200
+    text = response.json()["candidates"][0]["content"]["parts"][0]["text"]
+    assert json.loads(text)["references"] == ["Account Recovery"]
+    assert client.get("/stats").json()["requests"] == 1
+
+
+def test_stub_latency_distributions_keep_the_mean():
+    import random
+    sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+    from llm_stub import LATENCY_DISTRIBUTIONS, sample_latency
+
+    rng = random.Random(0)
+    for distribution in LATENCY_DISTRIBUTIONS:
+        samples = [sample_latency(rng, 0.5, distribution) for _ in range(20000)]
+        assert sum(samples) / len(samples) == pytest.approx(0.5, rel=0.05)
+        assert min(samples) >= 0.0
+    assert sample_latency(rng, 0.0, "lognormal") == 0.0
+
+
+def test_stub_injects_errors_and_invalid_answers():
+    from fastapi.testclient import TestClient
+    sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+    from llm_stub import create_app
+
+    app = create_app(error_rate=0.3, error_statuses=(503,), invalid_rate=0.3, seed=7)
+    client = TestClient(app)
+    body = {"contents": [{"role": "user", "parts": [{"text": "[Document 1: Billing]"}]}]}
+    statuses, invalid = [], 0
+    for _ in range(200):
+        response = client.post("/v1beta/models/gemini-test:generateContent", json=body)
+        statuses.append(response.status_code)
+        if response.status_code == 200:
+            invalid += "answer" not in json.loads(response.json()["candidates"][0]["content"]["parts"][0]["text"])
+
+    assert set(statuses) == {200, 503}
+    assert 40 < statuses.count(503) < 80
+    stats = client.get("/stats").json()
+    assert stats["errors"] == {"503": statuses.count(503)} and stats["invalid"] == invalid > 0
+
+
+@pytest.fixture
+def stub_server():
+    import socket
+    import threading
+    import time
+    import uvicorn
+    sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+    from llm_stub import create_app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    app = create_app(latency=0.2)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="error"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}", app
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_throughput_against_stub(stub_server):
+    from pydantic import BaseModel
+
+    class Answer(BaseModel):
+        answer: str
+        references: list
+        action_required: str
+
+    base_url, app = stub_server
+    svc = LLMService(api_key='test_key', base_url=base_url, max_concurrency=8)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    results = await asyncio.gather(*[svc.generate("[Document 1: Billing]", Answer) for _ in range(16)])
+    elapsed = loop.time() - start
+
+    assert all(r["references"] == ["Billing"] for r in results)
+    assert app.state.stats.max_in_flight == 8
+    # 16 requests of 0.2s each, 8 at a time: two waves rather than sixteen
+    assert elapsed < 1.6
+
+
+def test_json_field_streamer_decodes_answer_split_anywhere():
+    from LLMService import JSONFieldStreamer
+
+    payload = {
+        "references": ["answer", "Billing \"FAQ\""],
+        "answer": "Line one\nTab\there \"quoted\" \\ café \U0001F600 done",
+        "action_required": "none",
+    }
+    text = json.dumps(payload)
+    for size in (1, 2, 3, 7, len(text)):
+        streamer = JSONFieldStreamer("answer")
+        decoded = "".join(streamer.feed(text[i:i + size]) for i in range(0, len(text), size))
+        assert decoded == payload["answer"]
+        assert streamer.done
+
+
+def test_json_field_streamer_ignores_nested_keys():
+    from LLMService import JSONFieldStreamer
+
+    streamer = JSONFieldStreamer("answer")
+    text = json.dumps({"meta": {"answer": "nested"}, "answer": "top"})
+    assert streamer.feed(text) == "top"
+
+
+class StreamingModels(FakeModels):
+    def __init__(self, pieces, delay=0.0):
+        super().__init__('')
+        self.pieces = pieces
+        self.delay = delay
+
+    async def generate_content_stream(self, **kwargs):
+        async def chunks():
+            for piece in self.pieces:
+                await asyncio.sleep(self.delay)
+                yield type('Chunk', (), {'text': piece})()
+        return chunks()
+
+
+def make_streaming_service(monkeypatch, pieces, delay=0.0, **kwargs):
+    client = FakeClient('')
+    client.aio.models = StreamingModels(pieces, delay)
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': lambda api_key: client}))
+    return LLMService(api_key='test_key', **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_generate_stream_yields_answer_deltas_then_result(monkeypatch):
+    text = json.dumps({"answer": "Use the reset link.", "references": ["a"], "action_required": "none"})
+    svc = make_streaming_service(monkeypatch, [text[i:i + 5] for i in range(0, len(text), 5)])
+
+    events = [event async for event in svc.generate_stream("q", FakeResponseModel)]
+
+    deltas = [payload for kind, payload in events if kind == "delta"]
+    assert len(deltas) > 1
+    assert "".join(deltas) == "Use the reset link."
+    assert events[-1] == ("result", FakeResponseModel.model_validate_json(text).model_dump())
+    assert svc.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_generate_stream_times_out_on_stalled_stream(monkeypatch):
+    svc = make_streaming_service(monkeypatch, ['{"answer": "a', 'b"}'], delay=0.2, timeout=0.05)
+    with pytest.raises(LLMTimeoutError):
+        async for _ in svc.generate_stream("q", FakeResponseModel):
+            pass
+    assert svc.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_generate_stream_against_stub(stub_server):
+    from pydantic import BaseModel
+
+    class Answer(BaseModel):
+        answer: str
+        references: list
+        action_required: str
+
+    base_url, app = stub_server
+    app.state.chunk_chars = 8
+    svc = LLMService(api_key='test_key', base_url=base_url)
+    events = [event async for event in svc.generate_stream("[Document 1: Billing]", Answer)]
+
+    deltas = [payload for kind, payload in events if kind == "delta"]
+    kind, result = events[-1]
+    assert kind == "result"
+    assert result["references"] == ["Billing"]
+    assert len(deltas) > 1 and "".join(deltas) == result["answer"]
+    assert app.state.stats.streamed == 1
+
+
+class FakeCaches:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created = []
+        self.updated = []
+
+    async def create(self, model, config):
+        if self.fail:
+            raise RuntimeError("cached content too small")
+        self.created.append(config)
+        return type('Cached', (), {'name': f'cachedContents/{len(self.created)}'})()
+
+    async def update(self, name, config):
+        self.updated.append((name, config))
+
+
+class RecordingModels(FakeModels):
+    def __init__(self, response_text, reject_cached=0):
+        super().__init__(response_text)
+        self.requests = []
+        self.reject_cached = reject_cached
+
+    async def generate_content(self, **kwargs):
+        self.requests.append(kwargs)
+        if self.reject_cached and kwargs['config'].get('cached_content'):
+            self.reject_cached -= 1
+            from google.genai import errors
+            raise errors.ClientError(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+        return await super().generate_content(**kwargs)
+
+
+def make_caching_service(monkeypatch, fail=False, reject_cached=0, **kwargs):
+    client = FakeClient('{}')
+    client.aio.models = RecordingModels('{}', reject_cached=reject_cached)
+    client.aio.caches = FakeCaches(fail=fail)
+    monkeypatch.setattr('LLMService.genai', type('g', (), {'Client': lambda api_key: client}))
+    return LLMService(api_key='test_key', **kwargs), client.aio
+
+
+@pytest.mark.asyncio
+async def test_prefix_is_uploaded_once_and_referenced(monkeypatch):
+    svc, aio = make_caching_service(monkeypatch)
+    await asyncio.gather(*[svc.generate(f"ticket {i}", FakeResponseModel, prefix="PREFIX ") for i in range(5)])
+
+    assert len(aio.caches.created) == 1
+    assert aio.caches.created[0]['contents'] == ["PREFIX "]
+    assert {r['config']['cached_content'] for r in aio.models.requests} == {'cachedContents/1'}
+    assert sorted(r['contents'] for r in aio.models.requests) == [f"ticket {i}" for i in range(5)]
+    assert svc.stats()['cached_prefix_requests'] == 5
+
+
+@pytest.mark.asyncio
+async def test_prompt_cache_is_refreshed_before_expiry(monkeypatch):
+    import LLMService as llm_module
+    now = [1000.0]
+    monkeypatch.setattr(llm_module.time, 'monotonic', lambda: now[0])
+    svc, aio = make_caching_service(monkeypatch, prompt_cache_ttl=600, prompt_cache_refresh_margin=60)
+
+    await svc.generate("a", FakeResponseModel, prefix="PREFIX ")
+    now[0] += 500
+    await svc.generate("b", FakeResponseModel, prefix="PREFIX ")
+    assert aio.caches.updated == []
+    now[0] += 50
+    await svc.generate("c", FakeResponseModel, prefix="PREFIX ")
+    assert aio.caches.updated == [('cachedContents/1', {'ttl': '600s'})]
+    # Past the expiry a new cache is uploaded instead
+    now[0] += 700
+    await svc.generate("d", FakeResponseModel, prefix="PREFIX ")
+    assert len(aio.caches.created) == 2
+
+
+@pytest.mark.asyncio
+async def test_prompt_goes_inline_when_caching_fails(monkeypatch):
+    svc, aio = make_caching_service(monkeypatch, fail=True)
+    await svc.generate("a", FakeResponseModel, prefix="PREFIX ")
+    await svc.generate("b", FakeResponseModel, prefix="PREFIX ")
+
+    assert [r['contents'] for r in aio.models.requests] == ["PREFIX a", "PREFIX b"]
+    assert all('cached_content' not in r['config'] for r in aio.models.requests)
+    stats = svc.stats()
+    assert stats['inline_prefix_requests'] == 2
+    # The failed upload is not retried for every request
+    assert stats['prompt_cache']['failures'] == 1
+
+
+@pytest.mark.asyncio
+async def test_rejected_cache_is_retried_inline(monkeypatch):
+    svc, aio = make_caching_service(monkeypatch, reject_cached=1)
+    await svc.generate("a", FakeResponseModel, prefix="PREFIX ")
+    assert aio.models.requests[-1]['contents'] == "PREFIX a"
+    assert svc.prompt_cache.stats()['caches'] == 0
+
+    await svc.generate("b", FakeResponseModel, prefix="PREFIX ")
+    assert aio.models.requests[-1]['config']['cached_content'] == 'cachedContents/2'
+
+
+@pytest.mark.asyncio
+async def test_prompt_cache_against_stub(stub_server):
+    from pydantic import BaseModel
+
+    class Answer(BaseModel):
+        answer: str
+        references: list
+        action_required: str
+
+    base_url, app = stub_server
+    app.state.latency = 0.0
+    prefix = "SYSTEM ROLE AND EXAMPLES\n" * 20
+    svc = LLMService(api_key='test_key', base_url=base_url)
+    results = [await svc.generate(f"[Document 1: Billing {i}]", Answer, prefix=prefix) for i in range(3)]
+    events = [event async for event in svc.generate_stream("[Document 1: Billing]", Answer, prefix=prefix)]
+
+    assert [r["references"] for r in results] == [[f"Billing {i}"] for i in range(3)]
+    assert events[-1][1]["references"] == ["Billing"]
+    stats = app.state.stats.as_dict()
+    assert stats["caches_created"] == 1
+    assert stats["cached_requests"] == 4 and stats["inline_requests"] == 0
+    # The prefix was uploaded once, not sent with every request
+    assert stats["prompt_chars"] < 2 * len(prefix)
+
+
+@pytest.mark.asyncio
+async def test_stub_rejects_small_cache_and_service_falls_back(stub_server):
+    from pydantic import BaseModel
+
+    class Answer(BaseModel):
+        answer: str
+        references: list
+        action_required: str
+
+    base_url, app = stub_server
+    app.state.latency = 0.0
+    app.state.min_cache_chars = 10_000
+    svc = LLMService(api_key='test_key', base_url=base_url)
+    result = await svc.generate("[Document 1: Billing]", Answer, prefix="SHORT PREFIX\n")
+
+    assert result["references"] == ["Billing"]
+    assert app.state.stats.inline_requests == 1
+    assert svc.stats()["prompt_cache"]["failures"] == 1
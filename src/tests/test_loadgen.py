@@ -0,0 +1,113 @@
+import asyncio
+import httpx
+import json
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+sys.path.insert(0, str(Path(__file__).parent.parent / "api"))
+sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+
+import config
+from LLMService import LLMServiceError
+from RAGService import RAGAgent
+from StageTimings import StageTimings
+from loadgen import load_tickets, parse_server_timing, run_load
+
+
+DOCS = [{'id': 1, 'score': 0.9, 'metadata': {'text': 'Renew a domain.', 'metadata': {'filename': 'Renewal'}}}]
+
+
+class EmbeddingService:
+    def embed_query(self, query):
+        return [0.1, 0.2, 0.3]
+
+
+class VectorStore:
+    def search(self, embedding, top_k=5, query_text=None):
+        return DOCS[:top_k]
+
+
+class FlakyLLM:
+    #Fails every third call
+    def __init__(self):
+        self.calls = 0
+
+    async def generate(self, prompt, response_model, temperature=0.0, prefix=None):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(0.001)
+        if call % 3 == 0:
+            raise LLMServiceError("LLM generation error")
+        return {"answer": "Renew it.", "references": ["Renewal"], "action_required": "none"}
+
+    async def generate_stream(self, prompt, response_model, temperature=0.0, prefix=None):
+        result = await self.generate(prompt, response_model, temperature, prefix)
+        yield "delta", result["answer"]
+        yield "result", result
+
+
+class Services:
+    initialized = True
+
+    def __init__(self):
+        self.rag = RAGAgent(FlakyLLM(), VectorStore(), EmbeddingService(), config.TicketResponse,
+                            relevance_config=config.RelevanceGateConfig(threshold=0.1))
+
+
+@pytest.fixture
+def transport():
+    import app as api
+    services = Services()
+    api.app.dependency_overrides[api.get_services] = lambda: services
+    yield httpx.ASGITransport(app=api.app, raise_app_exceptions=False)
+    api.app.dependency_overrides.clear()
+
+
+def test_tickets_are_read_from_query_or_title_and_body(tmp_path):
+    path = tmp_path / "tickets.jsonl"
+    path.write_text(json.dumps({"query": "How do I renew?"}) + "\n\n"
+                    + json.dumps({"request_id": "t-2", "title": "Transfer", "body": "Move my domain."}) + "\n")
+    assert load_tickets(str(path)) == ["How do I renew?", "Transfer\n\nMove my domain."]
+
+
+def test_server_timing_header_is_parsed_with_the_failed_stage():
+    stages, failed = parse_server_timing('embed;dur=1.50, llm;dur=800.25;desc="failed", total;dur=802.00')
+    assert stages == {"embed": 1.5, "llm": 800.25, "total": 802.0} and failed == "llm"
+    assert parse_server_timing(None) == ({}, None)
+
+
+def test_stage_timings_are_only_recorded_inside_a_request():
+    with StageTimings.stage("embed"):
+        pass
+    assert StageTimings.current() is None
+
+    async def request():
+        timings = StageTimings.begin()
+        with pytest.raises(RuntimeError):
+            with StageTimings.stage("llm"):
+                raise RuntimeError("down")
+        return timings
+
+    timings = asyncio.run(request())
+    assert list(timings.stages) == ["llm"] and timings.failed == "llm"
+    assert 'llm;dur=' in timings.header() and 'desc="failed"' in timings.header()
+
+
+def test_load_run_reports_stage_timings_and_errors_by_stage(transport):
+    summary = asyncio.run(run_load("http://test", ["How do I renew my domain?"], concurrency=3, requests=12,
+                                   transport=transport))
+
+    assert summary["requests"] == 12 and summary["errors"] == 4 and summary["ok"] == 8
+    assert summary["errors_by_kind"] == {"http_500": 4} and summary["errors_by_stage"] == {"llm": 4}
+    assert {"embed", "search", "gate", "cache", "prompt", "llm", "total"} <= set(summary["stages_ms"])
+    assert summary["latency_ms"]["p50"] <= summary["latency_ms"]["p99"]
+    assert summary["throughput_rps"] > 0
+
+
+def test_open_loop_sends_at_the_requested_rate(transport):
+    summary = asyncio.run(run_load("http://test", ["How do I renew my domain?"], concurrency=4, rate=200.0,
+                                   requests=10, stream=True, transport=transport))
+
+    assert summary["requests"] == 10 and summary["rate"] == 200.0
+    assert summary["ttfb_ms"] and {"embed", "search"} <= set(summary["stages_ms"])
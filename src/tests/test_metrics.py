@@ -0,0 +1,104 @@
+import asyncio
+import httpx
+import os
+import subprocess
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+sys.path.insert(0, str(Path(__file__).parent.parent / "api"))
+
+import config
+from prometheus_client import REGISTRY
+from RAGService import RAGAgent
+from StageTimings import StageTimings
+
+
+class EmbeddingService:
+    def embed_query(self, query):
+        return [0.1, 0.2, 0.3]
+
+
+class VectorStore:
+    index = type('Index', (), {'ntotal': 42})()
+
+    def search(self, embedding, top_k=5, query_text=None):
+        return [{'id': 1, 'score': 0.9, 'metadata': {'text': 'Renew a domain.', 'metadata': {'filename': 'Renewal'}}}]
+
+
+class LLM:
+    async def generate(self, prompt, response_model, temperature=0.0, prefix=None):
+        return {"answer": "Renew it.", "references": ["Renewal"], "action_required": "none"}
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_stages_are_observed_outside_requests_too():
+    before = sample('rag_stage_seconds_count', stage='prompt')
+    with StageTimings.stage("prompt"):
+        pass
+    with StageTimings.stage("not-a-stage"):
+        pass
+    assert sample('rag_stage_seconds_count', stage='prompt') == before + 1
+    assert REGISTRY.get_sample_value('rag_stage_seconds_count', {'stage': 'not-a-stage'}) is None
+
+
+def test_metrics_endpoint_reports_requests_stages_and_index_size():
+    import app as api
+
+    class Services:
+        initialized = True
+        rag = RAGAgent(LLM(), VectorStore(), EmbeddingService(), config.TicketResponse,
+                       relevance_config=config.RelevanceGateConfig(threshold=0.1))
+
+    api.app.dependency_overrides[api.get_services] = lambda: Services
+    api.services.vector_store = VectorStore()
+    requests = sample('rag_request_seconds_count', endpoint='/resolve-ticket', status='2xx')
+    llm_calls = sample('rag_stage_seconds_count', stage='llm')
+
+    async def run():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            for _ in range(3):
+                assert (await client.post("/resolve-ticket", json={"query": "Renew?"})).status_code == 200
+            await client.get("/metrics")
+            return await client.get("/metrics")
+
+    try:
+        response = asyncio.run(run())
+    finally:
+        api.app.dependency_overrides.clear()
+        api.services.vector_store = None
+
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    assert sample('rag_request_seconds_count', endpoint='/resolve-ticket', status='2xx') == requests + 3
+    assert sample('rag_stage_seconds_count', stage='llm') == llm_calls + 3
+    assert sample('rag_requests_in_flight', endpoint='/resolve-ticket') == 0
+    assert 'rag_index_vectors 42.0' in response.text
+    # Only ticket endpoints are measured, so scrapes add no series
+    assert 'endpoint="/metrics"' not in response.text
+
+
+def test_workers_sharing_a_metrics_directory_are_reported_together(tmp_path):
+    script = f"""
+import os, sys
+sys.path.insert(0, {str(Path(__file__).parent.parent / "services")!r})
+import Metrics
+from prometheus_client import multiprocess
+Metrics.observe_stage("embed", 0.01)
+pid = os.fork()
+if pid == 0:
+    Metrics.observe_stage("embed", 0.02)
+    Metrics.in_flight("/resolve-ticket").inc()
+    os._exit(0)
+os.waitpid(pid, 0)
+multiprocess.mark_process_dead(pid)
+sys.stdout.write(Metrics.render()[0].decode())
+"""
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                            check=True).stdout
+
+    assert 'rag_stage_seconds_count{stage="embed"} 2.0' in output
+    assert 'rag_requests_in_flight{endpoint="/resolve-ticket"} 1.0' not in output
@@ -1,77 +1,160 @@
-import pytest
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-from PromptBuilder import PromptBuilder
-
-
-def test_build_prompt_basic():
-    docs = [
-        {
-            'metadata': {
-                'text': 'This is a test document',
-                'metadata': {'filename': 'doc1.txt'}
-            }
-        }
-    ]
-    prompt = PromptBuilder.build_prompt('How to test?', docs)
-    assert isinstance(prompt, str)
-    assert 'How to test?' in prompt
-    assert 'doc1.txt' in prompt
-    assert 'OUTPUT SCHEMA' in prompt
-
-
-def test_build_prompt_with_multiple_docs():
-    docs = [
-        {'metadata': {'text': 'First doc', 'metadata': {'filename': 'doc1.txt'}}},
-        {'metadata': {'text': 'Second doc', 'metadata': {'filename': 'doc2.txt'}}},
-    ]
-    prompt = PromptBuilder.build_prompt('Test query', docs)
-    assert 'doc1.txt' in prompt
-    assert 'doc2.txt' in prompt
-
-
-def test_format_context_documents_empty():
-    assert PromptBuilder._format_context_documents([]) == '[No documents provided]'
-
-
-def test_format_context_documents_with_docs():
-    docs = [
-        {'metadata': {'text': 'content', 'metadata': {'filename': 'test.txt'}}}
-    ]
-    result = PromptBuilder._format_context_documents(docs)
-    assert '[Document' in result
-    assert 'test.txt' in result
-    assert 'content' in result
-
-
-def test_format_actions():
-    result = PromptBuilder._format_actions()
-    assert 'none' in result
-    assert 'escalate_to_abuse_team' in result
-
-
-def test_format_json_schema():
-    schema = PromptBuilder._format_json_schema()
-    assert isinstance(schema, str)
-    assert 'answer' in schema
-    assert 'references' in schema
-    assert 'action_required' in schema
-
-
-def test_dict_to_json():
-    data = {'key': 'value', 'number': 42}
-    json_str = PromptBuilder._dict_to_json(data)
-    assert isinstance(json_str, str)
-    assert 'key' in json_str
-    assert 'value' in json_str
-
-
-def test_build_prompt_invalid_query():
-    with pytest.raises(ValueError):
-        PromptBuilder.build_prompt('', [{'metadata': {'text': 'doc', 'metadata': {'filename': 'f.txt'}}}])
-
-
-def test_build_prompt_invalid_context():
-    with pytest.raises(ValueError):
-        PromptBuilder.build_prompt('query', [])
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+from PromptBuilder import PromptBuilder
+
+
+def test_build_prompt_basic():
+    docs = [
+        {
+            'metadata': {
+                'text': 'This is a test document',
+                'metadata': {'filename': 'doc1.txt'}
+            }
+        }
+    ]
+    prompt = PromptBuilder.build_prompt('How to test?', docs)
+    assert isinstance(prompt, str)
+    assert 'How to test?' in prompt
+    assert 'doc1.txt' in prompt
+    assert 'OUTPUT SCHEMA' in prompt
+
+
+def test_build_prompt_with_multiple_docs():
+    docs = [
+        {'metadata': {'text': 'First doc', 'metadata': {'filename': 'doc1.txt'}}},
+        {'metadata': {'text': 'Second doc', 'metadata': {'filename': 'doc2.txt'}}},
+    ]
+    prompt = PromptBuilder.build_prompt('Test query', docs)
+    assert 'doc1.txt' in prompt
+    assert 'doc2.txt' in prompt
+
+
+def test_format_context_documents_empty():
+    assert PromptBuilder._format_context_documents([]) == '[No documents provided]'
+
+
+def test_format_context_documents_with_docs():
+    docs = [
+        {'metadata': {'text': 'content', 'metadata': {'filename': 'test.txt'}}}
+    ]
+    result = PromptBuilder._format_context_documents(docs)
+    assert '[Document' in result
+    assert 'test.txt' in result
+    assert 'content' in result
+
+
+def test_format_actions():
+    result = PromptBuilder._format_actions()
+    assert 'none' in result
+    assert 'escalate_to_abuse_team' in result
+
+
+def test_format_json_schema():
+    schema = PromptBuilder._format_json_schema()
+    assert isinstance(schema, str)
+    assert 'answer' in schema
+    assert 'references' in schema
+    assert 'action_required' in schema
+
+
+def test_dict_to_json():
+    data = {'key': 'value', 'number': 42}
+    json_str = PromptBuilder._dict_to_json(data)
+    assert isinstance(json_str, str)
+    assert 'key' in json_str
+    assert 'value' in json_str
+
+
+def test_build_prompt_invalid_query():
+    with pytest.raises(ValueError):
+        PromptBuilder.build_prompt('', [{'metadata': {'text': 'doc', 'metadata': {'filename': 'f.txt'}}}])
+
+
+def test_build_prompt_invalid_context():
+    with pytest.raises(ValueError):
+        PromptBuilder.build_prompt('query', [])
+
+
+def make_doc(filename, text, prepared=False):
+    chunk = {'text': text, 'metadata': {'filename': filename}}
+    if prepared:
+        PromptBuilder.prepare_chunk(chunk)
+    return {'score': 0.5, 'metadata': chunk}
+
+
+def test_prompt_prefix_is_rendered_once():
+    assert PromptBuilder.prompt_prefix() is PromptBuilder.prompt_prefix()
+    prompt = PromptBuilder.build_prompt('How to test?', [make_doc('doc1.txt', 'text')])
+    assert prompt.startswith(PromptBuilder.prompt_prefix())
+
+
+def test_prepared_chunk_token_count_is_used(monkeypatch):
+    doc = make_doc('doc1.txt', 'original text', prepared=True)
+    block = PromptBuilder.format_context_block('doc1.txt', 'original text')
+    assert doc['metadata']['context_tokens'] == PromptBuilder.count_tokens(block)
+    assert block in PromptBuilder.build_prompt('query', [doc])
+    # The stored count is trusted, so the block is not measured again when packing
+    monkeypatch.setattr(PromptBuilder, 'count_tokens', staticmethod(lambda text: 1 / 0))
+    assert block in PromptBuilder.build_prompt('query', [doc])
+
+
+def test_block_header_names_the_documents_of_dropped_duplicates():
+    doc = make_doc('a.txt', 'shared text', prepared=True)
+    doc['metadata']['metadata']['also_in'] = ['b.txt', 'c.txt']
+    block = PromptBuilder.chunk_block(PromptBuilder.prepare_chunk(doc['metadata']))
+
+    assert block.startswith('\n[Document: a.txt (also in: b.txt, c.txt)]\n')
+    assert doc['metadata']['context_tokens'] == PromptBuilder.count_tokens(block)
+    assert block in PromptBuilder.build_prompt('query', [doc])
+
+
+def test_context_packed_by_relevance_within_token_budget(monkeypatch):
+    # one token per word keeps the arithmetic readable
+    monkeypatch.setattr(PromptBuilder, 'count_tokens', staticmethod(lambda text: len(text.split())))
+    monkeypatch.setattr(PromptBuilder, 'min_partial_tokens', 5)
+    docs = [make_doc('a.txt', 'alpha ' * 40, True),
+            make_doc('b.txt', 'beta ' * 40, True),
+            make_doc('c.txt', 'gamma ' * 40, True)]
+    block_tokens = docs[0]['metadata']['context_tokens']
+
+    context = PromptBuilder._format_context_documents(docs, token_budget=block_tokens + 20)
+
+    assert context.count('alpha') == 40
+    assert 0 < context.count('beta') < 40
+    assert 'gamma' not in context
+    assert PromptBuilder.count_tokens(context) <= block_tokens + 20
+
+
+def test_context_skips_tiny_remainder(monkeypatch):
+    monkeypatch.setattr(PromptBuilder, 'count_tokens', staticmethod(lambda text: len(text.split())))
+    monkeypatch.setattr(PromptBuilder, 'min_partial_tokens', 10)
+    docs = [make_doc('a.txt', 'alpha ' * 40, True), make_doc('b.txt', 'beta ' * 40, True)]
+    context = PromptBuilder._format_context_documents(docs, token_budget=docs[0]['metadata']['context_tokens'] + 3)
+    assert 'beta' not in context
+
+
+def test_first_document_is_cut_rather_than_dropped():
+    docs = [make_doc('a.txt', 'alpha ' * 400, True)]
+    context = PromptBuilder._format_context_documents(docs, token_budget=100)
+    assert 'a.txt' in context and 'alpha' in context
+    assert PromptBuilder.count_tokens(context) <= 100
+
+
+def test_load_token_counter_falls_back_to_estimate(monkeypatch):
+    from PromptBuilder import estimate_tokens, load_token_counter
+    monkeypatch.setitem(sys.modules, 'google.genai.local_tokenizer', None)
+    assert load_token_counter('gemini-2.5-flash') == ('estimate', estimate_tokens)
+    assert load_token_counter(None) == ('estimate', estimate_tokens)
+
+
+def test_prompt_parts_share_a_byte_identical_prefix():
+    first = [{'metadata': {'text': 'reset link', 'metadata': {'filename': 'a.txt'}}}]
+    second = [{'metadata': {'text': 'dns records', 'metadata': {'filename': 'b.txt'}}}]
+    prefix_a, suffix_a = PromptBuilder.build_prompt_parts('reset password', first)
+    prefix_b, suffix_b = PromptBuilder.build_prompt_parts('dns help', second)
+
+    assert prefix_a == prefix_b
+    assert 'reset password' not in prefix_a and 'a.txt' not in prefix_a
+    assert PromptBuilder.build_prompt('reset password', first) == prefix_a + suffix_a
@@ -1,85 +1,338 @@
-import pytest
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-
-from RAGService import RAGAgent
-
-
-class DummyEmbeddingService:
-    def embed_query(self, q):
-        return [0.1, 0.2, 0.3]
-
-
-class DummyVectorStore:
-    def __init__(self, docs=None):
-        self.docs = docs or []
-
-    def search(self, embedding, top_k=5):
-        return self.docs[:top_k]
-
-
-class DummyPromptBuilder:
-    @staticmethod
-    def build_prompt(query, docs):
-        return f"Prompt for {query}"
-
-
-@pytest.fixture
-def dummy_docs():
-    return [
-        {'score': 0.95, 'metadata': {'filename': 'a.txt', 'content': 'highly relevant'}},
-        {'score': 0.85, 'metadata': {'filename': 'b.txt', 'content': 'relevant'}},
-        {'score': 0.5, 'metadata': {'filename': 'c.txt', 'content': 'somewhat relevant'}},
-    ]
-
-
-@pytest.fixture
-def rag_agent(dummy_docs):
-    emb = DummyEmbeddingService()
-    vs = DummyVectorStore(docs=dummy_docs)
-    return RAGAgent(llm_service=None, vector_store=vs, embedding_service=emb, output_schema=None)
-
-
-def test_embed_query(rag_agent):
-    result = rag_agent.embed_query('test query')
-    assert isinstance(result, list)
-    assert len(result) == 3
-    assert result[0] == 0.1
-
-
-def test_embed_query_with_different_input(rag_agent):
-    result = rag_agent.embed_query('another query')
-    assert result == [0.1, 0.2, 0.3]
-
-
-def test_retrieve_documents(rag_agent, dummy_docs):
-    embedding = [0.1, 0.2, 0.3]
-    docs = rag_agent.retrieve_documents(embedding, top_k=2)
-    assert len(docs) <= 2
-    assert docs == dummy_docs[:2]
-
-
-def test_retrieve_documents_with_different_top_k(rag_agent, dummy_docs):
-    embedding = [0.1, 0.2, 0.3]
-    docs = rag_agent.retrieve_documents(embedding, top_k=1)
-    assert len(docs) == 1
-    assert docs[0]['score'] == 0.95
-
-
-def test_check_relevancy_high_threshold_passes(rag_agent, dummy_docs):
-    assert rag_agent.check_relevancy(dummy_docs, threshold=0.7) is True
-
-
-def test_check_relevancy_very_high_threshold_fails(rag_agent, dummy_docs):
-    assert rag_agent.check_relevancy(dummy_docs, threshold=0.95) is False
-
-
-def test_check_relevancy_empty_docs(rag_agent):
-    assert rag_agent.check_relevancy([], threshold=0.1) is False
-
-
-def test_check_relevancy_single_doc(rag_agent):
-    docs = [{'score': 0.8, 'metadata': {'filename': 'test.txt'}}]
-    assert rag_agent.check_relevancy(docs, threshold=0.5) is True
-    assert rag_agent.check_relevancy(docs, threshold=0.9) is False
+import asyncio
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from PromptBuilder import PromptBuilder
+from RAGService import RAGAgent
+from StageTimings import StageTimings
+
+
+class DummyEmbeddingService:
+    def __init__(self):
+        self.batches = []
+
+    def embed_query(self, q):
+        return [0.1, 0.2, 0.3]
+
+    def embed_queries(self, queries):
+        self.batches.append(list(queries))
+        return np.array([[0.1, 0.2, 0.3]] * len(queries))
+
+
+class DummyVectorStore:
+    def __init__(self, docs=None):
+        self.docs = docs or []
+        self.batch_searches = 0
+
+    def search(self, embedding, top_k=5, query_text=None):
+        return self.docs[:top_k]
+
+    def search_batch(self, embeddings, top_k=5, query_texts=None):
+        self.batch_searches += 1
+        return [self.docs[:top_k] for _ in embeddings]
+
+
+class DummyPromptBuilder:
+    @staticmethod
+    def build_prompt(query, docs):
+        return f"Prompt for {query}"
+
+    @staticmethod
+    def build_prompt_parts(query, docs):
+        return "Static prefix. ", f"Prompt for {query}"
+
+
+@pytest.fixture
+def dummy_docs():
+    return [
+        {'score': 0.95, 'metadata': {'filename': 'a.txt', 'content': 'highly relevant'}},
+        {'score': 0.85, 'metadata': {'filename': 'b.txt', 'content': 'relevant'}},
+        {'score': 0.5, 'metadata': {'filename': 'c.txt', 'content': 'somewhat relevant'}},
+    ]
+
+
+@pytest.fixture
+def rag_agent(dummy_docs):
+    emb = DummyEmbeddingService()
+    vs = DummyVectorStore(docs=dummy_docs)
+    return RAGAgent(llm_service=None, vector_store=vs, embedding_service=emb, output_schema=None)
+
+
+def test_embed_query(rag_agent):
+    result = rag_agent.embed_query('test query')
+    assert isinstance(result, list)
+    assert len(result) == 3
+    assert result[0] == 0.1
+
+
+def test_embed_query_with_different_input(rag_agent):
+    result = rag_agent.embed_query('another query')
+    assert result == [0.1, 0.2, 0.3]
+
+
+def test_retrieve_documents(rag_agent, dummy_docs):
+    embedding = [0.1, 0.2, 0.3]
+    docs = rag_agent.retrieve_documents(embedding, top_k=2)
+    assert len(docs) <= 2
+    assert docs == dummy_docs[:2]
+
+
+def test_retrieve_documents_with_different_top_k(rag_agent, dummy_docs):
+    embedding = [0.1, 0.2, 0.3]
+    docs = rag_agent.retrieve_documents(embedding, top_k=1)
+    assert len(docs) == 1
+    assert docs[0]['score'] == 0.95
+
+
+def test_check_relevancy_high_threshold_passes(rag_agent, dummy_docs):
+    assert rag_agent.check_relevancy(dummy_docs, threshold=0.7) is True
+
+
+def test_check_relevancy_very_high_threshold_fails(rag_agent, dummy_docs):
+    assert rag_agent.check_relevancy(dummy_docs, threshold=0.95, rule='mean') is False
+    assert rag_agent.check_relevancy(dummy_docs, threshold=0.96) is False
+
+
+def test_check_relevancy_max_rule_uses_best_score(rag_agent, dummy_docs):
+    assert rag_agent.check_relevancy(dummy_docs, threshold=0.9, rule='max') is True
+    assert rag_agent.check_relevancy(dummy_docs, threshold=0.9, rule='mean') is False
+
+
+def test_check_relevancy_margin_rule_rejects_flat_scores(rag_agent):
+    flat = [{'score': s, 'metadata': {}} for s in (0.41, 0.40, 0.40, 0.39)]
+    peaked = [{'score': s, 'metadata': {}} for s in (0.62, 0.40, 0.40, 0.39)]
+    assert rag_agent.check_relevancy(flat, threshold=0.35, rule='margin') is False
+    assert rag_agent.check_relevancy(peaked, threshold=0.35, rule='margin') is True
+
+
+def test_check_relevancy_unknown_rule(rag_agent, dummy_docs):
+    with pytest.raises(ValueError):
+        rag_agent.check_relevancy(dummy_docs, rule='median')
+
+
+def test_check_relevancy_empty_docs(rag_agent):
+    assert rag_agent.check_relevancy([], threshold=0.1) is False
+
+
+def test_check_relevancy_single_doc(rag_agent):
+    docs = [{'score': 0.8, 'metadata': {'filename': 'test.txt'}}]
+    assert rag_agent.check_relevancy(docs, threshold=0.5) is True
+    assert rag_agent.check_relevancy(docs, threshold=0.9) is False
+
+
+class CountingLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate(self, prompt, response_model, prefix=None):
+        self.calls += 1
+        return {'answer': 'cached answer', 'references': ['a.txt'], 'action_required': 'none'}
+
+
+@pytest.mark.asyncio
+async def test_answer_query_uses_semantic_cache(dummy_docs, monkeypatch):
+    from SemanticCache import SemanticCache
+    monkeypatch.setattr('RAGService.PromptBuilder', DummyPromptBuilder)
+    llm = CountingLLM()
+    docs = [dict(d, id=i) for i, d in enumerate(dummy_docs)]
+    agent = RAGAgent(llm_service=llm, vector_store=DummyVectorStore(docs=docs),
+                     embedding_service=DummyEmbeddingService(), output_schema=None,
+                     cache=SemanticCache())
+
+    first = await agent.answer_query('How do I reset my password?')
+    second = await agent.answer_query('How can I reset my password?')
+
+    assert first == second
+    assert llm.calls == 1
+    assert agent.cache.stats()['hits'] == 1
+    assert agent.stats() == {'llm_calls': 1,
+                             'llm_calls_avoided': {'relevance_gate': 0, 'answer_cache': 1}}
+
+
+@pytest.mark.asyncio
+async def test_off_topic_query_skips_llm():
+    llm = CountingLLM()
+    docs = [{'id': i, 'score': s, 'metadata': {}} for i, s in enumerate((0.12, 0.1, 0.08))]
+    agent = RAGAgent(llm_service=llm, vector_store=DummyVectorStore(docs=docs),
+                     embedding_service=DummyEmbeddingService(), output_schema=None)
+
+    response = await agent.answer_query('What is the weather in Paris?')
+
+    assert response.action_required == 'follow_up_required'
+    assert response.references == []
+    assert llm.calls == 0
+    assert agent.stats()['llm_calls_avoided']['relevance_gate'] == 1
+
+
+class FlakyLLM:
+    async def generate(self, prompt, response_model, prefix=None):
+        if 'fail' in prompt:
+            raise RuntimeError('LLM exploded')
+        return {'answer': prompt, 'references': [], 'action_required': 'none'}
+
+
+@pytest.mark.asyncio
+async def test_answer_queries_batches_embedding_and_search(dummy_docs, monkeypatch):
+    monkeypatch.setattr('RAGService.PromptBuilder', DummyPromptBuilder)
+    emb = DummyEmbeddingService()
+    vs = DummyVectorStore(docs=dummy_docs)
+    agent = RAGAgent(llm_service=FlakyLLM(), vector_store=vs, embedding_service=emb, output_schema=None)
+
+    results = await agent.answer_queries(['first', 'please fail', '  ', 'last'])
+
+    assert emb.batches == [['first', 'please fail', 'last']]
+    assert vs.batch_searches == 1
+    assert results[0]['answer'] == 'Prompt for first'
+    assert isinstance(results[1], RuntimeError)
+    assert isinstance(results[2], ValueError)
+    assert results[3]['answer'] == 'Prompt for last'
+
+
+@pytest.mark.asyncio
+async def test_answer_queries_bounds_llm_concurrency(dummy_docs, monkeypatch):
+    import asyncio
+    monkeypatch.setattr('RAGService.PromptBuilder', DummyPromptBuilder)
+
+    class SlowLLM:
+        in_flight = 0
+        peak = 0
+
+        async def generate(self, prompt, response_model, prefix=None):
+            SlowLLM.in_flight += 1
+            SlowLLM.peak = max(SlowLLM.peak, SlowLLM.in_flight)
+            await asyncio.sleep(0.01)
+            SlowLLM.in_flight -= 1
+            return {'answer': prompt, 'references': [], 'action_required': 'none'}
+
+    agent = RAGAgent(llm_service=SlowLLM(), vector_store=DummyVectorStore(docs=dummy_docs),
+                     embedding_service=DummyEmbeddingService(), output_schema=None)
+    results = await agent.answer_queries([f'q{i}' for i in range(8)], max_concurrency=2)
+    assert [r['answer'] for r in results] == [f'Prompt for q{i}' for i in range(8)]
+    assert SlowLLM.peak == 2
+
+
+class PromptRecordingLLM:
+    def __init__(self):
+        self.prompts = []
+
+    async def generate(self, prompt, response_model, prefix=None):
+        self.prompts.append(prompt)
+        return {'answer': 'Renew it.', 'references': ['Renewal'], 'action_required': 'none'}
+
+
+@pytest.mark.asyncio
+async def test_documents_of_dropped_duplicates_are_listed_and_referenced():
+    chunk = PromptBuilder.prepare_chunk({'text': 'Renew a domain from the dashboard.',
+                                         'metadata': {'filename': 'Renewal', 'also_in': ['Billing FAQ']}})
+    docs = [{'id': 1, 'score': 0.9, 'metadata': chunk}]
+    llm = PromptRecordingLLM()
+    agent = RAGAgent(llm_service=llm, vector_store=DummyVectorStore(docs=docs),
+                     embedding_service=DummyEmbeddingService(), output_schema=None)
+
+    response = await agent.answer_query('How do I renew?')
+    [batch_response] = await agent.answer_queries(['How do I renew?'])
+
+    assert '[Document: Renewal (also in: Billing FAQ)]' in llm.prompts[0]
+    assert response['references'] == ['Renewal', 'Billing FAQ']
+    assert batch_response['references'] == ['Renewal', 'Billing FAQ']
+
+
+class StreamingLLM(CountingLLM):
+    async def generate_stream(self, prompt, response_model, prefix=None):
+        self.calls += 1
+        for piece in ['Use the ', 'reset link.']:
+            yield 'delta', piece
+        yield 'result', {'answer': 'Use the reset link.', 'references': ['a.txt'], 'action_required': 'none'}
+
+
+def named_docs(scores):
+    return [{'id': i, 'score': s, 'metadata': {'text': 'chunk', 'metadata': {'filename': f'Doc {i % 2}'}}}
+            for i, s in enumerate(scores)]
+
+
+@pytest.mark.asyncio
+async def test_answer_query_stream_emits_references_then_answer(monkeypatch):
+    from SemanticCache import SemanticCache
+    monkeypatch.setattr('RAGService.PromptBuilder', DummyPromptBuilder)
+    llm = StreamingLLM()
+    agent = RAGAgent(llm_service=llm, vector_store=DummyVectorStore(docs=named_docs([0.9, 0.8, 0.7])),
+                     embedding_service=DummyEmbeddingService(), output_schema=None, cache=SemanticCache())
+
+    events = [event async for event in agent.answer_query_stream('reset password')]
+
+    assert [kind for kind, _ in events] == ['references', 'answer', 'answer', 'result']
+    assert events[0][1]['references'] == ['Doc 0', 'Doc 1']
+    assert [d['id'] for d in events[0][1]['documents']] == [0, 1, 2]
+    assert events[-1][1]['references'] == ['a.txt']
+
+    # the streamed answer was cached, so a repeat is served without the LLM
+    repeat = [event async for event in agent.answer_query_stream('reset password')]
+    assert [kind for kind, _ in repeat] == ['references', 'answer', 'result']
+    assert llm.calls == 1
+
+
+class SlowStreamingLLM(CountingLLM):
+    async def generate_stream(self, prompt, response_model, prefix=None):
+        for piece in ['Use the ', 'reset link.']:
+            await asyncio.sleep(0.01)
+            yield 'delta', piece
+        yield 'result', {'answer': 'Use the reset link.', 'references': ['a.txt'], 'action_required': 'none'}
+
+
+@pytest.mark.asyncio
+async def test_answer_query_stream_times_the_llm_without_the_reader(monkeypatch):
+    monkeypatch.setattr('RAGService.PromptBuilder', DummyPromptBuilder)
+    agent = RAGAgent(llm_service=SlowStreamingLLM(), vector_store=DummyVectorStore(docs=named_docs([0.9, 0.8])),
+                     embedding_service=DummyEmbeddingService(), output_schema=None)
+    timings = StageTimings.begin()
+
+    async for kind, _ in agent.answer_query_stream('reset password'):
+        # a slow client reading the answer
+        await asyncio.sleep(0.2)
+
+    assert 0.02 <= timings.stages['llm'] < 0.2
+    assert timings.failed is None
+
+
+@pytest.mark.asyncio
+async def test_answer_query_stream_off_topic_skips_llm():
+    llm = StreamingLLM()
+    agent = RAGAgent(llm_service=llm, vector_store=DummyVectorStore(docs=named_docs([0.1, 0.05])),
+                     embedding_service=DummyEmbeddingService(), output_schema=None)
+
+    events = [event async for event in agent.answer_query_stream('weather in Paris')]
+
+    assert [kind for kind, _ in events] == ['references', 'result']
+    assert events[-1][1].action_required == 'follow_up_required'
+    assert llm.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_reranker_overfetches_and_trims_prompt_documents(monkeypatch):
+    from Reranker import Reranker
+
+    class ReverseModel:
+        def predict(self, pairs, **kwargs):
+            return np.arange(len(pairs), dtype=np.float32)
+
+    seen = []
+
+    class RecordingPromptBuilder(DummyPromptBuilder):
+        @staticmethod
+        def build_prompt_parts(query, docs):
+            seen.append([d['id'] for d in docs])
+            return "Static prefix. ", f"Prompt for {query}"
+
+    monkeypatch.setattr('RAGService.PromptBuilder', RecordingPromptBuilder)
+    docs = [{'id': i, 'score': 0.9, 'metadata': {'text': f'chunk {i}'}} for i in range(10)]
+    store = DummyVectorStore(docs=docs)
+    reranker = Reranker(model=ReverseModel(), top_n=2, candidates=8)
+    agent = RAGAgent(llm_service=CountingLLM(), vector_store=store,
+                     embedding_service=DummyEmbeddingService(), output_schema=None, reranker=reranker)
+
+    await agent.answer_query('question', top_k=5)
+    assert seen == [[7, 6]]
+    assert agent.candidate_count(5) == 8
@@ -0,0 +1,63 @@
+import time
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from Reranker import Reranker
+
+
+class KeywordCrossEncoder:
+    #Scores a pair by how many query words the passage contains
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+
+    def predict(self, pairs, batch_size=32, show_progress_bar=False, convert_to_numpy=True):
+        if self.fail:
+            raise RuntimeError("model crashed")
+        self.batches.append(len(pairs))
+        time.sleep(self.delay)
+        return np.array([sum(w in p.lower() for w in q.lower().split()) for q, p in pairs], dtype=np.float32)
+
+
+def make_docs(texts):
+    return [{'id': i, 'score': 0.9 - i * 0.1, 'metadata': {'text': t, 'metadata': {'filename': f'doc{i}'}}}
+            for i, t in enumerate(texts)]
+
+
+DOCS = make_docs(['billing invoices', 'general faq', 'dns zone records', 'reset dns cache', 'abuse desk'])
+
+
+def test_rerank_orders_by_cross_encoder_and_keeps_top_n():
+    model = KeywordCrossEncoder()
+    reranker = Reranker(model=model, top_n=2, batch_size=2)
+    results = reranker.rerank('dns zone', DOCS)
+    assert [r['id'] for r in results] == [2, 3]
+    assert results[0]['rerank_score'] == 2.0
+    # Dense cosine scores are kept for the relevance gate
+    assert results[0]['score'] == DOCS[2]['score']
+    assert model.batches == [2, 2, 1]
+    assert reranker.stats()['reranked'] == 1
+
+
+def test_rerank_falls_back_to_dense_order_over_budget():
+    reranker = Reranker(model=KeywordCrossEncoder(delay=0.05), top_n=2, batch_size=2, budget_ms=20)
+    results = reranker.rerank('dns zone', DOCS)
+    assert [r['id'] for r in results] == [0, 1]
+    assert 'rerank_score' not in results[0]
+    assert reranker.stats()['budget_fallbacks'] == 1
+    assert reranker.model.batches == [2]
+
+
+def test_rerank_errors_keep_dense_order():
+    reranker = Reranker(model=KeywordCrossEncoder(fail=True), top_n=3)
+    assert [r['id'] for r in reranker.rerank('dns', DOCS)] == [0, 1, 2]
+    assert reranker.stats()['errors'] == 1
+
+
+def test_passage_includes_document_name():
+    assert Reranker.passage(DOCS[0]) == 'doc0: billing invoices'
+    assert Reranker.passage({'metadata': {'text': 'plain'}}) == 'plain'
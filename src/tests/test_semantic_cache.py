@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+import SemanticCache as semantic_cache
+from SemanticCache import SemanticCache
+
+
+ANSWER = {"answer": "Use the reset link.", "references": ["Account Recovery"], "action_required": "none"}
+
+
+@pytest.fixture
+def cache():
+    return SemanticCache(similarity_threshold=0.9, max_entries=3, ttl_seconds=60)
+
+
+def test_hit_for_similar_query_with_same_chunks(cache):
+    cache.store([1.0, 0.0, 0.0], [3, 1], ANSWER, index_version=1)
+    result = cache.lookup([0.99, 0.05, 0.0], [1, 3], index_version=1)
+    assert result == ANSWER
+    assert cache.stats()["hits"] == 1
+
+
+def test_miss_for_dissimilar_query(cache):
+    cache.store([1.0, 0.0, 0.0], [1], ANSWER, index_version=1)
+    assert cache.lookup([0.0, 1.0, 0.0], [1], index_version=1) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_miss_when_retrieved_chunks_differ(cache):
+    cache.store([1.0, 0.0, 0.0], [1, 2], ANSWER, index_version=1)
+    assert cache.lookup([1.0, 0.0, 0.0], [1, 4], index_version=1) is None
+
+
+def test_returned_answer_is_a_copy(cache):
+    cache.store([1.0, 0.0, 0.0], [1], ANSWER, index_version=1)
+    cache.lookup([1.0, 0.0, 0.0], [1], index_version=1)["references"].append("mutated")
+    assert cache.lookup([1.0, 0.0, 0.0], [1], index_version=1) == ANSWER
+
+
+def test_lru_eviction(cache):
+    for i in range(3):
+        cache.store([1.0, float(i), 0.0], [i], ANSWER, index_version=1)
+    # touch entry 0 so entry 1 becomes least recently used
+    assert cache.lookup([1.0, 0.0, 0.0], [0], index_version=1) is not None
+    cache.store([1.0, 3.0, 0.0], [3], ANSWER, index_version=1)
+
+    assert cache.stats()["entries"] == 3
+    assert cache.lookup([1.0, 1.0, 0.0], [1], index_version=1) is None
+    assert cache.lookup([1.0, 0.0, 0.0], [0], index_version=1) is not None
+
+
+def test_ttl_expiry(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache.time, "monotonic", lambda: now[0])
+    cache.store([1.0, 0.0, 0.0], [1], ANSWER, index_version=1)
+    now[0] += 61
+    assert cache.lookup([1.0, 0.0, 0.0], [1], index_version=1) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_memory_bound():
+    cache = SemanticCache(max_entries=100, max_bytes=2000)
+    for i in range(20):
+        cache.store(np.random.rand(64), [i], ANSWER, index_version=1)
+    stats = cache.stats()
+    assert stats["bytes"] <= 2000
+    assert stats["entries"] < 20
+    assert stats["evictions"] > 0
+
+
+def test_index_version_change_invalidates(cache):
+    cache.store([1.0, 0.0, 0.0], [1], ANSWER, index_version=1)
+    assert cache.lookup([1.0, 0.0, 0.0], [1], index_version=2) is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["index_version"] == 2
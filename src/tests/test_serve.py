@@ -0,0 +1,73 @@
+import os
+import signal
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "api"))
+
+from serve import WorkerPool, format_memory_report, memory_report, parse_smaps_rollup, threads_per_worker
+
+
+SMAPS_ROLLUP = """00400000-7ffd2d5fe000 ---p 00000000 00:00 0                          [rollup]
+Rss:              409600 kB
+Pss:              102400 kB
+Pss_Anon:          51200 kB
+Shared_Clean:     307200 kB
+Shared_Dirty:          0 kB
+Private_Clean:     20480 kB
+Private_Dirty:     81920 kB
+Swap:                  0 kB
+"""
+
+
+def test_threads_are_split_across_workers():
+    assert threads_per_worker(4, cpus=16) == 4
+    assert threads_per_worker(3, cpus=8) == 2
+    assert threads_per_worker(8, cpus=2) == 1
+
+
+def test_parse_smaps_rollup_in_bytes():
+    memory = parse_smaps_rollup(SMAPS_ROLLUP)
+    assert memory['rss'] == 400 * 1024 * 1024
+    assert memory['pss'] == 100 * 1024 * 1024
+    assert memory['private_dirty'] == 80 * 1024 * 1024
+    assert 'pss_anon' not in memory
+
+
+def test_memory_report_compares_shared_pool_with_independent_processes():
+    mb = 1024 * 1024
+    parent = {'rss': 400 * mb, 'pss': 50 * mb}
+    worker = {'rss': 420 * mb, 'pss': 120 * mb, 'private_clean': 0, 'private_dirty': 20 * mb}
+    report = memory_report(400 * mb, parent, [worker] * 4)
+    assert report['naive_rss'] == 1600 * mb
+    assert report['aggregate_pss'] == 530 * mb
+    assert report['saved_bytes'] == 1070 * mb
+    assert report['worker_private'] == [20 * mb] * 4
+    assert '4 workers use 530 MB' in format_memory_report(report)
+
+
+def test_worker_pool_restarts_dead_workers_and_stops(tmp_path):
+    def target(index):
+        (tmp_path / f'{index}-{os.getpid()}').touch()
+        signal.pause()
+
+    started = lambda: sorted(tmp_path.iterdir())
+    state = {'killed': None}
+
+    def on_tick():
+        if state['killed'] is None and len(started()) == 2:
+            state['killed'] = pool.pids[0]
+            state['index'] = pool.children[state['killed']]
+            os.kill(state['killed'], signal.SIGKILL)
+        elif state['killed'] is not None and len(started()) == 3:
+            pool.stop()
+
+    exited = []
+    pool = WorkerPool(2, target, graceful_timeout=5.0, on_tick=on_tick, on_exit=exited.append)
+    pool.start()
+    pool.supervise(poll_interval=0.05)
+
+    names = [p.name for p in started()]
+    assert len(names) == 3
+    assert [name.split('-')[0] for name in names].count(str(state['index'])) == 2
+    assert not pool.children
+    assert len(exited) == 3 and exited[0] == state['killed']
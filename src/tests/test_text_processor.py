@@ -1,82 +1,134 @@
-import pytest
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-
-from TextProcessor import FileLoader, TextChunker
-
-
-class DummySplitter:
-    def __init__(self, chunk_size=1000, chunk_overlap=100):
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
-
-    def split_text(self, text):
-        mid = max(1, len(text) // 2)
-        return [text[:mid], text[mid:]]
-
-
-@pytest.fixture
-def dummy_documents():
-    return [('Document One', 'This is the first document with some content.'),
-            ('Document Two', 'This is the second document with more content.')]
-
-
-@pytest.fixture
-def text_chunker(monkeypatch, dummy_documents):
-    monkeypatch.setattr('TextProcessor.RecursiveCharacterTextSplitter', DummySplitter)
-    return TextChunker(documents=dummy_documents, chunk_size=100, chunk_overlap=20)
-
-
-def test_text_chunker_initialization(text_chunker):
-    assert text_chunker.chunk_size == 100
-    assert text_chunker.chunk_overlap == 20
-    assert len(text_chunker.documents) == 2
-
-
-def test_text_chunker_split_single_document(text_chunker):
-    chunks = text_chunker.split_into_chunks('Test Doc', 'hello world')
-    assert isinstance(chunks, list)
-    assert len(chunks) > 0
-    assert all('text' in c and 'metadata' in c for c in chunks)
-
-
-def test_text_chunker_split_single_document_metadata(text_chunker):
-    chunks = text_chunker.split_into_chunks('TestFile', 'some text content')
-    for chunk in chunks:
-        assert chunk['metadata']['filename'] == 'TestFile'
-
-
-def test_text_chunker_split_docs(text_chunker):
-    all_chunks = text_chunker.split_docs()
-    assert isinstance(all_chunks, list)
-    assert len(all_chunks) > 0
-    assert all('text' in c and 'metadata' in c for c in all_chunks)
-
-
-def test_text_chunker_split_docs_metadata(text_chunker, dummy_documents):
-    all_chunks = text_chunker.split_docs()
-    filenames = set(c['metadata']['filename'] for c in all_chunks)
-    assert 'Document One' in filenames
-    assert 'Document Two' in filenames
-
-
-def test_text_chunker_initialization_with_invalid_documents():
-    with pytest.raises(ValueError):
-        TextChunker(documents=None)
-
-
-def test_text_chunker_initialization_with_empty_documents():
-    with pytest.raises(ValueError):
-        TextChunker(documents=[])
-
-
-def test_file_loader_initialization():
-    loader = FileLoader(directory='test_dir')
-    assert loader.directory == 'test_dir'
-
-
-def test_file_loader_load_files_nonexistent_directory():
-    loader = FileLoader(directory='nonexistent_dir_xyz')
-    files = loader.load_files()
-    assert files == []
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from TextProcessor import ChildChunker, FileLoader, StreamingTextChunker, TextChunker
+
+
+class DummySplitter:
+    def __init__(self, chunk_size=1000, chunk_overlap=100):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def split_text(self, text):
+        mid = max(1, len(text) // 2)
+        return [text[:mid], text[mid:]]
+
+
+@pytest.fixture
+def dummy_documents():
+    return [('Document One', 'This is the first document with some content.'),
+            ('Document Two', 'This is the second document with more content.')]
+
+
+@pytest.fixture
+def text_chunker(monkeypatch, dummy_documents):
+    monkeypatch.setattr('TextProcessor.RecursiveCharacterTextSplitter', DummySplitter)
+    return TextChunker(documents=dummy_documents, chunk_size=100, chunk_overlap=20)
+
+
+def test_text_chunker_initialization(text_chunker):
+    assert text_chunker.chunk_size == 100
+    assert text_chunker.chunk_overlap == 20
+    assert len(text_chunker.documents) == 2
+
+
+def test_text_chunker_split_single_document(text_chunker):
+    chunks = text_chunker.split_into_chunks('Test Doc', 'hello world')
+    assert isinstance(chunks, list)
+    assert len(chunks) > 0
+    assert all('text' in c and 'metadata' in c for c in chunks)
+
+
+def test_text_chunker_split_single_document_metadata(text_chunker):
+    chunks = text_chunker.split_into_chunks('TestFile', 'some text content')
+    for chunk in chunks:
+        assert chunk['metadata']['filename'] == 'TestFile'
+
+
+def test_text_chunker_split_docs(text_chunker):
+    all_chunks = text_chunker.split_docs()
+    assert isinstance(all_chunks, list)
+    assert len(all_chunks) > 0
+    assert all('text' in c and 'metadata' in c for c in all_chunks)
+
+
+def test_text_chunker_split_docs_metadata(text_chunker, dummy_documents):
+    all_chunks = text_chunker.split_docs()
+    filenames = set(c['metadata']['filename'] for c in all_chunks)
+    assert 'Document One' in filenames
+    assert 'Document Two' in filenames
+
+
+def test_text_chunker_initialization_with_invalid_documents():
+    with pytest.raises(ValueError):
+        TextChunker(documents=None)
+
+
+def test_text_chunker_initialization_with_empty_documents():
+    with pytest.raises(ValueError):
+        TextChunker(documents=[])
+
+
+def test_file_loader_initialization():
+    loader = FileLoader(directory='test_dir')
+    assert loader.directory == 'test_dir'
+
+
+def test_file_loader_load_files_nonexistent_directory():
+    loader = FileLoader(directory='nonexistent_dir_xyz')
+    files = loader.load_files()
+    assert files == []
+
+
+def write_document(path, text):
+    path.write_bytes(text.encode('utf-8'))
+    return str(path)
+
+
+def reference_chunks(path, chunk_size, chunk_overlap):
+    #What TextChunker produces for the file with the real splitter
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return TextChunker([('Doc', content)], chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_docs()
+
+
+@pytest.mark.parametrize('block_size', [16, 1 << 20])
+def test_streaming_chunker_matches_recursive_splitter(tmp_path, block_size):
+    paragraph = ' '.join(f'Ticket {i} mentions Überweisung and WHOIS data.' for i in range(12))
+    text = '\n\n'.join([paragraph, 'x' * 250, 'short line\nnext line', '  \n\n', paragraph + ' 日本語' * 40])
+    path = write_document(tmp_path / 'archive.txt', text)
+
+    chunker = StreamingTextChunker(chunk_size=120, chunk_overlap=30, block_size=block_size)
+    chunks = list(chunker.split_file(path, 'Doc'))
+    assert [c['text'] for c in chunks] == [c['text'] for c in reference_chunks(path, 120, 30)]
+    assert all(c['metadata'] == {'filename': 'Doc'} for c in chunks)
+
+    raw = text.encode('utf-8')
+    assert all(raw[c['start_byte']:c['end_byte']].decode('utf-8') == c['text'] for c in chunks)
+
+
+def test_streaming_chunker_reads_newlines_like_text_mode(tmp_path):
+    path = write_document(tmp_path / 'export.txt', 'First line\r\nSecond line\r\n\r\nOld Mac line\rend')
+    chunks = list(StreamingTextChunker(chunk_size=20, chunk_overlap=0).split_file(path))
+    assert [c['text'] for c in chunks] == [c['text'] for c in reference_chunks(path, 20, 0)]
+    assert chunks[0]['metadata']['filename'] == 'Export'
+
+
+def test_streaming_chunker_handles_empty_files_and_is_lazy(tmp_path):
+    assert list(StreamingTextChunker().split_file(write_document(tmp_path / 'empty.txt', ''))) == []
+
+    path = write_document(tmp_path / 'big.txt', 'word ' * 10000)
+    chunks = StreamingTextChunker(chunk_size=100, chunk_overlap=0).split_file(path)
+    assert next(chunks)['start_byte'] == 0
+
+
+def test_child_chunker_links_children_to_their_parent():
+    parent = {'text': 'Reset your password from the login page. ' * 10,
+              'metadata': {'filename': 'Faq', 'also_in': ['X']}, 'context_tokens': 120}
+    ids, children = ChildChunker(chunk_size=100, chunk_overlap=0).split([7], [parent])
+    assert len(children) > 1 and all(c['parent'] == 7 and len(c['text']) <= 100 for c in children)
+    assert children[0]['metadata'] == {'filename': 'Faq'}
+    assert len(set(ids)) == len(ids)
+    assert ids == ChildChunker(chunk_size=100, chunk_overlap=0).split([7], [parent])[0]
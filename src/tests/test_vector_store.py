@@ -1,133 +1,486 @@
-import numpy as np
-import pytest
-import sys
-from pathlib import Path
-sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
-
-from VectorStore import VectorStore
-
-
-class SimpleIndex:
-    def __init__(self, dim):
-        self.dim = dim
-        self.vectors = np.empty((0, dim), dtype=float)
-        self.ntotal = 0
-
-    def add(self, arr):
-        arr = np.asarray(arr)
-        self.vectors = np.vstack([self.vectors, arr])
-        self.ntotal += len(arr)
-
-    def search(self, query_embedding, top_k):
-        if self.ntotal == 0:
-            return np.empty((1, 0)), np.empty((1, 0), dtype=int)
-        q = np.asarray(query_embedding).reshape(-1)
-        dists = np.sum((self.vectors - q) ** 2, axis=1)
-        order = np.argsort(dists)[:top_k]
-        return dists[np.newaxis, order], order[np.newaxis, :]
-
-
-@pytest.fixture
-def vector_store(monkeypatch):
-    monkeypatch.setattr('VectorStore.faiss', type('f', (), {'IndexFlatL2': SimpleIndex}))
-    return VectorStore(embedding_dim=3)
-
-
-def test_vector_store_initialization(vector_store):
-    assert vector_store.embedding_dim == 3
-    assert vector_store.metadata == []
-
-
-def test_add_single_vector(vector_store):
-    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
-    metas = [{'id': 1}]
-    vector_store.add(vectors, metas)
-    assert len(vector_store.metadata) == 1
-    assert vector_store.metadata[0]['id'] == 1
-
-
-def test_add_multiple_vectors(vector_store):
-    vectors = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], dtype=float)
-    metas = [{'id': 1}, {'id': 2}]
-    vector_store.add(vectors, metas)
-    assert len(vector_store.metadata) == 2
-    assert vector_store.index.ntotal == 2
-
-
-def test_add_mismatched_vectors_and_metadata(vector_store):
-    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
-    metas = [{'id': 1}, {'id': 2}]
-    with pytest.raises(ValueError):
-        vector_store.add(vectors, metas)
-
-
-def test_search_basic(vector_store):
-    vectors = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]], dtype=float)
-    metas = [{'id': 1, 'doc': 'a'}, {'id': 2, 'doc': 'b'}]
-    vector_store.add(vectors, metas)
-    
-    q = np.array([[0.1, 0.1, 0.1]], dtype=float)
-    results = vector_store.search(q, top_k=2)
-    
-    assert isinstance(results, list)
-    assert len(results) <= 2
-    if results:
-        assert 'score' in results[0]
-        assert 'metadata' in results[0]
-
-
-def test_search_returns_closest_vector(vector_store):
-    vectors = np.array([[0.0, 0.0, 0.0], [10.0, 10.0, 10.0]], dtype=float)
-    metas = [{'id': 1}, {'id': 2}]
-    vector_store.add(vectors, metas)
-    
-    q = np.array([[0.1, 0.1, 0.1]], dtype=float)
-    results = vector_store.search(q, top_k=1)
-    
-    assert len(results) == 1
-    assert results[0]['metadata']['id'] == 1
-
-
-def test_search_empty_store(vector_store):
-    q = np.array([[1.0, 2.0, 3.0]], dtype=float)
-    results = vector_store.search(q, top_k=5)
-    assert results == []
-
-
-def test_search_top_k_limit(vector_store):
-    vectors = np.array([[float(i), float(i), float(i)] for i in range(5)], dtype=float)
-    metas = [{'id': i} for i in range(5)]
-    vector_store.add(vectors, metas)
-    
-    q = np.array([[0.0, 0.0, 0.0]], dtype=float)
-    results = vector_store.search(q, top_k=2)
-    assert len(results) <= 2
-
-
-def test_save_and_load(vector_store, tmp_path):
-    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
-    metas = [{'id': 1, 'content': 'test'}]
-    vector_store.add(vectors, metas)
-    
-    path = str(tmp_path / 'store')
-    vector_store.save(path)
-    
-    new_store = VectorStore(embedding_dim=3)
-    new_store.load(path)
-    
-    assert len(new_store.metadata) == 1
-    assert new_store.metadata[0]['id'] == 1
-
-
-def test_save_creates_directory(vector_store, tmp_path):
-    path = str(tmp_path / 'new_store')
-    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
-    vector_store.add(vectors, [{'id': 1}])
-    vector_store.save(path)
-    
-    assert Path(path).exists()
-
-
-def test_load_nonexistent_path(vector_store):
-    with pytest.raises(Exception):
-        vector_store.load('/nonexistent/path/store')
+import numpy as np
+import pickle
+import pytest
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+
+from VectorStore import VectorStore
+
+
+class SimpleIndex:
+    def __init__(self, dim):
+        self.dim = dim
+        self.vectors = np.empty((0, dim), dtype=float)
+        self.ntotal = 0
+
+    def add(self, arr):
+        arr = np.asarray(arr)
+        self.vectors = np.vstack([self.vectors, arr])
+        self.ntotal += len(arr)
+
+    def search(self, query_embedding, top_k):
+        if self.ntotal == 0:
+            n = len(np.atleast_2d(np.asarray(query_embedding)))
+            return np.empty((n, 0)), np.empty((n, 0), dtype=int)
+        q = np.atleast_2d(np.asarray(query_embedding))
+        dists = np.sum((self.vectors[np.newaxis, :, :] - q[:, np.newaxis, :]) ** 2, axis=2)
+        order = np.argsort(dists, axis=1)[:, :top_k]
+        return np.take_along_axis(dists, order, axis=1), order
+
+
+class SimpleIPIndex(SimpleIndex):
+    def search(self, query_embedding, top_k):
+        if self.ntotal == 0:
+            n = len(np.atleast_2d(np.asarray(query_embedding)))
+            return np.empty((n, 0)), np.empty((n, 0), dtype=int)
+        q = np.atleast_2d(np.asarray(query_embedding))
+        sims = q @ self.vectors.T
+        order = np.argsort(-sims, axis=1)[:, :top_k]
+        return np.take_along_axis(sims, order, axis=1), order
+
+
+class SimpleIDMap:
+    def __init__(self, index):
+        self.index = index
+        self.ids = np.empty(0, dtype=np.int64)
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    def add_with_ids(self, arr, ids):
+        self.index.add(arr)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+
+    def remove_ids(self, ids):
+        keep = ~np.isin(self.ids, ids)
+        self.index.vectors = self.index.vectors[keep]
+        self.index.ntotal = int(keep.sum())
+        self.ids = self.ids[keep]
+        return int((~keep).sum())
+
+    def search(self, query_embedding, top_k):
+        dists, order = self.index.search(query_embedding, top_k)
+        return dists, self.ids[order] if order.size else order
+
+
+def serialize_index(index):
+    return np.frombuffer(pickle.dumps(index), dtype=np.uint8)
+
+
+def read_index(path, flags=0):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def deserialize_index(data):
+    return pickle.loads(data.tobytes())
+
+
+fake_faiss = type('f', (), {
+    'IndexFlatL2': SimpleIndex,
+    'IndexFlatIP': SimpleIPIndex,
+    'IndexIDMap2': SimpleIDMap,
+    'IO_FLAG_MMAP_IFC': 1,
+    'IO_FLAG_READ_ONLY': 2,
+    'serialize_index': staticmethod(serialize_index),
+    'deserialize_index': staticmethod(deserialize_index),
+    'read_index': staticmethod(read_index),
+})
+
+
+@pytest.fixture
+def vector_store(monkeypatch):
+    monkeypatch.setattr('VectorStore.faiss', fake_faiss)
+    return VectorStore(embedding_dim=3)
+
+
+def test_vector_store_initialization(vector_store):
+    assert vector_store.embedding_dim == 3
+    assert len(vector_store.metadata) == 0
+
+
+def test_add_single_vector(vector_store):
+    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
+    metas = [{'id': 1}]
+    vector_store.add(vectors, metas)
+    assert len(vector_store.metadata) == 1
+    assert vector_store.metadata[0]['id'] == 1
+
+
+def test_add_multiple_vectors(vector_store):
+    vectors = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], dtype=float)
+    metas = [{'id': 1}, {'id': 2}]
+    vector_store.add(vectors, metas)
+    assert len(vector_store.metadata) == 2
+    assert vector_store.index.ntotal == 2
+
+
+def test_add_mismatched_vectors_and_metadata(vector_store):
+    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
+    metas = [{'id': 1}, {'id': 2}]
+    with pytest.raises(ValueError):
+        vector_store.add(vectors, metas)
+
+
+def test_search_basic(vector_store):
+    vectors = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]], dtype=float)
+    metas = [{'id': 1, 'doc': 'a'}, {'id': 2, 'doc': 'b'}]
+    vector_store.add(vectors, metas)
+    
+    q = np.array([[0.1, 0.1, 0.1]], dtype=float)
+    results = vector_store.search(q, top_k=2)
+    
+    assert isinstance(results, list)
+    assert len(results) <= 2
+    if results:
+        assert 'score' in results[0]
+        assert 'metadata' in results[0]
+
+
+def test_search_returns_closest_vector(vector_store):
+    vectors = np.array([[1.0, 0.0, 0.0], [0.0, 10.0, 0.0]], dtype=float)
+    metas = [{'id': 1}, {'id': 2}]
+    vector_store.add(vectors, metas)
+    
+    q = np.array([[0.9, 0.1, 0.0]], dtype=float)
+    results = vector_store.search(q, top_k=1)
+    
+    assert len(results) == 1
+    assert results[0]['metadata']['id'] == 1
+
+
+def test_search_empty_store(vector_store):
+    q = np.array([[1.0, 2.0, 3.0]], dtype=float)
+    results = vector_store.search(q, top_k=5)
+    assert results == []
+
+
+def test_search_top_k_limit(vector_store):
+    vectors = np.array([[float(i), float(i), float(i)] for i in range(5)], dtype=float)
+    metas = [{'id': i} for i in range(5)]
+    vector_store.add(vectors, metas)
+    
+    q = np.array([[0.0, 0.0, 0.0]], dtype=float)
+    results = vector_store.search(q, top_k=2)
+    assert len(results) <= 2
+
+
+def test_save_and_load(vector_store, tmp_path):
+    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
+    metas = [{'id': 1, 'content': 'test'}]
+    vector_store.add(vectors, metas)
+    
+    path = str(tmp_path / 'store')
+    vector_store.save(path)
+    
+    new_store = VectorStore(embedding_dim=3)
+    new_store.load(path)
+    
+    assert len(new_store.metadata) == 1
+    assert new_store.metadata[0]['id'] == 1
+
+
+def test_save_creates_directory(vector_store, tmp_path):
+    path = str(tmp_path / 'new_store')
+    vectors = np.array([[1.0, 2.0, 3.0]], dtype=float)
+    vector_store.add(vectors, [{'id': 1}])
+    vector_store.save(path)
+    
+    assert Path(path).exists()
+
+
+def test_load_nonexistent_path(vector_store):
+    with pytest.raises(Exception):
+        vector_store.load('/nonexistent/path/store')
+
+
+def test_scores_are_cosine_similarities(vector_store):
+    vectors = np.array([[2.0, 0.0, 0.0], [0.0, 5.0, 0.0], [1.0, 1.0, 0.0]], dtype=float)
+    vector_store.add(vectors, [{'id': i} for i in range(3)])
+    results = vector_store.search(np.array([[3.0, 0.0, 0.0]]), top_k=3)
+    assert [r['id'] for r in results] == [0, 2, 1]
+    np.testing.assert_allclose([r['score'] for r in results], [1.0, np.sqrt(0.5), 0.0], atol=1e-6)
+
+
+def test_load_rejects_l2_store(vector_store, tmp_path):
+    vector_store.add(np.array([[1.0, 2.0, 3.0]]), [{'id': 1}])
+    path = tmp_path / 'store'
+    vector_store.save(str(path))
+    (path / 'index.json').unlink()
+    with pytest.raises(ValueError):
+        VectorStore(embedding_dim=3).load(str(path))
+
+
+def test_add_with_explicit_ids(vector_store):
+    vectors = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], dtype=float)
+    vector_store.add(vectors, [{'id': 'a'}, {'id': 'b'}], ids=[101, 202])
+    assert vector_store.metadata[202]['id'] == 'b'
+    assert vector_store.next_id == 203
+
+
+def test_search_returns_chunk_ids(vector_store):
+    vectors = np.array([[0.0, 0.0, 0.0], [10.0, 10.0, 10.0]], dtype=float)
+    vector_store.add(vectors, [{'id': 1}, {'id': 2}], ids=[7, 9])
+    results = vector_store.search(np.array([[9.0, 9.0, 9.0]]), top_k=1)
+    assert results[0]['id'] == 9
+
+
+def test_remove_vectors(vector_store):
+    vectors = np.array([[0.0, 0.0, 0.0], [10.0, 10.0, 10.0]], dtype=float)
+    vector_store.add(vectors, [{'id': 1}, {'id': 2}], ids=[7, 9])
+    assert vector_store.remove([7, 12345]) == 1
+    assert vector_store.index.ntotal == 1
+    results = vector_store.search(np.array([[0.0, 0.0, 0.0]]), top_k=2)
+    assert [r['id'] for r in results] == [9]
+
+
+def test_update_replaces_vectors_and_bumps_version(vector_store):
+    vector_store.add(np.array([[0.0, 0.0, 0.0]]), [{'id': 'old'}], ids=[1])
+    version = vector_store.version
+    vector_store.update([1], np.array([[1.0, 1.0, 1.0]]), [{'id': 'new'}], [2])
+    assert vector_store.version > version
+    assert list(vector_store.metadata) == [2]
+    assert vector_store.index.ntotal == 1
+
+
+def test_reset_clears_store(vector_store):
+    vector_store.add(np.array([[0.0, 0.0, 0.0]]), [{'id': 1}])
+    version = vector_store.version
+    vector_store.reset()
+    assert vector_store.index.ntotal == 0
+    assert len(vector_store.metadata) == 0
+    assert vector_store.version > version
+
+
+def test_search_batch_returns_one_result_list_per_query(vector_store):
+    vectors = np.array([[1.0, 0.0, 0.0], [0.0, 10.0, 10.0]], dtype=float)
+    vector_store.add(vectors, [{'id': 'x'}, {'id': 'yz'}])
+    queries = np.array([[0.5, 0.1, 0.1], [0.0, 9.0, 8.0], [1.0, 11.0, 11.0]])
+    results = vector_store.search_batch(queries, top_k=1)
+    assert [r[0]['metadata']['id'] for r in results] == ['x', 'yz', 'yz']
+
+
+def ann_config(index_type, **overrides):
+    import config
+    settings = dict(index_type=index_type, nlist=8, nprobe=8, hnsw_m=8, ef_search=32,
+                    pq_m=4, pq_nbits=4, train_sample_size=400)
+    settings.update(overrides)
+    return config.VectorStoreConfig(**settings)
+
+
+@pytest.fixture
+def corpus():
+    rng = np.random.default_rng(1)
+    return rng.standard_normal((500, 16)).astype(np.float32)
+
+
+@pytest.mark.parametrize('index_type', ['ivf_flat', 'hnsw', 'ivf_pq'])
+def test_ann_index_finds_exact_vectors(index_type, corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config(index_type))
+    store.add(corpus, [{'row': i} for i in range(len(corpus))], ids=range(1000, 1500))
+    assert store.index.is_trained
+    results = store.search_batch(corpus[:20], top_k=3)
+    hits = sum(results[i][0]['id'] == 1000 + i for i in range(20))
+    assert hits >= 18
+
+
+@pytest.mark.parametrize('index_type', ['ivf_flat', 'hnsw', 'ivf_pq'])
+def test_ann_index_removal(index_type, corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config(index_type))
+    store.add(corpus, [{'row': i} for i in range(len(corpus))])
+    assert store.remove([0, 1, 2]) == 3
+    assert store.index.ntotal == 497
+    ids = {r['id'] for r in store.search(corpus[:1], top_k=5)}
+    assert 0 not in ids
+
+
+def test_ann_index_survives_save_and_load(corpus, tmp_path):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('hnsw', ef_search=48))
+    store.add(corpus, [{'row': i} for i in range(len(corpus))])
+    store.save(str(tmp_path / 'store'))
+
+    loaded = VectorStore(embedding_dim=16, index_config=ann_config('hnsw', ef_search=96))
+    loaded.load(str(tmp_path / 'store'))
+    assert loaded.index_type == 'hnsw'
+    import faiss
+    assert faiss.downcast_index(loaded.index.index).hnsw.efSearch == 96
+    assert loaded.search(corpus[5:6], top_k=1)[0]['id'] == 5
+
+
+def test_ivf_nlist_reduced_for_small_corpus(corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('ivf_flat', nlist=1024, nprobe=4))
+    store.add(corpus[:100], [{}] * 100)
+    assert store.index.nlist == 2
+    assert store.index.nprobe == 2
+
+
+def test_ivf_pq_falls_back_to_flat_when_too_small(corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('ivf_pq', pq_nbits=8))
+    store.add(corpus[:50], [{}] * 50)
+    assert store.index_type == 'flat'
+    assert store.search(corpus[:1], top_k=1)[0]['id'] == 0
+    store.reset()
+    assert store.index_type == 'ivf_pq'
+
+
+def test_set_search_params_updates_ivf(corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('ivf_flat'))
+    store.add(corpus, [{}] * len(corpus))
+    store.set_search_params(nprobe=3)
+    assert store.index.nprobe == 3
+
+
+def test_unknown_index_type_rejected():
+    with pytest.raises(ValueError):
+        VectorStore(embedding_dim=16, index_config=ann_config('annoy'))
+
+
+def test_index_report_flat_has_full_recall(corpus):
+    sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+    from index_report import make_queries, run_report
+
+    queries = make_queries(corpus, 30)
+    rows = run_report(corpus, queries, top_k=5, index_types=('flat', 'ivf_flat', 'hnsw'),
+                      nprobes=(1, 8), ef_searches=(16,), base_config=ann_config('flat'))
+    assert [r['index_type'] for r in rows] == ['flat', 'ivf_flat', 'ivf_flat', 'hnsw']
+    assert rows[0]['recall'] == 1.0
+    assert rows[1]['recall'] <= rows[2]['recall']
+
+
+def chunk(text, filename='Faq'):
+    return {'text': text, 'metadata': {'filename': filename}}
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'ivf_flat', 'hnsw'])
+def test_hybrid_search_surfaces_exact_identifier(index_type, corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config(index_type))
+    metas = [chunk(f"general hosting question {i}") for i in range(len(corpus))]
+    metas[321] = chunk("Error ERR_DNS_404 means the zone has no record")
+    store.add(corpus, metas, ids=range(1000, 1500))
+
+    query = corpus[:1]
+    dense = store.search(query, top_k=3)
+    assert 1321 not in {r['id'] for r in dense}
+    hybrid = store.search(query, top_k=3, query_text="getting ERR_DNS_404")
+    assert len(hybrid) == 3
+    by_id = {r['id']: r for r in hybrid}
+    assert 1321 in by_id and 1000 in by_id
+    # Keyword-only hits still carry their cosine similarity for the relevance gate
+    expected = float((VectorStore.normalize(corpus[321]) @ VectorStore.normalize(query).T)[0, 0])
+    assert by_id[1321]['score'] == pytest.approx(expected, abs=1e-4)
+    assert by_id[1321]['bm25_score'] > 0
+
+
+def test_hybrid_search_batch_and_removal(corpus):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('flat'))
+    metas = [chunk("plain text") for _ in range(10)]
+    metas[7] = chunk("WHOIS privacy settings")
+    store.add(corpus[:10], metas)
+    results = store.search_batch(corpus[:2], top_k=2, query_texts=["whois", "nothing matches"])
+    assert 7 in {r['id'] for r in results[0]}
+    assert [r['id'] for r in results[1]] == [r['id'] for r in store.search(corpus[1:2], top_k=2)]
+
+    store.remove([7])
+    assert 7 not in {r['id'] for r in store.search(corpus[:1], top_k=2, query_text="whois")}
+
+
+def test_lexical_index_persisted_with_store(corpus, tmp_path):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('ivf_flat'))
+    metas = [chunk(f"text {i}") for i in range(len(corpus))]
+    metas[42] = chunk("Product name SuperHost Pro")
+    store.add(corpus, metas)
+    path = tmp_path / 'store'
+    store.save(str(path))
+    assert (path / 'lexical' / 'postings.npy').exists()
+
+    loaded = VectorStore(embedding_dim=16, index_config=ann_config('ivf_flat'))
+    loaded.load(str(path))
+    assert loaded.lexical.search("superhost") == [(42, pytest.approx(store.lexical.search("superhost")[0][1]))]
+    assert 42 in {r['id'] for r in loaded.search(corpus[:1], top_k=3, query_text="SuperHost")}
+
+    # Stores saved without postings get them rebuilt from the chunk text
+    import shutil
+    shutil.rmtree(path / 'lexical')
+    rebuilt = VectorStore(embedding_dim=16, index_config=ann_config('ivf_flat'))
+    rebuilt.load(str(path))
+    assert rebuilt.lexical.search("superhost")[0][0] == 42
+
+
+def test_hybrid_disabled_ignores_query_text(corpus):
+    import config
+    store = VectorStore(embedding_dim=16, index_config=ann_config('flat'),
+                        hybrid_config=config.HybridSearchConfig(enabled=False))
+    metas = [chunk("plain text") for _ in range(10)]
+    metas[7] = chunk("WHOIS privacy settings")
+    store.add(corpus[:10], metas)
+    assert store.lexical is None
+    assert store.search(corpus[:1], top_k=2, query_text="whois") == store.search(corpus[:1], top_k=2)
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'ivf_flat', 'hnsw'])
+def test_mmap_load_is_read_only_until_updated(index_type, corpus, tmp_path):
+    store = VectorStore(embedding_dim=16, index_config=ann_config(index_type))
+    store.add(corpus, [chunk(f"row {i} ünïcode") for i in range(len(corpus))], ids=range(1000, 1500))
+    path = tmp_path / 'store'
+    store.save(str(path))
+    assert not list(path.glob('*.pkl'))
+
+    loaded = VectorStore(embedding_dim=16, index_config=ann_config(index_type))
+    loaded.load(str(path))
+    assert isinstance(loaded.metadata.text, np.memmap)
+    assert loaded.next_id == 1500
+    result = loaded.search(corpus[3:4], top_k=1)[0]
+    assert result['id'] == 1003 and result['metadata']['text'] == "row 3 ünïcode"
+
+    # The first change copies the mapped index into private memory; the snapshot is untouched
+    loaded.update([1003], corpus[3:4], [chunk("replacement")], [2000])
+    assert not loaded._mapped
+    assert loaded.search(corpus[3:4], top_k=1)[0]['id'] == 2000
+    again = VectorStore(embedding_dim=16, index_config=ann_config(index_type))
+    again.load(str(path))
+    assert again.search(corpus[3:4], top_k=1)[0]['id'] == 1003
+
+
+def test_load_without_mmap_reads_into_memory(corpus, tmp_path):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('flat'))
+    store.add(corpus[:10], [chunk(f"row {i}") for i in range(10)])
+    store.save(str(tmp_path / 'store'))
+    loaded = VectorStore(embedding_dim=16, index_config=ann_config('flat', mmap=False))
+    loaded.load(str(tmp_path / 'store'))
+    assert not isinstance(loaded.metadata.text, np.memmap)
+    assert loaded.metadata[4]['text'] == "row 4"
+    # Already private, so the first update changes the index in place
+    assert not loaded._mapped
+    index = loaded.index
+    loaded.update([4], corpus[4:5], [chunk("replacement")], [99])
+    assert loaded.index is index
+
+
+def test_child_hits_collapse_to_distinct_parents(corpus, tmp_path):
+    store = VectorStore(embedding_dim=16, index_config=ann_config('flat', child_fanout=3))
+    parents = ([1, 2], [chunk("first section"), chunk("second section")])
+    children = [dict(chunk(f"child {i}"), parent=1 if i < 3 else 2) for i in range(6)]
+    # Children 0-2 belong to parent 1 and are all close to the query
+    vectors = np.vstack([corpus[0] + 0.01 * i for i in range(3)] + [corpus[1:4]])
+    store.add(vectors, children, ids=range(100, 106), parents=parents)
+
+    results = store.search(corpus[:1], top_k=2)
+    assert [r['id'] for r in results] == [1, 2]
+    assert results[0]['metadata']['text'] == "first section"
+    assert results[0]['children'][0] == 100 and len(results[0]['children']) == 3
+    assert [r['id'] for r in store.search(corpus[:1], top_k=2, query_text="child")] == [1, 2]
+
+    store.save(str(tmp_path / 'store'))
+    loaded = VectorStore(embedding_dim=16, index_config=ann_config('flat', child_fanout=3))
+    loaded.load(str(tmp_path / 'store'))
+    assert [r['id'] for r in loaded.search(corpus[:1], top_k=2)] == [1, 2]
+    assert loaded.chunk(2)['text'] == "second section" and loaded.chunk(104)['parent'] == 2
+
+    # Removing a parent removes its children; parent chunks can be updated in place
+    loaded.update([1], [], [], [])
+    assert loaded.index.ntotal == 3 and 1 not in loaded.parents
+    loaded.set_metadata([2], [chunk("second section, revised")])
+    assert [(r['id'], r['metadata']['text']) for r in loaded.search(corpus[:1], top_k=2)] == \
+        [(2, "second section, revised")]
@@ -0,0 +1,388 @@
+"""
+Per-stage micro-benchmarks with regression baselines.
+
+Times each stage of the pipeline on its own, on a synthetic corpus of the
+requested size: chunking, document and query embedding, VectorStore add,
+search, save and load, prompt building and RAGAgent.answer_query against an
+in-process stub LLM:
+
+    python src/tools/benchmark.py --baseline my_baseline.json --update-baseline
+    python src/tools/benchmark.py --baseline my_baseline.json
+    python src/tools/benchmark.py --chunks 1000000 --embedder model --json bench.json
+
+With --embedder hash (the default) vectors come from a hash of the text and
+the embedding stages are skipped, so every other stage is measured without
+loading a model; --embedder model embeds --embed-sample chunks with the
+configured EmbeddingService. The store stages always use synthetic vectors so
+corpora of a million chunks do not have to be embedded.
+
+Every stage runs --rounds times and keeps its best result. A stage regresses
+when its time (seconds, or p50/p95 latency) grows by more than --threshold
+relative to the baseline and by more than a small absolute noise floor; the
+exit status is 1 when any stage regressed.
+Baselines are only comparable when the workload (chunks, embedder, index
+type) matches and on the machine that recorded them, so none is shipped:
+record one with --update-baseline before comparing.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from dataclasses import replace
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import config
+
+
+WORDS = ("domain", "renewal", "WHOIS", "contact", "policy", "suspended", "account", "invoice", "refund",
+         "registrar", "transfer", "within", "days", "email", "password", "reset", "login", "DNS", "record",
+         "abuse", "report", "the", "is", "a", "of", "to", "and", "for", "your", "after")
+# Settings that define the workload; results are only compared when they match
+WORKLOAD_KEYS = ("chunks", "embedder", "embedding_dim", "index_type", "chunk_size")
+# Metrics judged for regressions; rates and means are reported but follow from these
+COMPARED_METRICS = ("seconds", "p50_ms", "p95_ms")
+# Absolute differences below these are timer and scheduler noise, whatever the relative change
+NOISE_FLOOR = {"seconds": 0.002, "p50_ms": 0.05, "p95_ms": 0.05}
+
+
+def synthetic_documents(chunks: int, chunk_size: int = 1000, chunks_per_doc: int = 20, seed: int = 0):
+    #(name, text) documents of short paragraphs, sized to split into roughly `chunks` chunks
+    rng = np.random.default_rng(seed)
+    words = np.array(WORDS)
+    docs = []
+    total_chars = int(chunks * chunk_size * 0.9)
+    doc_chars = chunks_per_doc * chunk_size
+    for index in range(max(1, -(-total_chars // doc_chars))):
+        paragraphs, size = [], 0
+        while size < min(doc_chars, total_chars - index * doc_chars):
+            sentences = [" ".join(words[rng.integers(0, len(words), rng.integers(6, 18))]).capitalize() + "."
+                         for _ in range(rng.integers(2, 6))]
+            paragraph = " ".join(sentences)
+            paragraphs.append(paragraph)
+            size += len(paragraph) + 2
+        docs.append((f"Document {index}", "\n\n".join(paragraphs)))
+    return docs
+
+
+def synthetic_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    #Unit vectors around a few hundred centers, so ANN indexes see clustered data like real embeddings
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((min(256, max(1, n // 10)), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class HashEmbedder:
+    #Deterministic text -> vector stand-in with the EmbeddingService interface
+    model_name = "hash"
+    backend = "hash"
+
+    def __init__(self, embedding_dim: int = 384):
+        self.embedding_dim = embedding_dim
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+        return np.random.default_rng(seed).standard_normal(self.embedding_dim).astype(np.float32)
+
+    def embed_documents(self, chunks: list[dict], show_progress: bool = True):
+        return np.array([self._vector(chunk['text']) for chunk in chunks], dtype=np.float32), chunks
+
+    def embed_query(self, query: str) -> np.ndarray:
+        return self._vector(query)[np.newaxis, :]
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        return np.array([self._vector(query) for query in queries], dtype=np.float32)
+
+
+class StubLLM:
+    #In-process LLM answering like tools/llm_stub.py, so answer_query is timed without any network
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    async def generate(self, prompt, response_model, temperature: float = 0.0, prefix: str = None):
+        from llm_stub import build_answer
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return response_model(**build_answer((prefix or "") + prompt))
+
+
+def latency(samples: list[float]) -> dict:
+    #Milliseconds from per-call seconds
+    samples = np.array(samples) * 1000.0
+    return {"p50_ms": float(np.percentile(samples, 50)), "p95_ms": float(np.percentile(samples, 95)),
+            "mean_ms": float(samples.mean())}
+
+
+def time_calls(fn, args_list) -> list[float]:
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def best_time(fn, budget: float = 1.0, max_repeat: int = 5):
+    #Fastest of several runs until `budget` seconds are spent, so small corpora are not timed on a single
+    #noisy run while large ones still run once; returns (seconds, result of the last run)
+    best, spent, runs = float("inf"), 0.0, 0
+    while runs < max_repeat and (runs == 0 or spent < budget):
+        start = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - start
+        best, spent, runs = min(best, seconds), spent + seconds, runs + 1
+    return best, result
+
+
+def bench_chunking(docs, chunker_config) -> tuple[dict, list[dict]]:
+    from TextProcessor import TextChunker
+    seconds, chunks = best_time(lambda: TextChunker(docs, chunk_size=chunker_config.chunk_size,
+                                                    chunk_overlap=chunker_config.chunk_overlap).split_docs())
+    return {"seconds": seconds, "chunks_per_second": len(chunks) / seconds}, chunks
+
+
+def bench_embedding(service, chunks: list[dict], queries: list[str]) -> dict:
+    #Document throughput after a warm-up batch, then uncached single-query latency
+    service.embed_documents(chunks[:32], show_progress=False)
+    start = time.perf_counter()
+    service.embed_documents(chunks, show_progress=False)
+    seconds = time.perf_counter() - start
+    return {
+        "embed_documents": {"seconds": seconds, "chunks_per_second": len(chunks) / seconds},
+        "embed_query": latency(time_calls(service.embed_query, [(query,) for query in queries])),
+    }
+
+
+def bench_vector_store(vectors: np.ndarray, chunks: list[dict], queries: np.ndarray, query_texts: list[str],
+                       index_config, top_k: int, batch_size: int = 10_000) -> dict:
+    from VectorStore import VectorStore
+    results = {}
+
+    def build():
+        store = VectorStore(embedding_dim=vectors.shape[1], index_config=index_config)
+        for offset in range(0, len(vectors), batch_size):
+            store.add(vectors[offset:offset + batch_size], chunks[offset:offset + batch_size],
+                      ids=range(offset, min(offset + batch_size, len(vectors))))
+        return store
+
+    seconds, store = best_time(build)
+    results["vector_store_add"] = {"seconds": seconds, "vectors_per_second": len(vectors) / seconds}
+
+    results["search"] = latency(time_calls(store.search, [(query[np.newaxis, :], top_k) for query in queries]))
+    results["hybrid_search"] = latency(time_calls(
+        lambda query, text: store.search(query[np.newaxis, :], top_k=top_k, query_text=text),
+        list(zip(queries, query_texts))))
+
+    with tempfile.TemporaryDirectory() as path:
+        results["save"] = {"seconds": best_time(lambda: store.save(path))[0]}
+
+        def load():
+            loaded = VectorStore(embedding_dim=vectors.shape[1], index_config=index_config)
+            loaded.load(path)
+            # A mapped store is only usable once its first search has touched it
+            loaded.search(queries[:1], top_k=top_k)
+
+        results["load"] = {"seconds": best_time(load)[0]}
+    return results
+
+
+def bench_prompt(chunks: list[dict], queries: list[str], top_k: int) -> dict:
+    from PromptBuilder import PromptBuilder
+    PromptBuilder.prompt_prefix()
+    docs = [{"id": i, "score": 0.5, "metadata": PromptBuilder.prepare_chunk(dict(chunk))}
+            for i, chunk in enumerate(chunks[:top_k])]
+    return latency(time_calls(PromptBuilder.build_prompt, [(query, docs) for query in queries]))
+
+
+def bench_answer_query(embedder, vectors: np.ndarray, chunks: list[dict], queries: list[str],
+                       index_config, top_k: int) -> dict:
+    #answer_query end to end with the real retrieval and prompt code and a stub LLM; the relevance
+    #gate is opened so every query reaches the prompt and the LLM call
+    from PromptBuilder import PromptBuilder
+    from RAGService import RAGAgent
+    from VectorStore import VectorStore
+    store = VectorStore(embedding_dim=vectors.shape[1], index_config=index_config)
+    store.add(vectors, [PromptBuilder.prepare_chunk(dict(chunk)) for chunk in chunks], ids=range(len(vectors)))
+    agent = RAGAgent(StubLLM(), store, embedder, config.TicketResponse,
+                     relevance_config=config.RelevanceGateConfig(threshold=-1.0))
+
+    async def run():
+        samples = []
+        for query in queries:
+            start = time.perf_counter()
+            await agent.answer_query(query, top_k=top_k)
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    return latency(asyncio.run(run()))
+
+
+def make_queries(chunks: list[dict], count: int, seed: int = 1) -> list[str]:
+    #Distinct ticket-like queries made of words from random chunks
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in range(count):
+        words = chunks[int(rng.integers(0, len(chunks)))]['text'].split()[:12]
+        queries.append(f"Question {i}: " + " ".join(words))
+    return queries
+
+
+def run_benchmarks(chunks: int = 10_000, embedder: str = "hash", queries: int = 200, embed_sample: int = 2000,
+                   top_k: int = 5, index_config=None, chunker_config=None, log=print) -> dict:
+    index_config = index_config or config.VectorStoreConfig()
+    chunker_config = chunker_config or config.ChunkerConfig()
+    dim = config.VectorStoreConfig.embedding_dim
+    if embedder == "model":
+        from EmbeddingService import EmbeddingService
+        service = EmbeddingService(model_name=config.EmbeddingServiceConfig.model_name, embedding_dim=dim,
+                                   query_cache_size=0, backend=config.EmbeddingServiceConfig.backend,
+                                   quantize=config.EmbeddingServiceConfig.quantize,
+                                   quantization_target=config.EmbeddingServiceConfig.quantization_target,
+                                   model_cache_dir=str(config.EmbeddingServiceConfig.model_cache_dir))
+    else:
+        service = HashEmbedder(dim)
+
+    report = {
+        "meta": {
+            "chunks": chunks,
+            "embedder": embedder,
+            "embedding_dim": dim,
+            "index_type": index_config.index_type,
+            "chunk_size": chunker_config.chunk_size,
+            "queries": queries,
+            "top_k": top_k,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "created_at": time.time(),
+        },
+        "stages": {},
+    }
+    stages = report["stages"]
+
+    log(f"chunking a synthetic corpus of ~{chunks} chunks")
+    stages["chunking"], corpus = bench_chunking(synthetic_documents(chunks, chunker_config.chunk_size), chunker_config)
+    # Repeat the corpus when chunking came out a little short, so every later stage sees `chunks` chunks
+    corpus = (corpus * -(-chunks // len(corpus)))[:chunks]
+    query_texts = make_queries(corpus, queries)
+
+    if embedder == "model":
+        log(f"embedding {min(embed_sample, chunks)} chunks and {queries} queries")
+        stages.update(bench_embedding(service, corpus[:embed_sample], query_texts))
+
+    vectors = synthetic_vectors(chunks, dim)
+    query_vectors = synthetic_vectors(queries, dim, seed=2)
+    log(f"vector store: add, search, save and load of {chunks} vectors")
+    stages.update(bench_vector_store(vectors, corpus, query_vectors, query_texts, index_config, top_k))
+
+    log("prompt building and answer_query")
+    stages["build_prompt"] = bench_prompt(corpus, query_texts, top_k)
+    sample = min(chunks, 10_000)
+    stages["answer_query"] = bench_answer_query(service, vectors[:sample], corpus[:sample], query_texts,
+                                                index_config, top_k)
+    return report
+
+
+def best_of(reports: list[dict]) -> dict:
+    #Best value of every metric across repeated rounds; on shared machines the slow outliers are
+    #neighbours and frequency scaling, not the code under test
+    best = {"meta": dict(reports[0]["meta"], rounds=len(reports)), "stages": {}}
+    for stage, metrics in reports[0]["stages"].items():
+        best["stages"][stage] = {}
+        for metric in metrics:
+            values = [report["stages"][stage][metric] for report in reports]
+            best["stages"][stage][metric] = max(values) if metric.endswith("_per_second") else min(values)
+    return best
+
+
+def compare(report: dict, baseline: dict, threshold: float = 0.2) -> list[dict]:
+    #One row per compared metric present in both; a timing regresses when it grows by more than `threshold`
+    for key in WORKLOAD_KEYS:
+        if report["meta"].get(key) != baseline["meta"].get(key):
+            raise ValueError(f"Baseline workload differs in {key}: "
+                             f"{baseline['meta'].get(key)} vs {report['meta'].get(key)}")
+    rows = []
+    for stage, metrics in report["stages"].items():
+        for metric, current in metrics.items():
+            previous = baseline["stages"].get(stage, {}).get(metric)
+            if metric not in COMPARED_METRICS or previous is None:
+                continue
+            change = (current - previous) / previous if previous else 0.0
+            noise = abs(current - previous) < NOISE_FLOOR[metric]
+            rows.append({"stage": stage, "metric": metric, "baseline": previous, "current": current,
+                         "change": change, "regression": change > threshold and not noise})
+    return rows
+
+
+def format_comparison(rows: list[dict], threshold: float) -> str:
+    lines = [f"{'stage':<18} {'metric':<18} {'baseline':>12} {'current':>12} {'change':>8}"]
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(f"{row['stage']:<18} {row['metric']:<18} {row['baseline']:>12.4g} {row['current']:>12.4g} "
+                     f"{row['change']:>+8.1%}{flag}")
+    regressions = sum(row["regression"] for row in rows)
+    lines.append(f"{regressions} of {len(rows)} metrics regressed by more than {threshold:.0%}")
+    return "\n".join(lines)
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{'stage':<18} metrics"]
+    for stage, metrics in report["stages"].items():
+        lines.append(f"{stage:<18} " + ", ".join(f"{k}={v:.4g}" for k, v in metrics.items()))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=10_000)
+    parser.add_argument("--embedder", choices=("hash", "model"), default="hash")
+    parser.add_argument("--embed-sample", type=int, default=2000, help="chunks embedded with --embedder model")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=config.VectorStoreConfig.top_k)
+    parser.add_argument("--index-type", default=config.VectorStoreConfig.index_type)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to --baseline instead")
+    parser.add_argument("--rounds", type=int, default=3, help="repeat every stage and keep the best result")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    index_config = replace(config.VectorStoreConfig(), index_type=args.index_type)
+    report = best_of([run_benchmarks(chunks=args.chunks, embedder=args.embedder, queries=args.queries,
+                                     embed_sample=args.embed_sample, top_k=args.top_k, index_config=index_config)
+                      for _ in range(args.rounds)])
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+    elif args.baseline:
+        try:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            sys.exit(f"{args.baseline} does not exist; record it first with --update-baseline")
+        try:
+            rows = compare(report, baseline, args.threshold)
+        except ValueError as e:
+            sys.exit(f"Cannot compare with {args.baseline}: {e}; re-record it with --update-baseline")
+        print(format_comparison(rows, args.threshold))
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Parity and throughput of the embedding backends.
+
+Embeds the chunks of the data directory with every backend, measures
+corpus throughput and single-query latency, and compares each backend's
+vectors against the fp32 PyTorch model:
+
+    python src/tools/embedding_report.py
+    python src/tools/embedding_report.py --backends torch onnx onnx-int8 --tolerance 0.99
+
+A backend passes when the cosine similarity between its vector and the
+reference vector is at least --tolerance for every chunk. The report ends
+with the fastest backend that passes. The ONNX backends need
+`pip install optimum[onnxruntime]`.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services"))
+
+import config
+
+
+def backend_settings(name: str, quantization_target: str = "avx2") -> dict:
+    #Report names map to EmbeddingService settings: torch, onnx, onnx-int8
+    if name == "torch":
+        return {"backend": "torch", "quantize": False}
+    if name == "onnx":
+        return {"backend": "onnx", "quantize": False}
+    if name == "onnx-int8":
+        return {"backend": "onnx", "quantize": True, "quantization_target": quantization_target}
+    raise ValueError(f"Unknown backend {name!r}, expected torch, onnx or onnx-int8")
+
+
+def load_texts() -> list[str]:
+    from TextProcessor import FileLoader, TextChunker
+
+    docs = FileLoader(str(config.FileLoaderConfig.path)).load_files()
+    chunks = TextChunker(docs, chunk_size=config.ChunkerConfig.chunk_size,
+                         chunk_overlap=config.ChunkerConfig.chunk_overlap).split_docs()
+    return [chunk['text'] for chunk in chunks]
+
+
+def agreement(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    #Row-wise cosine similarity between two embeddings of the same texts
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosines = np.sum(reference * candidate, axis=1)
+    return {
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "p1_cosine": float(np.percentile(cosines, 1)),
+    }
+
+
+def benchmark(model, texts: list[str], queries: list[str], batch_size: int = 32) -> tuple[np.ndarray, dict]:
+    #Corpus throughput (one encode call) and single-query latency, after one warm-up call
+    model.encode(texts[:batch_size], convert_to_numpy=True, show_progress_bar=False, batch_size=batch_size)
+
+    start = time.perf_counter()
+    vectors = model.encode(texts, convert_to_numpy=True, show_progress_bar=False, batch_size=batch_size)
+    corpus_seconds = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.encode(query, convert_to_numpy=True, show_progress_bar=False)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000.0
+
+    return np.asarray(vectors, dtype=np.float32), {
+        "texts_per_second": len(texts) / corpus_seconds,
+        "query_mean_ms": float(latencies.mean()),
+        "query_p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def fastest_within_tolerance(rows: list[dict], tolerance: float):
+    passing = [row for row in rows if row["min_cosine"] >= tolerance]
+    return max(passing, key=lambda row: row["texts_per_second"]) if passing else None
+
+
+def run_report(texts: list[str], backends, models: dict = None, batch_size: int = 32,
+               query_count: int = 50, quantization_target: str = "avx2") -> list[dict]:
+    #The first backend is the reference the others are compared against
+    from EmbeddingService import load_model
+
+    models = models or {}
+    queries = texts[:query_count]
+    rows, reference = [], None
+    for name in backends:
+        model = models.get(name)
+        if model is None:
+            model = load_model(config.EmbeddingServiceConfig.model_name,
+                               cache_dir=str(config.EmbeddingServiceConfig.model_cache_dir),
+                               **backend_settings(name, quantization_target))
+        vectors, timings = benchmark(model, texts, queries, batch_size=batch_size)
+        if reference is None:
+            reference = vectors
+        rows.append(dict(backend=name, **timings, **agreement(reference, vectors)))
+    return rows
+
+
+def format_report(rows: list[dict], tolerance: float) -> str:
+    lines = [f"{'backend':<12} {'texts/s':>9} {'query ms':>9} {'p95 ms':>9} {'min cos':>9} {'mean cos':>9}"]
+    for row in rows:
+        lines.append(f"{row['backend']:<12} {row['texts_per_second']:>9.1f} {row['query_mean_ms']:>9.2f} "
+                     f"{row['query_p95_ms']:>9.2f} {row['min_cosine']:>9.4f} {row['mean_cosine']:>9.4f}")
+    best = fastest_within_tolerance(rows, tolerance)
+    if best is None:
+        lines.append(f"no backend stays within min cosine {tolerance}")
+    else:
+        lines.append(f"fastest backend within min cosine {tolerance}: {best['backend']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"],
+                        help="backends to compare; the first one is the reference")
+    parser.add_argument("--quantization-target", default=config.EmbeddingServiceConfig.quantization_target)
+    parser.add_argument("--tolerance", type=float, default=0.99)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--json", help="also write the report rows to this file")
+    args = parser.parse_args()
+
+    texts = load_texts()
+    print(f"{len(texts)} chunks from {config.FileLoaderConfig.path}")
+    rows = run_report(texts, args.backends, batch_size=args.batch_size, query_count=args.queries,
+                      quantization_target=args.quantization_target)
+    print(format_report(rows, args.tolerance))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
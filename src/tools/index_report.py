@@ -0,0 +1,169 @@
+"""
+Recall vs latency of the configurable vector index types.
+
+Embeds the chunks of the data directory (or loads vectors saved with
+--save-vectors), builds every index type from VectorStoreConfig over them and
+compares each search setting against the exact flat index:
+
+    python src/tools/index_report.py --queries 500 --top-k 5
+    python src/tools/index_report.py --vectors chunks.npy --json report.json
+
+Queries are corpus vectors with a little noise added, so recall is measured on
+points that look like the indexed data without being exact copies of it.
+"""
+import argparse
+import json
+import sys
+import time
+from dataclasses import replace
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services"))
+
+import config
+import faiss
+from VectorStore import VectorStore
+
+
+DEFAULT_NPROBES = (1, 4, 16, 64)
+DEFAULT_EF_SEARCHES = (16, 32, 64, 128)
+
+
+def embed_corpus() -> np.ndarray:
+    #Chunk and embed the data directory exactly as the service does
+    from EmbeddingService import EmbeddingService
+    from TextProcessor import FileLoader, TextChunker
+
+    docs = FileLoader(str(config.FileLoaderConfig.path)).load_files()
+    chunks = TextChunker(docs, chunk_size=config.ChunkerConfig.chunk_size,
+                         chunk_overlap=config.ChunkerConfig.chunk_overlap).split_docs()
+    service = EmbeddingService(model_name=config.EmbeddingServiceConfig.model_name,
+                               embedding_dim=config.VectorStoreConfig.embedding_dim,
+                               query_cache_size=0,
+                               backend=config.EmbeddingServiceConfig.backend,
+                               quantize=config.EmbeddingServiceConfig.quantize,
+                               quantization_target=config.EmbeddingServiceConfig.quantization_target,
+                               model_cache_dir=str(config.EmbeddingServiceConfig.model_cache_dir))
+    embeddings, _ = service.embed_documents(chunks)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def make_queries(vectors: np.ndarray, n: int, noise: float = 0.1, seed: int = 0) -> np.ndarray:
+    #Perturbed copies of random corpus vectors, noise scaled by the per-dimension spread
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), size=n, replace=n > len(vectors))
+    scale = vectors.std(axis=0, keepdims=True) * noise
+    queries = vectors[rows] + rng.standard_normal((n, vectors.shape[1])).astype(np.float32) * scale
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def build_store(vectors: np.ndarray, index_config) -> tuple[VectorStore, float]:
+    store = VectorStore(embedding_dim=vectors.shape[1], index_config=index_config)
+    start = time.perf_counter()
+    store.add(vectors, [{}] * len(vectors), ids=np.arange(len(vectors)))
+    return store, time.perf_counter() - start
+
+
+def measure(store: VectorStore, queries: np.ndarray, exact: list, top_k: int) -> dict:
+    #Recall@k against the exact neighbours, with one search per query as the API issues them
+    latencies = []
+    hits = 0
+    for query, truth in zip(queries, exact):
+        start = time.perf_counter()
+        results = store.search(query[np.newaxis, :], top_k=top_k)
+        latencies.append(time.perf_counter() - start)
+        hits += len(truth.intersection(r["id"] for r in results))
+
+    latencies = np.array(latencies) * 1000.0
+    return {
+        "recall": hits / (len(queries) * top_k),
+        "mean_ms": float(latencies.mean()),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def run_report(vectors: np.ndarray, queries: np.ndarray, top_k: int = 5, index_types=None,
+               nprobes=DEFAULT_NPROBES, ef_searches=DEFAULT_EF_SEARCHES, base_config=None) -> list[dict]:
+    #One row per index type and search setting; the flat index provides the ground truth
+    base_config = base_config or config.VectorStoreConfig()
+    index_types = index_types or ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+    flat, _ = build_store(vectors, replace(base_config, index_type="flat"))
+    exact = [{r["id"] for r in results} for results in flat.search_batch(queries, top_k=top_k)]
+
+    rows = []
+    for index_type in index_types:
+        index_config = replace(base_config, index_type=index_type)
+        if index_type == "ivf_pq" and vectors.shape[1] % index_config.pq_m:
+            print(f"skipping ivf_pq: pq_m={index_config.pq_m} does not divide {vectors.shape[1]}")
+            continue
+        store, build_seconds = build_store(vectors, index_config)
+
+        if store.index_type in ("ivf_flat", "ivf_pq"):
+            settings = [{"nprobe": n} for n in nprobes]
+        elif store.index_type == "hnsw":
+            settings = [{"ef_search": ef} for ef in ef_searches]
+        else:
+            settings = [{}]
+
+        size = int(faiss.serialize_index(store.index).nbytes)
+        for params in settings:
+            store.set_search_params(**params)
+            row = {
+                "index_type": index_type,
+                "built_index_type": store.index_type,
+                "params": params,
+                "build_seconds": build_seconds,
+                "index_bytes": size,
+            }
+            row.update(measure(store, queries, exact, top_k))
+            rows.append(row)
+    return rows
+
+
+def format_report(rows: list[dict], top_k: int) -> str:
+    lines = [f"{'index':<10} {'params':<16} {'recall@' + str(top_k):>9} {'mean ms':>9} "
+             f"{'p95 ms':>9} {'build s':>9} {'MB':>8}"]
+    for row in rows:
+        index = row["index_type"]
+        if row["built_index_type"] != index:
+            index = f"{index}*"
+        params = ",".join(f"{k}={v}" for k, v in row["params"].items()) or "-"
+        lines.append(f"{index:<10} {params:<16} {row['recall']:>9.3f} {row['mean_ms']:>9.3f} "
+                     f"{row['p95_ms']:>9.3f} {row['build_seconds']:>9.2f} "
+                     f"{row['index_bytes'] / 1e6:>8.2f}")
+    if any(row["built_index_type"] != row["index_type"] for row in rows):
+        lines.append("* corpus too small to train this index type, a flat index was built instead")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", help="load corpus vectors from this .npy file instead of embedding")
+    parser.add_argument("--save-vectors", help="save the embedded corpus vectors to this .npy file")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.1)
+    parser.add_argument("--top-k", type=int, default=config.VectorStoreConfig.top_k)
+    parser.add_argument("--index-types", nargs="+", default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=list(DEFAULT_NPROBES))
+    parser.add_argument("--ef-search", type=int, nargs="+", default=list(DEFAULT_EF_SEARCHES))
+    parser.add_argument("--json", help="also write the report rows to this file")
+    args = parser.parse_args()
+
+    vectors = np.load(args.vectors).astype(np.float32) if args.vectors else embed_corpus()
+    if args.save_vectors:
+        np.save(args.save_vectors, vectors)
+    queries = make_queries(vectors, args.queries, noise=args.noise)
+    print(f"{len(vectors)} vectors of dim {vectors.shape[1]}, {len(queries)} queries")
+
+    rows = run_report(vectors, queries, top_k=args.top_k, index_types=args.index_types,
+                      nprobes=args.nprobe, ef_searches=args.ef_search)
+    print(format_report(rows, args.top_k))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
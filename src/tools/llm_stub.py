@@ -0,0 +1,318 @@
+"""
+Local stand-in for the Gemini API.
+
+Serves the generateContent, streamGenerateContent and cachedContents
+endpoints used by LLMService so concurrency, throughput, streaming and
+prompt caching can be tested without network access or an API key:
+
+    python src/tools/llm_stub.py --port 8090 --latency 0.5 --chunk-delay 0.05
+    LLM_BASE_URL=http://localhost:8090 uvicorn app:app --port 8000
+
+For load tests the latency can be drawn from a distribution and a share of
+requests can fail or return answers that do not match the schema:
+
+    python src/tools/llm_stub.py --latency 0.8 --latency-distribution lognormal --error-rate 0.02
+
+GET /stats reports, among other counters, which requests referenced a
+cached prompt prefix and how many prompt characters were actually sent.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+DOCUMENT_PATTERN = re.compile(r"\[Document(?: \d+)?: ([^\]]+)\]")
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+ERROR_STATUSES = {400: "INVALID_ARGUMENT", 429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE",
+                  504: "DEADLINE_EXCEEDED"}
+
+
+class StubStats:
+    #Counters describing the load the stub has seen
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.streamed = 0
+        self.caches_created = 0
+        self.caches_refreshed = 0
+        self.cached_requests = 0
+        self.inline_requests = 0
+        self.prompt_chars = 0
+        # Injected failures: HTTP status -> count, and answers sent that break the response schema
+        self.errors = {}
+        self.invalid = 0
+        # Most recent generate requests and the cached content each one referenced, if any
+        self.cache_log = deque(maxlen=100)
+
+    def record(self, cached_content) -> None:
+        if cached_content:
+            self.cached_requests += 1
+        else:
+            self.inline_requests += 1
+        self.cache_log.append({"request": self.requests, "cached_content": cached_content})
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "streamed": self.streamed,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "caches_created": self.caches_created,
+            "caches_refreshed": self.caches_refreshed,
+            "cached_requests": self.cached_requests,
+            "inline_requests": self.inline_requests,
+            "prompt_chars": self.prompt_chars,
+            "errors": dict(self.errors),
+            "invalid": self.invalid,
+            "cache_log": list(self.cache_log),
+        }
+
+
+def build_answer(prompt: str) -> dict:
+    #Deterministic ticket answer citing the documents found in the prompt
+    references = list(dict.fromkeys(DOCUMENT_PATTERN.findall(prompt)))
+    return {
+        "answer": "This is a stubbed answer based on the provided documents.",
+        "references": references,
+        "action_required": "none" if references else "follow_up_required",
+    }
+
+
+def sample_latency(rng: random.Random, mean: float, distribution: str = "fixed", sigma: float = 0.5) -> float:
+    #Seconds before the first byte; every distribution has the given mean
+    if mean <= 0:
+        return 0.0
+    if distribution == "fixed":
+        return mean
+    if distribution == "uniform":
+        return rng.uniform(0.0, 2.0 * mean)
+    if distribution == "exponential":
+        return rng.expovariate(1.0 / mean)
+    if distribution == "lognormal":
+        # A long right tail, like real model latencies
+        return rng.lognormvariate(math.log(mean) - sigma ** 2 / 2.0, sigma)
+    raise ValueError(f"Unknown latency distribution {distribution!r}")
+
+
+def prompt_text(body: dict) -> str:
+    #Concatenate all text parts of a generateContent request
+    texts = []
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            texts.append(part.get("text", ""))
+    return "".join(texts)
+
+
+def gemini_error(code: int, status: str, message: str) -> JSONResponse:
+    #Error body in the shape the Gemini API (and so the SDK) uses
+    return JSONResponse(status_code=code, content={"error": {"code": code, "message": message, "status": status}})
+
+
+def timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def parse_ttl(ttl: str, default: float = 3600.0) -> float:
+    return float(ttl.rstrip("s")) if ttl else default
+
+
+def candidate(text: str, model: str, finished: bool = True) -> dict:
+    response = {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+        }],
+        "modelVersion": model,
+    }
+    if finished:
+        response["candidates"][0]["finishReason"] = "STOP"
+    return response
+
+
+def create_app(latency: float = 0.0, chunk_chars: int = 16, chunk_delay: float = 0.0,
+               min_cache_chars: int = 0, latency_distribution: str = "fixed", latency_sigma: float = 0.5,
+               error_rate: float = 0.0, error_statuses=(429, 500, 503), invalid_rate: float = 0.0,
+               seed: int = None) -> FastAPI:
+    #latency: mean wait before the first byte, drawn from latency_distribution; streamed answers then
+    #arrive chunk_chars at a time, chunk_delay seconds apart, like tokens from the real model.
+    #min_cache_chars: smaller cachedContents are rejected, like the provider's minimum cache size.
+    #error_rate: share of generate requests failing with one of error_statuses after their latency;
+    #invalid_rate: share answered with JSON that misses the answer fields
+    if latency_distribution not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"Unknown latency distribution {latency_distribution!r}")
+    app = FastAPI(title="Gemini stub")
+    app.state.latency = latency
+    app.state.latency_distribution = latency_distribution
+    app.state.latency_sigma = latency_sigma
+    app.state.error_rate = error_rate
+    app.state.error_statuses = tuple(error_statuses)
+    app.state.invalid_rate = invalid_rate
+    app.state.rng = random.Random(seed)
+    app.state.chunk_chars = chunk_chars
+    app.state.chunk_delay = chunk_delay
+    app.state.min_cache_chars = min_cache_chars
+    app.state.stats = StubStats()
+    # cache name -> {"model", "text", "created", "expires"}
+    app.state.caches = {}
+
+    def cache_resource(name: str) -> dict:
+        cache = app.state.caches[name]
+        return {
+            "name": name,
+            "model": cache["model"],
+            "createTime": timestamp(cache["created"]),
+            "updateTime": timestamp(time.time()),
+            "expireTime": timestamp(cache["expires"]),
+            "usageMetadata": {"totalTokenCount": len(cache["text"]) // 4},
+        }
+
+    def live_cache(name: str):
+        cache = app.state.caches.get(name)
+        if cache is not None and cache["expires"] <= time.time():
+            del app.state.caches[name]
+            cache = None
+        return cache
+
+    @app.post("/{api_version}/cachedContents")
+    async def create_cache(api_version: str, request: Request):
+        body = await request.json()
+        text = prompt_text(body)
+        if len(text) < app.state.min_cache_chars:
+            return gemini_error(400, "INVALID_ARGUMENT",
+                                f"Cached content is too small: {len(text)} < {app.state.min_cache_chars} characters")
+        name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+        now = time.time()
+        app.state.caches[name] = {
+            "model": body.get("model", ""),
+            "text": text,
+            "created": now,
+            "expires": now + parse_ttl(body.get("ttl")),
+        }
+        app.state.stats.caches_created += 1
+        return cache_resource(name)
+
+    @app.patch("/{api_version}/cachedContents/{cache_id}")
+    async def update_cache(api_version: str, cache_id: str, request: Request):
+        name = f"cachedContents/{cache_id}"
+        cache = live_cache(name)
+        if cache is None:
+            return gemini_error(404, "NOT_FOUND", f"{name} not found")
+        body = await request.json()
+        cache["expires"] = time.time() + parse_ttl(body.get("ttl"))
+        app.state.stats.caches_refreshed += 1
+        return cache_resource(name)
+
+    @app.delete("/{api_version}/cachedContents/{cache_id}")
+    async def delete_cache(api_version: str, cache_id: str):
+        app.state.caches.pop(f"cachedContents/{cache_id}", None)
+        return {}
+
+    @app.post("/{api_version}/models/{model_action}")
+    async def generate(api_version: str, model_action: str, request: Request):
+        model, _, action = model_action.partition(":")
+        if action not in ("generateContent", "streamGenerateContent"):
+            raise HTTPException(status_code=404, detail=f"Unsupported action: {action}")
+
+        stats = app.state.stats
+        stats.requests += 1
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        streaming = False
+        try:
+            body = await request.json()
+            prompt = prompt_text(body)
+            stats.prompt_chars += len(prompt)
+            cached_content = body.get("cachedContent")
+            if cached_content:
+                cache = live_cache(cached_content)
+                if cache is None:
+                    return gemini_error(404, "NOT_FOUND", f"{cached_content} not found")
+                # The model sees the cached prefix followed by the request contents
+                prompt = cache["text"] + prompt
+            stats.record(cached_content)
+
+            rng = app.state.rng
+            delay = sample_latency(rng, app.state.latency, app.state.latency_distribution, app.state.latency_sigma)
+            if delay:
+                await asyncio.sleep(delay)
+            if app.state.error_rate and rng.random() < app.state.error_rate:
+                code = rng.choice(app.state.error_statuses)
+                stats.errors[code] = stats.errors.get(code, 0) + 1
+                return gemini_error(code, ERROR_STATUSES.get(code, "UNKNOWN"), "Injected by the stub")
+            answer = build_answer(prompt)
+            if app.state.invalid_rate and rng.random() < app.state.invalid_rate:
+                stats.invalid += 1
+                answer = {"references": answer["references"]}
+            text = json.dumps(answer)
+            if action == "generateContent":
+                return candidate(text, model)
+
+            streaming = True
+            return StreamingResponse(stream_text(text, model), media_type="text/event-stream")
+        finally:
+            if not streaming:
+                stats.in_flight -= 1
+
+    async def stream_text(text: str, model: str):
+        #Server-sent events in the format of streamGenerateContent?alt=sse
+        size = max(1, app.state.chunk_chars)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        try:
+            for i, piece in enumerate(pieces):
+                if i and app.state.chunk_delay:
+                    await asyncio.sleep(app.state.chunk_delay)
+                yield f"data: {json.dumps(candidate(piece, model, finished=i == len(pieces) - 1))}\r\n\r\n"
+            app.state.stats.streamed += 1
+        finally:
+            app.state.stats.in_flight -= 1
+
+    @app.get("/stats")
+    async def get_stats():
+        return app.state.stats.as_dict()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Gemini API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Mean seconds to wait before answering each request")
+    parser.add_argument("--latency-distribution", choices=LATENCY_DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--latency-sigma", type=float, default=0.5,
+                        help="Shape of the lognormal distribution; larger means a longer tail")
+    parser.add_argument("--chunk-chars", type=int, default=16,
+                        help="Characters per chunk of a streamed answer")
+    parser.add_argument("--chunk-delay", type=float, default=0.0,
+                        help="Seconds between chunks of a streamed answer")
+    parser.add_argument("--min-cache-chars", type=int, default=0,
+                        help="Reject cached contents smaller than this, like the provider's minimum")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of generate requests answered with an error status")
+    parser.add_argument("--error-statuses", type=int, nargs="+", default=[429, 500, 503],
+                        choices=sorted(ERROR_STATUSES))
+    parser.add_argument("--invalid-rate", type=float, default=0.0,
+                        help="Share of answers that do not match the response schema")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+    app = create_app(latency=args.latency, chunk_chars=args.chunk_chars, chunk_delay=args.chunk_delay,
+                     min_cache_chars=args.min_cache_chars, latency_distribution=args.latency_distribution,
+                     latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+                     error_statuses=args.error_statuses, invalid_rate=args.invalid_rate, seed=args.seed)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+HTTP load generator for the ticket API.
+
+Replays tickets from a JSONL file (one object per line with a "query", or a
+"title" and "body") against a running server and reports throughput,
+p50/p95/p99 latency, the server's per-stage timings (from the Server-Timing
+header) and errors by kind and by the stage that failed:
+
+    python src/tools/llm_stub.py --latency 0.8 --latency-distribution lognormal --error-rate 0.01
+    cd src/api && LLM_BASE_URL=http://localhost:8090 uvicorn app:app --port 8000
+    python src/tools/loadgen.py tickets.jsonl --concurrency 1 4 16 64 --duration 30
+    python src/tools/loadgen.py tickets.jsonl --rate 20 --concurrency 128 --duration 60 --stream --json load.json
+
+Without --rate every connection sends its next ticket as soon as the previous
+one is answered (closed loop); several --concurrency values are run one after
+the other, so the throughput column shows where the server saturates. With
+--rate tickets arrive as a Poisson process of that many per second (open
+loop), --concurrency caps the requests in flight, and latency counts from the
+scheduled arrival, so time spent queueing for a connection is not hidden.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from pathlib import Path
+import httpx
+import numpy as np
+
+
+TIMING_ENTRY = re.compile(r'\s*([\w-]+)((?:\s*;\s*\w+=(?:"[^"]*"|[^;,]*))*)')
+TIMING_PARAM = re.compile(r'(\w+)=(?:"([^"]*)"|([^;,]*))')
+
+
+def load_tickets(path: str) -> list[str]:
+    #Ticket queries from a JSONL file; lines without a "query" join their title and body
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            ticket = json.loads(line)
+            query = ticket.get("query") or "\n\n".join(filter(None, (ticket.get("title"), ticket.get("body"))))
+            if not query:
+                raise ValueError(f"{path}:{number}: ticket has no query, title or body")
+            queries.append(query)
+    if not queries:
+        raise ValueError(f"{path} contains no tickets")
+    return queries
+
+
+def parse_server_timing(header: str) -> tuple[dict, str]:
+    #Server-Timing header -> ({stage: milliseconds}, the stage marked desc="failed" or None)
+    stages, failed = {}, None
+    for match in TIMING_ENTRY.finditer(header or ""):
+        params = {key: quoted or plain for key, quoted, plain in TIMING_PARAM.findall(match.group(2))}
+        if "dur" in params:
+            stages[match.group(1)] = float(params["dur"])
+        if params.get("desc") == "failed":
+            failed = match.group(1)
+    return stages, failed
+
+
+async def send_ticket(client: httpx.AsyncClient, query: str, stream: bool = False, start: float = None) -> dict:
+    #One ticket; latency counts from `start` (the scheduled arrival) when given
+    start = time.perf_counter() if start is None else start
+    result = {"status": None, "error": None, "stages": {}, "failed_stage": None, "ttfb": None}
+    try:
+        if stream:
+            async with client.stream("POST", "/resolve-ticket/stream", json={"query": query}) as response:
+                result["status"] = response.status_code
+                result["stages"], result["failed_stage"] = parse_server_timing(response.headers.get("server-timing"))
+                if response.status_code == 200:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("event:"):
+                            continue
+                        if result["ttfb"] is None:
+                            result["ttfb"] = time.perf_counter() - start
+                        if line[len("event:"):].strip() == "error":
+                            result["error"], result["failed_stage"] = "stream_error", "stream"
+                else:
+                    await response.aread()
+        else:
+            response = await client.post("/resolve-ticket", json={"query": query})
+            result["status"] = response.status_code
+            result["stages"], result["failed_stage"] = parse_server_timing(response.headers.get("server-timing"))
+        if result["status"] != 200:
+            result["error"] = f"http_{result['status']}"
+            result["failed_stage"] = result["failed_stage"] or "server"
+    except httpx.TimeoutException:
+        result["error"], result["failed_stage"] = "timeout", "client"
+    except httpx.TransportError as e:
+        result["error"], result["failed_stage"] = type(e).__name__, "client"
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def run_load(url: str, queries: list[str], concurrency: int = 8, rate: float = None, requests: int = None,
+                   duration: float = None, stream: bool = False, timeout: float = 60.0, seed: int = 0,
+                   transport=None) -> dict:
+    #Send tickets until `requests` were sent or `duration` seconds passed, then summarize
+    if requests is None and duration is None:
+        requests = len(queries)
+    tickets = itertools.cycle(queries)
+    results, sent = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits, transport=transport) as client:
+        start = time.perf_counter()
+        deadline = start + duration if duration is not None else None
+
+        def more() -> bool:
+            return ((requests is None or sent < requests)
+                    and (deadline is None or time.perf_counter() < deadline))
+
+        if rate is None:
+            async def connection():
+                nonlocal sent
+                while more():
+                    sent += 1
+                    results.append(await send_ticket(client, next(tickets), stream))
+
+            await asyncio.gather(*[connection() for _ in range(concurrency)])
+        else:
+            rng = random.Random(seed)
+            slots = asyncio.Semaphore(concurrency)
+
+            async def arrival(scheduled: float, query: str):
+                async with slots:
+                    results.append(await send_ticket(client, query, stream, start=scheduled))
+
+            tasks, next_arrival = [], start
+            while more():
+                await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+                sent += 1
+                tasks.append(asyncio.create_task(arrival(next_arrival, next(tickets))))
+                next_arrival += rng.expovariate(rate)
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    summary = summarize(results, elapsed)
+    summary["concurrency"], summary["rate"] = concurrency, rate
+    return summary
+
+
+def percentiles(values) -> dict:
+    if not len(values):
+        return {}
+    values = np.asarray(values, dtype=np.float64)
+    return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)), "max": float(values.max())}
+
+
+def summarize(results: list[dict], elapsed: float) -> dict:
+    #Throughput, latency of successful tickets, server stage timings and errors of one run
+    ok = [r for r in results if r["error"] is None]
+    stages = {}
+    for result in results:
+        for stage, ms in result["stages"].items():
+            stages.setdefault(stage, []).append(ms)
+    errors_by_kind, errors_by_stage = {}, {}
+    for result in results:
+        if result["error"] is not None:
+            errors_by_kind[result["error"]] = errors_by_kind.get(result["error"], 0) + 1
+            errors_by_stage[result["failed_stage"]] = errors_by_stage.get(result["failed_stage"], 0) + 1
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "seconds": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+        "ok_rps": len(ok) / elapsed if elapsed else 0.0,
+        "latency_ms": percentiles([r["latency"] * 1000.0 for r in ok]),
+        "ttfb_ms": percentiles([r["ttfb"] * 1000.0 for r in ok if r["ttfb"] is not None]),
+        "stages_ms": {stage: percentiles(values) for stage, values in stages.items()},
+        "errors_by_kind": errors_by_kind,
+        "errors_by_stage": errors_by_stage,
+    }
+
+
+def format_summary(summaries: list[dict]) -> str:
+    lines = [f"{'conc':>5} {'rate':>6} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    for s in summaries:
+        latency = s["latency_ms"]
+        lines.append(f"{s['concurrency']:>5} {s['rate'] or '-':>6} {s['requests']:>6} {s['errors']:>6} "
+                     f"{s['throughput_rps']:>8.2f} {latency.get('p50', 0):>9.1f} {latency.get('p95', 0):>9.1f} "
+                     f"{latency.get('p99', 0):>9.1f}")
+    for s in summaries:
+        lines.append(f"\nconcurrency {s['concurrency']}: server stages (ms)")
+        for stage, p in s["stages_ms"].items():
+            lines.append(f"  {stage:<8} p50={p['p50']:.1f} p95={p['p95']:.1f} p99={p['p99']:.1f}")
+        if s["ttfb_ms"]:
+            lines.append(f"  first event p50={s['ttfb_ms']['p50']:.1f} p95={s['ttfb_ms']['p95']:.1f}")
+        if s["errors"]:
+            lines.append(f"  errors by kind:  {s['errors_by_kind']}")
+            lines.append(f"  errors by stage: {s['errors_by_stage']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tickets", help="JSONL file of tickets")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8],
+                        help="connections, or the cap on requests in flight with --rate; one run per value")
+    parser.add_argument("--rate", type=float, default=None, help="Poisson arrivals per second (open loop)")
+    parser.add_argument("--requests", type=int, default=None, help="tickets per run (default: the file once)")
+    parser.add_argument("--duration", type=float, default=None, help="seconds per run")
+    parser.add_argument("--stream", action="store_true", help="use /resolve-ticket/stream")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--warmup", type=int, default=0, help="tickets sent before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the summaries to this file")
+    args = parser.parse_args()
+
+    queries = load_tickets(args.tickets)
+    if args.warmup:
+        asyncio.run(run_load(args.url, queries, concurrency=max(args.concurrency), requests=args.warmup,
+                             stream=args.stream, timeout=args.timeout))
+    summaries = []
+    for concurrency in args.concurrency:
+        summaries.append(asyncio.run(run_load(args.url, queries, concurrency=concurrency, rate=args.rate,
+                                              requests=args.requests, duration=args.duration, stream=args.stream,
+                                              timeout=args.timeout, seed=args.seed)))
+    print(format_summary(summaries))
+    if args.json:
+        Path(args.json).write_text(json.dumps({"url": args.url, "tickets": args.tickets, "runs": summaries},
+                                              indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()